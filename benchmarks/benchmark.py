@@ -0,0 +1,277 @@
+"""
+Benchmark of dumping, restoring and anonymizing a generated database.
+
+Run from the root of the repository, e.g.:
+
+    python -m benchmarks.benchmark --rows 1000000 --dbname bench --anonymized-dbname bench_anonymized \
+        --user postgres --update-baseline
+
+The generated tables replace any tables of the same names in the source database.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+import yaml
+
+from pgantomizer.anonymize import anonymize_db, load_db_to_new_instance
+from pgantomizer.dump import dump_db
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_PATH = os.path.join(HERE, "schema.yaml")
+DEFAULT_BASELINE_PATH = os.path.join(HERE, "baseline.json")
+STAGES = ("dump", "load", "anonymize")
+WIDE_TABLE_COLUMNS = 20
+
+# Every value is derived from the row number only, so that the same data is generated on every run
+GENERATE_DATA_SQL = """
+DROP TABLE IF EXISTS event, customer_profile, customer_address, customer CASCADE;
+
+CREATE TABLE customer (
+    customer_id serial PRIMARY KEY,
+    name varchar NOT NULL,
+    language varchar NOT NULL,
+    currency varchar NOT NULL,
+    ip inet NOT NULL
+);
+
+CREATE TABLE customer_address (
+    id serial PRIMARY KEY,
+    customer_id integer NOT NULL REFERENCES customer(customer_id),
+    address_line varchar NOT NULL,
+    country varchar NOT NULL
+);
+
+CREATE TABLE customer_profile (
+    id serial PRIMARY KEY,
+    customer_id integer NOT NULL REFERENCES customer(customer_id),
+    {wide_columns}
+);
+
+CREATE TABLE event (
+    id bigint,
+    customer_id integer NOT NULL,
+    note varchar(100) NOT NULL,
+    created date NOT NULL,
+    PRIMARY KEY (id, created)
+) PARTITION BY RANGE (created);
+CREATE TABLE event_2020 PARTITION OF event FOR VALUES FROM ('2020-01-01') TO ('2021-01-01');
+CREATE TABLE event_2021 PARTITION OF event FOR VALUES FROM ('2021-01-01') TO ('2022-01-01');
+CREATE TABLE event_2022 PARTITION OF event FOR VALUES FROM ('2022-01-01') TO ('2023-01-01');
+CREATE TABLE event_2023 PARTITION OF event FOR VALUES FROM ('2023-01-01') TO ('2024-01-01');
+
+INSERT INTO customer
+SELECT
+    i,
+    'Customer ' || md5(i::text),
+    (ARRAY['en', 'fr', 'de', 'tlh'])[i % 4 + 1],
+    (ARRAY['EUR', 'USD', 'KR'])[i % 3 + 1],
+    ('10.' || (i >> 16) % 256 || '.' || (i >> 8) % 256 || '.' || i % 256)::inet
+FROM generate_series(1, {rows}) i;
+
+INSERT INTO customer_address
+SELECT i, i, 'Street ' || md5(i::text) || ' ' || i % 1000, (ARRAY['France', 'Kronos', 'Vulcan'])[i % 3 + 1]
+FROM generate_series(1, {rows}) i;
+
+INSERT INTO customer_profile
+SELECT i, i, {wide_values}
+FROM generate_series(1, greatest({rows} / 10, 1)) i;
+
+INSERT INTO event
+SELECT i, i % {rows} + 1, 'Event ' || md5(i::text), '2020-01-01'::date + i % 1461
+FROM generate_series(1, 2 * {rows}) i;
+
+SELECT setval(pg_get_serial_sequence(table_name, column_name), {rows})
+FROM (VALUES ('customer', 'customer_id'), ('customer_address', 'id'), ('customer_profile', 'id')) s(table_name, column_name);
+"""
+
+
+def generate_data(db_args, rows):
+    conn = psycopg2.connect(**db_args)
+    # VACUUM cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                GENERATE_DATA_SQL.format(
+                    wide_columns=",\n    ".join(
+                        "attribute_{} text NOT NULL".format(i) for i in range(WIDE_TABLE_COLUMNS)
+                    ),
+                    wide_values=", ".join(
+                        "md5((i + {})::text)".format(i) for i in range(WIDE_TABLE_COLUMNS)
+                    ),
+                    rows=int(rows),
+                )
+            )
+            cursor.execute("VACUUM ANALYZE")
+    finally:
+        conn.close()
+
+
+def get_size_and_wal_lsn(db_args):
+    conn = psycopg2.connect(**db_args)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT sum(pg_total_relation_size(c.oid))::bigint, pg_current_wal_insert_lsn() "
+                "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname = 'public' AND c.relkind = 'r';"
+            )
+            return cursor.fetchone()
+    finally:
+        conn.close()
+
+
+def get_wal_bytes_since(db_args, wal_lsn):
+    conn = psycopg2.connect(**db_args)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), %s)::bigint;", (wal_lsn,)
+            )
+            return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_benchmark(source_db_args, db_args, dump_format="custom", jobs=1):
+    """
+    Dump the source DB, load the dump into the target DB and anonymize it, returning the seconds per stage.
+    The size of the anonymized tables and the WAL generated by the anonymization are returned as well,
+    so that `pgantomizer --plan` can project the anonymization of other DBs from them.
+    """
+    results = {}
+    dump_path = os.path.join(tempfile.mkdtemp(), "benchmark_dump")
+    try:
+        start = time.monotonic()
+        dump_db(
+            dump_path,
+            SCHEMA_PATH,
+            source_db_args["password"],
+            *[source_db_args[name] for name in ("dbname", "user", "host", "port")],
+            dump_format=dump_format,
+            jobs=jobs,
+        )
+        results["dump"] = time.monotonic() - start
+
+        start = time.monotonic()
+        load_db_to_new_instance(dump_path, db_args)
+        results["load"] = time.monotonic() - start
+
+        size, wal_lsn = get_size_and_wal_lsn(db_args)
+        start = time.monotonic()
+        anonymize_db(yaml.load(open(SCHEMA_PATH), Loader=yaml.FullLoader), db_args, False, jobs)
+        results["anonymize"] = time.monotonic() - start
+        results["anonymize_bytes"] = size
+        results["anonymize_wal_bytes"] = get_wal_bytes_since(db_args, wal_lsn)
+    finally:
+        shutil.rmtree(os.path.dirname(dump_path))
+    return results
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """Return the stages that are slower than in the baseline by more than the threshold (e.g. 0.2 for 20 %)."""
+    regressions = []
+    for stage in STAGES:
+        if stage not in baseline:
+            continue
+        change = results[stage] / baseline[stage] - 1
+        logging.info(
+            "{:<10} {:>10.2f} s {:>10.2f} s {:>+8.1%}".format(
+                stage, baseline[stage], results[stage], change
+            )
+        )
+        if change > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark dumping, restoring and anonymizing a generated database "
+        "and compare the timings with a stored baseline.",
+    )
+    parser.add_argument(
+        "--rows", type=int, default=1000000, help="number of customers, other tables are scaled accordingly"
+    )
+    parser.add_argument(
+        "--skip-generate", action="store_true", help="reuse the data generated by a previous run"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="run the benchmark repeatedly and keep the fastest time of each stage"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of parallel jobs to dump and anonymize with")
+    parser.add_argument(
+        "-F", "--format", choices=("custom", "directory"), default="custom", help="archive format of the dump"
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="JSON file with the baseline timings")
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="store the timings as the new baseline instead of comparing"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fail if a stage is slower than the baseline by more than this fraction",
+    )
+    parser.add_argument("--dbname", help="name of the database to generate the data in", required=True)
+    parser.add_argument(
+        "--anonymized-dbname", help="name of the database to restore and anonymize the data in", required=True
+    )
+    parser.add_argument("--user", help="name of the Postgres user with access to both databases", required=True)
+    parser.add_argument("--password", help="password of the Postgres user", default="")
+    parser.add_argument("--host", help="host where the DB is running", default="localhost")
+    parser.add_argument("--port", help="port where the DB is running", default="5432")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+
+    source_db_args = {
+        "dbname": args.dbname,
+        "user": args.user,
+        "password": args.password,
+        "host": args.host,
+        "port": args.port,
+    }
+    db_args = {**source_db_args, "dbname": args.anonymized_dbname}
+
+    if not args.skip_generate:
+        logging.info("Generating data for {} customers ...".format(args.rows))
+        generate_data(source_db_args, args.rows)
+
+    results = {}
+    for _ in range(args.repeat):
+        for key, value in run_benchmark(source_db_args, db_args, args.format, args.jobs).items():
+            results[key] = min(value, results.get(key, value))
+    results["rows"] = args.rows
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        logging.info("Stored the baseline in {}: {}".format(args.baseline, results))
+        return
+
+    if not os.path.isfile(args.baseline):
+        sys.exit("Baseline {} does not exist, create it with --update-baseline.".format(args.baseline))
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get("rows") != args.rows:
+        sys.exit("Baseline {} was measured with {} rows.".format(args.baseline, baseline.get("rows")))
+
+    logging.info("{:<10} {:>12} {:>12} {:>9}".format("stage", "baseline", "current", "change"))
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    if regressions:
+        sys.exit(
+            "Stages slower by more than {:.0%}: {}".format(args.threshold, ", ".join(regressions))
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,94 @@
 import argparse
+import itertools
+import json
 import logging
 import os
+import re
 import subprocess
 import sys
+import tempfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 
 import yaml
 
-from .utils import get_in
+from .catalog import (
+    get_foreign_keys,
+    get_namespaces,
+    get_referencing_tables,
+    load_catalog,
+)
+from .domains import (
+    MAPPING_SCHEMA,
+    create_mapping_tables,
+    drop_mapping_tables,
+    get_domain_update_statement,
+    get_pseudonym_expression,
+)
+from .dump import (
+    get_db_args_from_env,
+    get_dump_command,
+    get_emptied_source_tables,
+    get_source_db_args_from_env,
+)
+from .incremental import (
+    STATE_SCHEMA,
+    copy_changed_rows,
+    create_watermark_table,
+    delete_removed_rows,
+    get_watermark_column,
+    has_watermark_table,
+    record_watermark,
+)
+from .journal import ANONYMIZE_STAGE, RESTORE_STAGE, Journal
+from .metrics import Metrics
+from .python_rules import (
+    PYTHON_ANONYMIZATION_RULES,
+    export_python_rule_values,
+    import_python_rule_values,
+    resolve_python_rule,
+)
+from .rewrite import get_rewrite_blocker, rewrite_table
+from .subset import has_subset, has_subset_data, load_subset
+from .template import publish_template
+from .transfer import transfer_table
+from .utils import (
+    execute_statements,
+    expand_schema,
+    get_in,
+    get_namespace_patterns,
+    get_truncated_tables,
+    qualify_table_name,
+    quote_table_name,
+    split_table_name,
+    get_temporary_table_name,
+    unquote_identifier,
+    table_matches,
+)
 
 
 DEFAULT_PK_COLUMN_NAME = "id"
+ANONYMIZED_VARCHAR_LENGTH = 250
+DEFAULT_RESTORE_JOBS = 8
+
+MATCHED_TABLE_SUFFIX = "__matched"
+
+UPDATE_ENGINE = "update"
+REWRITE_ENGINE = "rewrite"
+ENGINES = (UPDATE_ENGINE, REWRITE_ENGINE)
+
+# Indexes, constraints and triggers live in post-data and can be restored after anonymization
+PRE_DATA_SECTIONS = ("pre-data", "data")
+POST_DATA_SECTIONS = ("post-data",)
+
+# Session settings of the ephemeral mode, which gives up durability of the target DB for speed
+EPHEMERAL_SETTINGS = OrderedDict(
+    [("synchronous_commit", "off"), ("work_mem", "256MB"), ("maintenance_work_mem", "1GB")]
+)
 
 
 def null_anonymize(column, pk_name):
@@ -55,6 +132,24 @@ ANONYMIZE_DATA_TYPE = {
 }
 
 
+# Rules calling these functions yield a different value on every evaluation
+VOLATILE_FUNCTIONS_RE = re.compile(r"\b(\w*random\w*|clock_timestamp|timeofday|nextval)\s*\(", re.IGNORECASE)
+# Identifiers as written by pg_dump, double-quoted unless they are plain lowercase names
+IDENTIFIER = r'("(?:[^"]|"")+"|[^\s."(]+)'
+# Tables as defined by pg_dump, with the possibly quoted namespace and name
+TABLE_DEFINITION = re.compile(
+    r"^CREATE (?:UNLOGGED )?TABLE {identifier}\.{identifier} ".format(identifier=IDENTIFIER), re.MULTILINE
+)
+# Foreign keys as defined by pg_dump, with the possibly quoted namespaces and names of both tables
+FOREIGN_KEY_DEFINITION = re.compile(
+    r"^ALTER TABLE (?:ONLY )?{identifier}\.{identifier}\s+ADD CONSTRAINT .*? FOREIGN KEY \(.*?\) "
+    r"REFERENCES {identifier}\.{identifier}\(".format(identifier=IDENTIFIER),
+    re.MULTILINE,
+)
+# Types whose names without a modifier denote a length of 1
+UNBOUNDED_DATA_TYPES = {"character": "bpchar", "bit": "varbit"}
+
+
 CUSTOM_ANONYMIZATION_RULES = {
     "aggregate_length": aggregate_length,
     "x_out": x_out,
@@ -65,13 +160,6 @@ CUSTOM_ANONYMIZATION_RULES = {
 
 
 DB_ARG_NAMES = ("dbname", "user", "password", "host", "port")
-DB_ENV_NAMES = (
-    "ANONYMIZED_DB_NAME",
-    "ANONYMIZED_DB_USER",
-    "ANONYMIZED_DB_PASS",
-    "ANONYMIZED_DB_HOST",
-    "ANONYMIZED_DB_PORT",
-)
 
 
 class PgantomizerError(Exception):
@@ -94,89 +182,453 @@ def get_table_pk_name(schema, table):
     )
 
 
-def get_db_args_from_env():
-    return {name: os.environ.get(var) for name, var in zip(DB_ARG_NAMES, DB_ENV_NAMES)}
-
-
 def get_psql_db_args(db_args):
     return "-d {dbname} -U {user} -h {host} -p {port}".format(**db_args)
 
 
-def drop_schema(db_args):
-    subprocess.run(
-        'PGPASSWORD={password} psql {db_args} -c "DROP SCHEMA public CASCADE; CREATE SCHEMA public;" {redirect}'.format(
-            password=db_args.get("password"),
-            db_args=get_psql_db_args(db_args),
-            redirect=""
-            if logging.getLogger().getEffectiveLevel() == logging.DEBUG
-            else ">/dev/null 2>&1",
+def drop_schema(db_args, namespaces=()):
+    """Drop all tables of public and the given namespaces, which are recreated empty."""
+    statements = [sql.SQL("DROP SCHEMA public CASCADE; CREATE SCHEMA public")]
+    for namespace in namespaces:
+        if namespace != "public":
+            statements.append(
+                sql.SQL(
+                    "DROP SCHEMA IF EXISTS {namespace} CASCADE; CREATE SCHEMA {namespace}"
+                ).format(namespace=sql.Identifier(namespace))
+            )
+    for schema in (MAPPING_SCHEMA, STATE_SCHEMA):
+        statements.append(
+            sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(schema))
+        )
+    with psycopg2.connect(**db_args) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("; ").join(statements))
+
+
+def read_restore_list(filename):
+    return subprocess.run(
+        ["pg_restore", "-l", filename],
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stdout
+
+
+def read_dump_definitions(filename, entry_type):
+    """Return the SQL of the entries of the given type in the dump, rendered by pg_restore without a DB."""
+    entry = re.compile(r"^\d+; \d+ \d+ {} ".format(entry_type))
+    with tempfile.NamedTemporaryFile("w", suffix=".list", delete=False) as list_file:
+        for line in read_restore_list(filename).splitlines():
+            if entry.match(line):
+                list_file.write(line + "\n")
+    try:
+        return subprocess.run(
+            ["pg_restore", "-L", list_file.name, "-f", "-", filename],
+            stdout=subprocess.PIPE,
+            check=True,
+            universal_newlines=True,
+        ).stdout
+    finally:
+        os.remove(list_file.name)
+
+
+def get_dump_namespaces(filename):
+    """Return the names of the namespaces of the tables in the dump, which pg_dump -t does not create."""
+    return sorted(
+        {
+            unquote_identifier(match.group(1))
+            for match in TABLE_DEFINITION.finditer(read_dump_definitions(filename, "TABLE(?! DATA )"))
+        }
+    )
+
+
+def get_dump_referencing_tables(filename, tables):
+    """
+    Return names of all tables of the dump that reference any of the given tables, whose namespaces
+    may be glob patterns, through a chain of foreign keys. The foreign keys are read from their definitions
+    in the dump, as they are only restored with the post-data.
+    """
+    definitions = read_dump_definitions(filename, "FK CONSTRAINT")
+    foreign_keys = [
+        (
+            qualify_table_name(*map(unquote_identifier, match.group(1, 2))),
+            qualify_table_name(*map(unquote_identifier, match.group(3, 4))),
+        )
+        for match in FOREIGN_KEY_DEFINITION.finditer(definitions)
+    ]
+    referencing = set()
+    while True:
+        found = {
+            table
+            for table, referenced in foreign_keys
+            if referenced in referencing or any(table_matches(pattern, referenced) for pattern in tables)
+        } - referencing
+        if not found:
+            return sorted(referencing)
+        referencing |= found
+
+
+def get_dump_emptied_tables(filename, schema):
+    """
+    Return the tables whose data is not restored from the dump as the truncate rules drop it:
+    the truncated tables and the tables referencing the tables truncated with cascade.
+    """
+    truncated = get_truncated_tables(schema)
+    cascaded = [table for table in truncated if schema[table]["truncate"] == "cascade"]
+    return truncated + (get_dump_referencing_tables(filename, cascaded) if cascaded else [])
+
+
+def get_table_entry_names(entry):
+    """
+    Return the names the TOC entry may refer to, given the rest of its line after the type.
+    pg_restore -l lists the namespace, the name and the owner unquoted, separated by spaces,
+    so names containing spaces make the split ambiguous.
+    """
+    spaces = [index for index, character in enumerate(entry) if character == " "]
+    return [
+        qualify_table_name(entry[:first], entry[first + 1 : second])
+        for first, second in itertools.combinations(spaces, 2)
+    ]
+
+
+def write_restore_list(filename, excluded_data_tables):
+    """
+    Write the table of contents of the dump without TABLE DATA entries of the given tables
+    to a temporary file usable with `pg_restore -L` and return its path.
+    """
+    table_data_entry = re.compile(r"^\d+; \d+ \d+ TABLE DATA (.+)$")
+    with tempfile.NamedTemporaryFile("w", suffix=".list", delete=False) as list_file:
+        for line in read_restore_list(filename).splitlines():
+            match = table_data_entry.match(line)
+            excluded = match and next(
+                (
+                    name
+                    for name in get_table_entry_names(match.group(1))
+                    if any(table_matches(table, name) for table in excluded_data_tables)
+                ),
+                None,
+            )
+            if excluded:
+                logging.debug("Skipping restore of data for table {}".format(excluded))
+                continue
+            list_file.write(line + "\n")
+    return list_file.name
+
+
+def get_restore_command(
+    filename, db_args, sections=None, list_filename=None, jobs=DEFAULT_RESTORE_JOBS
+):
+    """Build the pg_restore command, reading a custom format archive from stdin if no filename is given."""
+    return "PGPASSWORD={password} {options}pg_restore -F {format} {jobs}{sections}{list_file}{db_args} {filename}{redirect}".format(
+        password=db_args.get("password"),
+        options="PGOPTIONS='{}' ".format(db_args["options"]) if db_args.get("options") else "",
+        format="d" if filename and os.path.isdir(filename) else "c",
+        # Parallel restore needs to seek in the archive, which is not possible in a stream
+        jobs="-j {} ".format(jobs) if filename else "",
+        sections="".join("--section={} ".format(section) for section in sections or []),
+        list_file="-L {} ".format(list_filename) if list_filename else "",
+        db_args=get_psql_db_args(db_args),
+        filename=filename or "",
+        redirect=""
+        if logging.getLogger().getEffectiveLevel() == logging.DEBUG
+        else " >/dev/null 2>&1",
+    )
+
+
+def restore_db(
+    filename, db_args, sections=None, excluded_data_tables=(), jobs=DEFAULT_RESTORE_JOBS, check=False
+):
+    """
+    Restore the given sections (all if None) of the dump. The rows of a subset dumped by `dump_subset`
+    are loaded after the data section, before the post-data adds the indexes and the constraints.
+    pg_restore skips the items that fail, e.g. foreign keys to tables left out of the dump;
+    with `check`, any failed item raises `PgantomizerError` instead.
+    """
+    restored_sections = sections or ("pre-data", "data", "post-data")
+    if has_subset_data(filename) and "data" in restored_sections and "post-data" in restored_sections:
+        restore_db(filename, db_args, PRE_DATA_SECTIONS, excluded_data_tables, jobs, check)
+        restore_db(filename, db_args, POST_DATA_SECTIONS, excluded_data_tables, jobs, check)
+        return
+    list_filename = (
+        write_restore_list(filename, excluded_data_tables) if excluded_data_tables else None
+    )
+    try:
+        returncode = subprocess.run(
+            get_restore_command(filename, db_args, sections, list_filename, jobs), shell=True
+        ).returncode
+    finally:
+        if list_filename:
+            os.remove(list_filename)
+    if check and returncode != 0:
+        raise PgantomizerError("Restoring the dump failed, pg_restore exited with {}".format(returncode))
+    if has_subset_data(filename) and "data" in restored_sections:
+        load_subset(filename, db_args, excluded_data_tables)
+
+
+def get_session_options(settings):
+    """Return the settings as the `options` connection argument, which pg_restore reads from PGOPTIONS."""
+    return " ".join("-c {}={}".format(name, value) for name, value in settings.items())
+
+
+def report_session_settings(db_args, metrics):
+    with psycopg2.connect(**db_args) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT name, current_setting(name) FROM pg_settings WHERE name = ANY(%s) ORDER BY name;",
+                (list(EPHEMERAL_SETTINGS),),
+            )
+            for name, setting in cursor.fetchall():
+                logging.info("Running with {} = {}".format(name, setting))
+                metrics.settings[name] = setting
+
+
+def set_tables_persistence(db_args, logged):
+    """
+    Switch all tables to LOGGED or UNLOGGED. Unlogged tables are written without WAL, but they are emptied
+    if the server crashes. Switching an empty table is instant, switching a filled one rewrites it.
+    Foreign keys must not exist yet, as they cannot connect tables of different persistence.
+    """
+    with psycopg2.connect(**db_args) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.oid::regclass FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                "WHERE n.nspname !~ '^pg_' AND n.nspname <> 'information_schema' "
+                "AND c.relkind = 'r' AND c.relpersistence = %s;",
+                ("u" if logged else "p",),
+            )
+            for (table,) in cursor.fetchall():
+                logging.debug("Setting {} {}".format(table, "LOGGED" if logged else "UNLOGGED"))
+                cursor.execute("ALTER TABLE {} SET {}".format(table, "LOGGED" if logged else "UNLOGGED"))
+
+
+def split_restore(restore, db_args, sections, unlogged):
+    """
+    Run the restore of the given sections (all if None) as a whole, or with `unlogged`, restore the table
+    definitions first and switch the tables to UNLOGGED before their data is loaded.
+    """
+    if not unlogged:
+        restore(sections)
+        return
+    restore(("pre-data",))
+    set_tables_persistence(db_args, logged=False)
+    restore(
+        tuple(section for section in sections or ("data", "post-data") if section != "pre-data")
+    )
+
+
+def load_db_to_new_instance(
+    filename,
+    db_args,
+    sections=None,
+    excluded_data_tables=(),
+    jobs=DEFAULT_RESTORE_JOBS,
+    metrics=None,
+    unlogged=False,
+):
+    metrics = metrics or Metrics()
+    if not os.path.exists(filename):
+        raise IOError("Dump {} is neither a file nor a directory.".format(filename))
+    os.putenv("PGPASSWORD", db_args.get("password"))
+    with metrics.stage("drop"):
+        drop_schema(db_args, get_dump_namespaces(filename))
+    with metrics.stage("restore"):
+        split_restore(
+            lambda sections: restore_db(filename, db_args, sections, excluded_data_tables, jobs),
+            db_args,
+            sections,
+            unlogged,
+        )
+
+
+def stream_db(schema, source_db_args, db_args, sections=None, include_table_data=True):
+    """
+    Pipe an uncompressed dump of the tables listed in the schema from the source DB straight into pg_restore,
+    so that no dump file is written. The pipe blocks pg_dump whenever pg_restore falls behind.
+    Data of truncated tables and of the tables referencing the tables truncated with cascade is not dumped at all.
+    """
+    source_db_args = source_db_args or get_source_db_args_from_env()
+    dump = subprocess.Popen(
+        get_dump_command(
+            schema,
+            source_db_args.get("password") or "",
+            [source_db_args[name] for name in ("dbname", "user", "host", "port")],
+            compression="0",
+            sections=sections,
+            include_table_data=include_table_data,
+            excluded_data_tables=get_emptied_source_tables(source_db_args, schema)
+            if include_table_data
+            else (),
         ),
         shell=True,
+        stdout=subprocess.PIPE,
+    )
+    restore = subprocess.Popen(
+        get_restore_command(None, db_args, sections), shell=True, stdin=dump.stdout
     )
+    # Let pg_dump get SIGPIPE if pg_restore exits early
+    dump.stdout.close()
+    restore_returncode = restore.wait()
+    dump_returncode = dump.wait()
+    if dump_returncode != 0 or restore_returncode != 0:
+        raise PgantomizerError(
+            "Streaming the DB failed, pg_dump exited with {} and pg_restore with {}".format(
+                dump_returncode, restore_returncode
+            )
+        )
 
 
-def load_db_to_new_instance(filename, db_args):
-    if not os.path.isfile(filename):
-        raise IOError("Dump file {} is not a file.".format(filename))
+def stream_db_to_new_instance(
+    schema,
+    source_db_args,
+    db_args,
+    sections=None,
+    include_table_data=True,
+    metrics=None,
+    unlogged=False,
+):
+    metrics = metrics or Metrics()
     os.putenv("PGPASSWORD", db_args.get("password"))
-    drop_schema(db_args)
-    subprocess.run(
-        "PGPASSWORD={password} pg_restore -Fc -j 8 {db_args} {filename} {redirect}".format(
-            password=db_args.get("password"),
-            db_args=get_psql_db_args(db_args),
-            filename=filename,
-            redirect=""
-            if logging.getLogger().getEffectiveLevel() == logging.DEBUG
-            else ">/dev/null 2>&1",
+    with metrics.stage("drop"):
+        drop_schema(
+            db_args, get_schema_namespaces(source_db_args or get_source_db_args_from_env(), schema)
+        )
+    with metrics.stage("restore"):
+        split_restore(
+            lambda sections: stream_db(schema, source_db_args, db_args, sections, include_table_data),
+            db_args,
+            sections,
+            unlogged,
+        )
+
+
+def get_widen_statement(table_plan):
+    return "ALTER TABLE {table} {clauses}".format(
+        table=quote_table_name(table_plan.name),
+        clauses=", ".join(
+            "ALTER COLUMN {} TYPE varchar({})".format(column, ANONYMIZED_VARCHAR_LENGTH)
+            for column in table_plan.widened_columns
         ),
-        shell=True,
     )
 
 
-def prepare_column_for_anonymization(conn, cursor, table, column, data_type):
+def get_truncate_statement(table_plan):
+    return "TRUNCATE {table}{cascade}".format(
+        table=quote_table_name(table_plan.name), cascade=" CASCADE" if table_plan.truncate == "cascade" else ""
+    )
+
+
+def get_column_updates_sql(table_plan):
+    return ", ".join(
+        "{column} = {value}".format(column=column, value=value)
+        for column, value in table_plan.column_values
+    )
+
+
+def get_change_condition(table_plan):
     """
-    Some data types such as VARCHAR are anonymized in such a manner that the anonymized value can be longer that
-    the length constrain on the column. Therefore, the constraint is enlarged.
+    Return the condition matching only the rows whose anonymized values differ from the current ones,
+    so that rows already anonymized (or NULL where the rule yields NULL) are not written again.
+    Return None if a rule is volatile, as a row whose value happened to match one evaluation of the rule
+    would keep its raw value.
     """
-    if data_type == "character varying":
-        logging.debug("Extending length of varchar {}.{}".format(table, column))
-        cursor.execute(
-            "ALTER TABLE {table} ALTER COLUMN {column} TYPE varchar(250);".format(
-                table=table, column=column
+    if any(VOLATILE_FUNCTIONS_RE.search(value) for _, value in table_plan.column_values):
+        return None
+    columns = {column.name: column for column in table_plan.columns}
+    conditions = []
+    for column, value in table_plan.column_values:
+        data_type = columns[column].data_type
+        if not columns[column].comparable:
+            # Without a proper equality, values are the same only if their texts are
+            conditions.append("{}::text IS DISTINCT FROM ({})::text".format(column, value))
+        else:
+            # The value is compared as it would be assigned, e.g. `length(...)` to a varchar column
+            conditions.append(
+                "{} IS DISTINCT FROM ({})::{}".format(
+                    column, value, UNBOUNDED_DATA_TYPES.get(data_type, data_type)
+                )
             )
-        )
-    conn.commit()
+    return " OR ".join(conditions)
 
 
-def check_schema(cursor, schema, db_args):
-    for table in schema:
-        logging.debug("Checking definition for table {}".format(table))
+def get_update_where(table_plan):
+    """Return the WHERE clause of the UPDATE, i.e. the `where` rule of the table guarded by `get_change_condition`."""
+    change_condition = get_change_condition(table_plan)
+    if change_condition is None:
+        return table_plan.where or "TRUE"
+    if table_plan.where is None:
+        return "({})".format(change_condition)
+    return "({}) AND ({})".format(table_plan.where, change_condition)
 
-        if "truncate" in schema[table]:
-            if schema[table]["truncate"] in [True, "cascade"]:
-                continue
-            else:
-                raise InvalidAnonymizationSchemaError(
-                    "Invalid value for `truncate`: {}".format(schema[table]["truncate"])
-                )
 
-        pk_column = get_table_pk_name(schema, table)
-        raw_columns = schema[table].get("raw", [])
-        custom_rule_columns = list(schema[table].get("custom_rules", {}).keys())
-        columns_to_validate = raw_columns + custom_rule_columns
-        if pk_column is not None:
-            columns_to_validate.append(pk_column)
-        try:
-            cursor.execute(
-                "SELECT {columns} FROM {table} LIMIT 1;".format(
-                    columns='"{}"'.format('", "'.join(columns_to_validate)), table=table
+def get_update_statement(table_plan):
+    """Return the UPDATE applying all SQL rules of the table at once or None if it has none."""
+    if not table_plan.column_values:
+        return None
+    return "UPDATE {table} SET {column_updates_sql} WHERE {where}".format(
+        table=quote_table_name(table_plan.name),
+        column_updates_sql=get_column_updates_sql(table_plan),
+        where=get_update_where(table_plan),
+    )
+
+
+def get_domain_update_statements(table_plan, where=None):
+    """
+    Return the UPDATEs replacing the values of the domain columns of the table by their pseudonyms
+    in the rows matched by `where`, or by the `where` rule of the table if it is not given.
+    """
+    return [
+        get_domain_update_statement(
+            table_plan.name, column, domain, value, table_plan.where if where is None else where
+        )
+        for column, domain, value in table_plan.domain_columns
+    ]
+
+
+def prepare_tables_for_anonymization(conn, cursor, table_plans):
+    """
+    Some data types such as VARCHAR are anonymized in such a manner that the anonymized value can be longer that
+    the length constrain on the column. Therefore, the constraint is enlarged for all such columns at once.
+    Increasing the length of a varchar is a catalog-only change that neither rewrites the table nor its indexes.
+    The columns of all the tables are widened in a single round-trip and committed together.
+    """
+    statements = []
+    for table_plan in table_plans:
+        if table_plan.widened_columns:
+            logging.debug(
+                "Extending length of varchars {} in {}".format(
+                    ", ".join(table_plan.widened_columns), table_plan.name
                 )
             )
-        except psycopg2.ProgrammingError as e:
-            raise InvalidAnonymizationSchemaError(str(e))
+            statements.append(get_widen_statement(table_plan))
+    if statements:
+        execute_statements(cursor, statements)
+        conn.commit()
 
 
-def get_column_update(schema, table, column, data_type):
+def find_namespaces(cursor, schema):
+    """Return the names of the namespaces of the DB matched by the tables of the schema."""
+    return get_namespaces(cursor, get_namespace_patterns(schema), (MAPPING_SCHEMA, STATE_SCHEMA))
+
+
+def get_schema_namespaces(db_args, schema):
+    with psycopg2.connect(**db_args) as conn:
+        with conn.cursor() as cursor:
+            return find_namespaces(cursor, schema)
+
+
+def load_schema_catalog(cursor, schema):
+    """Return the schema expanded to the namespaces it matches in the DB and the catalog of the namespaces."""
+    namespaces = find_namespaces(cursor, schema)
+    return expand_schema(schema, namespaces), load_catalog(cursor, namespaces)
+
+
+def check_schema(cursor, schema, db_args):
+    """Validate the schema against the DB catalog and return the compiled `AnonymizationPlan`."""
+    return compile_plan(*load_schema_catalog(cursor, schema))
+
+
+def get_column_anonymization(schema, table, column, data_type):
+    """Return the SQL expression that anonymizes the column or None if the column is kept raw."""
     custom_rule = get_in(schema, [table, "custom_rules", column]) if schema[table] else None
 
     if column == get_table_pk_name(schema, table) or (
@@ -190,7 +642,20 @@ def get_column_update(schema, table, column, data_type):
                     'Custom rule "{}" must provide a non-None value'.format(custom_rule)
                 )
             else:
-                return "{column} = '{value}'".format(column=column, value=custom_rule["value"])
+                return "'{value}'".format(value=custom_rule["value"])
+        elif custom_rule and isinstance(custom_rule, dict) and "domain" in custom_rule:
+            if not re.match(r"^[a-z_][a-z0-9_]*$", str(custom_rule["domain"])):
+                raise InvalidAnonymizationSchemaError(
+                    'Domain "{}" must be a lowercase identifier'.format(custom_rule["domain"])
+                )
+            pseudonym = get_pseudonym_expression(custom_rule["domain"], data_type)
+            if pseudonym is None:
+                raise InvalidAnonymizationSchemaError(
+                    'Domain "{}" cannot pseudonymize type "{}" of column "{}"'.format(
+                        custom_rule["domain"], data_type, column
+                    )
+                )
+            return pseudonym
         elif custom_rule and custom_rule not in CUSTOM_ANONYMIZATION_RULES:
             raise MissingAnonymizationRuleError(
                 'Custom rule "{}" is not defined'.format(custom_rule)
@@ -200,11 +665,10 @@ def get_column_update(schema, table, column, data_type):
             if custom_rule
             else ANONYMIZE_DATA_TYPE[data_type]
         )
-        return "{column} = {value}".format(
-            column=column,
-            value=anonymization(column, get_table_pk_name(schema, table))
+        return (
+            anonymization(column, get_table_pk_name(schema, table))
             if callable(anonymization)
-            else anonymization,
+            else anonymization
         )
     else:
         raise MissingAnonymizationRuleError(
@@ -212,65 +676,964 @@ def get_column_update(schema, table, column, data_type):
         )
 
 
-def anonymize_table(conn, cursor, schema, table, disable_schema_changes):
-    logging.debug('Processing "{}" table'.format(table))
+def get_python_rule(schema, table, column):
+    """
+    Return the Python rule of the column or None if it has none. Python rules are either named
+    in `PYTHON_ANONYMIZATION_RULES` or given as `{"python": "package.module:function"}`.
+    """
+    custom_rule = get_in(schema, [table, "custom_rules", column]) if schema[table] else None
+    if isinstance(custom_rule, dict) and "python" in custom_rule:
+        return custom_rule["python"]
+    if isinstance(custom_rule, str) and custom_rule in PYTHON_ANONYMIZATION_RULES:
+        return custom_rule
+    return None
 
-    # Truncate and return if desired
-    if schema[table] and "truncate" in schema[table]:
-        cascade = ""
-        if schema[table]["truncate"] == "cascade":
-            cascade = " CASCADE"
 
-        logging.debug(
-            "Running TRUNCATE{cascade} on {table} ...".format(table=table, cascade=cascade)
+def get_column_update(schema, table, column, data_type):
+    value = get_column_anonymization(schema, table, column, data_type)
+    return None if value is None else "{column} = {value}".format(column=column, value=value)
+
+
+TablePlan = namedtuple(
+    "TablePlan",
+    [
+        "name",
+        "partitioned",
+        "truncate",
+        "columns",
+        "column_values",
+        "python_columns",
+        "domain_columns",
+        "widened_columns",
+        "pk_name",
+        "where",
+        "batch_size",
+        "watermark",
+        "size",
+    ],
+)
+AnonymizationPlan = namedtuple("AnonymizationPlan", ["tables", "domains"])
+
+
+def inherit_partition_rules(schema, catalog):
+    """
+    Return a copy of the schema in which every partition without rules of its own
+    (missing or empty) has the rules of its nearest ancestor.
+    """
+    schema = dict(schema)
+    for relation in catalog.values():
+        ancestor = relation
+        while not schema.get(ancestor.name) and ancestor.parent in catalog:
+            ancestor = catalog[ancestor.parent]
+        if ancestor is not relation and ancestor.name in schema:
+            schema[relation.name] = schema[ancestor.name]
+    return schema
+
+
+def compile_plan(schema, catalog):
+    """
+    Combine the YAML schema with the DB catalog loaded by `load_catalog` into an immutable plan
+    that holds everything needed to anonymize each table. All rules are resolved here,
+    so that an invalid schema is reported before any data is touched.
+
+    Partitioned tables are anonymized through their leaf partitions, which inherit their rules,
+    so that no row is updated twice. Their plans come first as they carry the varchar widening,
+    which can only be done on the root of the partitioning, also for the columns anonymized
+    by the rules of partitions.
+    """
+    for table in schema:
+        logging.debug("Checking definition for table {}".format(table))
+        rules = schema[table] or {}
+
+        if "truncate" in rules:
+            if rules["truncate"] in [True, "cascade"]:
+                continue
+            else:
+                raise InvalidAnonymizationSchemaError(
+                    "Invalid value for `truncate`: {}".format(rules["truncate"])
+                )
+
+        if table not in catalog:
+            raise InvalidAnonymizationSchemaError('relation "{}" does not exist'.format(table))
+        pk_column = get_table_pk_name(schema, table)
+        columns_to_validate = rules.get("raw", []) + list(rules.get("custom_rules", {}).keys())
+        if pk_column is not None:
+            columns_to_validate.append(pk_column)
+        column_names = {column.name for column in catalog[table].columns}
+        for column in columns_to_validate:
+            if column not in column_names:
+                raise InvalidAnonymizationSchemaError(
+                    'column "{}" of relation "{}" does not exist'.format(column, table)
+                )
+
+    schema = inherit_partition_rules(schema, catalog)
+    partitioned_tables = []
+    tables = []
+    domains = OrderedDict()
+    root_widened_columns = {}
+    for relation in catalog.values():
+        if relation.name not in schema:
+            raise MissingAnonymizationRuleError(
+                'No rules for table "{}" in the schema'.format(relation.name)
+            )
+        rules = schema[relation.name] or {}
+        if relation.parent and "truncate" in (schema.get(relation.parent) or {}):
+            logging.debug("Skipping {} truncated along with its parent".format(relation.name))
+            continue
+        column_values = []
+        python_columns = []
+        domain_columns = []
+        widened_columns = []
+        if "truncate" not in rules:
+            for column in relation.columns:
+                custom_rule = get_in(rules, ["custom_rules", column.name])
+                domain = (
+                    custom_rule.get("domain")
+                    if isinstance(custom_rule, dict) and "value" not in custom_rule
+                    else None
+                )
+                python_rule = get_python_rule(schema, relation.name, column.name)
+                if python_rule is not None:
+                    try:
+                        resolve_python_rule(python_rule)
+                    except (ImportError, AttributeError, ValueError):
+                        raise MissingAnonymizationRuleError(
+                            'Python rule "{}" cannot be imported'.format(python_rule)
+                        )
+                    python_columns.append((column.name, python_rule))
+                    value = None
+                else:
+                    value = get_column_anonymization(
+                        schema, relation.name, column.name, column.data_type
+                    )
+                    if value is None:
+                        continue
+                if (
+                    column.data_type == "character varying"
+                    and column.max_length is not None
+                    and column.max_length < ANONYMIZED_VARCHAR_LENGTH
+                ):
+                    if column.has_dependents:
+                        # Type of the column cannot be altered, cut the anonymized value instead
+                        if value is not None:
+                            value = "({})::varchar({})".format(value, column.max_length)
+                    else:
+                        widened_columns.append(column.name)
+                if domain is not None and value is not None:
+                    # Pseudonyms are joined from the mapping table by a separate UPDATE
+                    domain_columns.append((column.name, domain, value))
+                    if relation.kind != "p":
+                        domains.setdefault(domain, []).append((relation.name, column.name))
+                elif value is not None:
+                    column_values.append((column.name, value))
+            if python_columns and get_table_pk_name(schema, relation.name) is None:
+                raise InvalidAnonymizationSchemaError(
+                    'Python rules need a primary key to join the results on in "{}"'.format(
+                        relation.name
+                    )
+                )
+            if domain_columns and rules.get("where") and get_table_pk_name(schema, relation.name) is None:
+                raise InvalidAnonymizationSchemaError(
+                    'Domains with a `where` rule need a primary key to select the rows by in "{}"'.format(
+                        relation.name
+                    )
+                )
+        if relation.kind == "p":
+            # Partitioned tables hold no rows of their own, UPDATEs are run on the leaf partitions
+            column_values = []
+            python_columns = []
+            domain_columns = []
+        if relation.parent:
+            # Columns inherited by partitions can only be widened on the root, also for the rules of partitions
+            root = relation
+            while root.parent in catalog:
+                root = catalog[root.parent]
+            partition_widened_columns = root_widened_columns.setdefault(root.name, [])
+            partition_widened_columns.extend(
+                column for column in widened_columns if column not in partition_widened_columns
+            )
+            widened_columns = []
+        (partitioned_tables if relation.kind == "p" else tables).append(
+            TablePlan(
+                name=relation.name,
+                partitioned=relation.kind == "p",
+                truncate=rules.get("truncate"),
+                columns=relation.columns,
+                column_values=tuple(column_values),
+                python_columns=tuple(python_columns),
+                domain_columns=tuple(domain_columns),
+                widened_columns=tuple(widened_columns),
+                pk_name=get_table_pk_name(schema, relation.name),
+                where=rules.get("where"),
+                batch_size=rules.get("batch_size"),
+                watermark=rules.get("watermark"),
+                size=relation.size,
+            )
         )
-        cursor.execute("TRUNCATE {table} {cascade}".format(table=table, cascade=cascade))
-        return
+    partitioned_tables = [
+        table_plan._replace(
+            widened_columns=table_plan.widened_columns
+            + tuple(
+                column
+                for column in root_widened_columns.get(table_plan.name, [])
+                if column not in table_plan.widened_columns
+            )
+        )
+        for table_plan in partitioned_tables
+    ]
+    return AnonymizationPlan(
+        tables=tuple(partitioned_tables + tables),
+        domains=tuple((domain, tuple(columns)) for domain, columns in domains.items()),
+    )
+
 
-    # Generate list of column_update SQL snippets for UPDATE
+def get_batch_rows(cursor, table, batch_size):
+    """
+    Return the number of rows per batch. `batch_size` is either a number of rows
+    or a size with a unit understood by Postgres such as "64MB", which is converted
+    using the average size of a sample of the table's rows.
+    """
+    if str(batch_size).isdigit():
+        return int(batch_size)
     cursor.execute(
-        "SELECT column_name, data_type FROM information_schema.columns "
-        "WHERE table_schema = 'public' AND table_name = '{}'".format(table)
-    )
-    column_updates = []
-    updated_column_names = []
-    for column_name, data_type in cursor.fetchall():
-        if not disable_schema_changes:  # Bypass schema changes if explicitly requested
-            prepare_column_for_anonymization(conn, cursor, table, column_name, data_type)
-        column_update = get_column_update(schema, table, column_name, data_type)
-        if column_update is not None:
-            column_updates.append(column_update)
-            updated_column_names.append(column_name)
-
-    # Process UPDATE if any column_updates requested
-    if len(column_updates) > 0:
-        update_statement = "UPDATE {table} SET {column_updates_sql} {where_clause}".format(
-            table=table,
-            column_updates_sql=", ".join(column_updates),
-            where_clause="WHERE {}".format(
-                schema[table].get("where", "TRUE") if schema[table] else "TRUE"
+        "SELECT pg_size_bytes(%s) / greatest(avg(pg_column_size(sample.*)), 1)::bigint "
+        "FROM (SELECT * FROM {} LIMIT 1000) sample;".format(quote_table_name(table)),
+        (batch_size,),
+    )
+    return max(cursor.fetchone()[0] or 1, 1)
+
+
+def run_batched_update(
+    conn, cursor, table, pk_name, column_updates_sql, where, batch_size, journal=None
+):
+    """
+    Run the UPDATE in batches of consecutive primary key ranges, each committed separately,
+    so that no transaction grows with the size of the table and progress is kept on failure.
+    If a journal is given, the batches committed by a previous run are skipped.
+    Return the number of rows updated.
+    """
+    batch_rows = get_batch_rows(cursor, table, batch_size)
+    updated_rows = 0
+    # The statements below are parametrized, so literal percent signs in the rules must be escaped
+    where = (where or "TRUE").replace("%", "%%")
+    column_updates_sql = column_updates_sql.replace("%", "%%")
+    lower_bound = journal.get_batch_progress(table) if journal else None
+    while True:
+        cursor.execute(
+            "SELECT max({pk}) FROM (SELECT {pk} FROM {table} WHERE ({where}) {lower_bound}"
+            "ORDER BY {pk} LIMIT %(batch_rows)s) batch;".format(
+                pk=pk_name,
+                table=quote_table_name(table),
+                where=where,
+                lower_bound="AND {} > %(lower_bound)s ".format(pk_name)
+                if lower_bound is not None
+                else "",
             ),
+            {"lower_bound": lower_bound, "batch_rows": batch_rows},
         )
+        upper_bound = cursor.fetchone()[0]
+        if upper_bound is None:
+            break
         logging.debug(
-            "Running UPDATE on {} for columns {} ...".format(
-                table, ", ".join(updated_column_names)
+            "Running UPDATE on {} for {} in ({}, {}] ...".format(
+                table, pk_name, lower_bound, upper_bound
+            )
+        )
+        cursor.execute(
+            "UPDATE {table} SET {column_updates_sql} WHERE ({where}) {lower_bound}"
+            "AND {pk} <= %(upper_bound)s".format(
+                table=quote_table_name(table),
+                column_updates_sql=column_updates_sql,
+                where=where,
+                pk=pk_name,
+                lower_bound="AND {} > %(lower_bound)s ".format(pk_name)
+                if lower_bound is not None
+                else "",
+            ),
+            {"lower_bound": lower_bound, "upper_bound": upper_bound},
+        )
+        updated_rows += cursor.rowcount
+        conn.commit()
+        if journal:
+            journal.finish_batch(table, upper_bound)
+        lower_bound = upper_bound
+    return updated_rows
+
+
+def anonymize_table(
+    conn,
+    cursor,
+    table_plan,
+    disable_schema_changes,
+    engine=UPDATE_ENGINE,
+    batch_size=None,
+    journal=None,
+    metrics=None,
+):
+    metrics = metrics or Metrics()
+    table = table_plan.name
+    logging.debug('Processing "{}" table'.format(table))
+
+    # Bypass schema changes if explicitly requested
+    if not disable_schema_changes and table_plan.truncate is None:
+        with metrics.stage("widen"):
+            prepare_tables_for_anonymization(conn, cursor, [table_plan])
+
+    with metrics.table(cursor, table) as stats:
+        # Truncate and return if desired
+        if table_plan.truncate is not None:
+            logging.debug("Running {} ...".format(get_truncate_statement(table_plan)))
+            with metrics.stage("truncate"):
+                cursor.execute(get_truncate_statement(table_plan))
+            return
+
+        if not (
+            table_plan.column_values or table_plan.python_columns or table_plan.domain_columns
+        ):
+            logging.debug("Nothing to anonymize for {}".format(table))
+            return
+
+        if (
+            table_plan.column_values
+            and not (table_plan.python_columns or table_plan.domain_columns)
+            and get_change_condition(table_plan) is not None
+        ):
+            cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM {} WHERE {});".format(
+                    quote_table_name(table), get_update_where(table_plan)
+                )
+            )
+            if not cursor.fetchone()[0]:
+                logging.info("Skipping {} as all its rows are anonymized already".format(table))
+                stats["rows"] = 0
+                return
+
+        with metrics.stage("update"):
+            # The values for Python rules and the rows to pseudonymize are read before the SQL rules
+            # change the rows matched by `where`
+            python_results = None
+            matched_table = None
+            if table_plan.domain_columns and table_plan.where:
+                matched_table = select_matched_rows(cursor, table_plan)
+            if table_plan.python_columns:
+                logging.debug(
+                    "Running Python rules on {} for columns {} ...".format(
+                        table, ", ".join(column for column, _ in table_plan.python_columns)
+                    )
+                )
+                python_results = export_python_rule_values(
+                    cursor, table, table_plan.pk_name, table_plan.python_columns, table_plan.where
+                )
+            try:
+                stats["rows"] = anonymize_table_columns(
+                    conn, cursor, table_plan, engine, batch_size, journal
+                )
+                if table_plan.domain_columns:
+                    stats["rows"] = max(
+                        stats["rows"] or 0,
+                        pseudonymize_table_columns(cursor, table_plan, matched_table),
+                    )
+                if python_results:
+                    stats["rows"] = max(
+                        stats["rows"] or 0,
+                        import_python_rule_values(
+                            cursor,
+                            table,
+                            table_plan.pk_name,
+                            table_plan.python_columns,
+                            python_results,
+                        ),
+                    )
+            finally:
+                if python_results:
+                    os.remove(python_results)
+
+
+def anonymize_table_columns(conn, cursor, table_plan, engine, batch_size, journal):
+    """Apply the SQL rules of the table with the given engine and return the number of rows written."""
+    table = table_plan.name
+    column_values = dict(table_plan.column_values)
+    if len(column_values) == 0:
+        return None
+
+    where = table_plan.where
+    if engine == REWRITE_ENGINE:
+        blocker = get_rewrite_blocker(cursor, table)
+        if blocker is None:
+            logging.debug(
+                "Rewriting {} with anonymized columns {} ...".format(
+                    table, ", ".join(column_values)
+                )
+            )
+            return rewrite_table(cursor, table, column_values, where)
+        logging.debug("Falling back to UPDATE on {} as {}".format(table, blocker))
+
+    # Process UPDATE of the anonymized columns
+    if table_plan.batch_size is not None:
+        batch_size = table_plan.batch_size
+    if batch_size and table_plan.pk_name is not None:
+        return run_batched_update(
+            conn,
+            cursor,
+            table,
+            table_plan.pk_name,
+            get_column_updates_sql(table_plan),
+            get_update_where(table_plan),
+            batch_size,
+            journal,
+        )
+
+    logging.debug(
+        "Running UPDATE on {} for columns {} ...".format(table, ", ".join(column_values))
+    )
+    cursor.execute(get_update_statement(table_plan))
+    return cursor.rowcount
+
+
+def select_matched_rows(cursor, table_plan):
+    """Keep the primary keys of the rows matched by the `where` rule of the table in a temporary table and return its name."""
+    matched_table = get_temporary_table_name(table_plan.name, MATCHED_TABLE_SUFFIX)
+    cursor.execute(
+        "CREATE TEMPORARY TABLE {matched_table} AS SELECT {pk} FROM {table} WHERE {where}".format(
+            matched_table=matched_table,
+            pk=table_plan.pk_name,
+            table=quote_table_name(table_plan.name),
+            where=table_plan.where,
+        )
+    )
+    cursor.execute("ANALYZE {}".format(matched_table))
+    return matched_table
+
+
+def pseudonymize_table_columns(cursor, table_plan, matched_table=None):
+    """
+    Replace the values of the domain columns of the table by their pseudonyms, see `create_mapping_tables`,
+    and return the largest number of rows written by one of the UPDATEs. NULLs are kept.
+    The pseudonyms are written after the SQL rules, which may change the values the `where` rule reads,
+    so the rows it matches are given by `matched_table` selected beforehand by `select_matched_rows`.
+    """
+    where = None
+    if matched_table:
+        where = "{table}.{pk} IN (SELECT {pk} FROM {matched_table})".format(
+            table=quote_table_name(table_plan.name), pk=table_plan.pk_name, matched_table=matched_table
+        )
+    rows = 0
+    for statement in get_domain_update_statements(table_plan, where):
+        logging.debug("Running {} ...".format(statement))
+        cursor.execute(statement)
+        rows = max(rows, cursor.rowcount)
+    if matched_table:
+        cursor.execute("DROP TABLE {}".format(matched_table))
+    return rows
+
+
+def anonymize_table_from_pool(pool, table_plan, engine, batch_size, journal, metrics):
+    conn = pool.getconn()
+    try:
+        with conn:
+            with conn.cursor() as cursor:
+                # Schema changes were already made serially, see anonymize_db_in_parallel
+                anonymize_table(
+                    conn, cursor, table_plan, True, engine, batch_size, journal, metrics
+                )
+        if journal:
+            journal.finish_table(table_plan.name)
+    finally:
+        pool.putconn(conn)
+
+
+def anonymize_tables_from_pool(pool, table_plans, engine, batch_size, journal, metrics):
+    for table_plan in table_plans:
+        anonymize_table_from_pool(pool, table_plan, engine, batch_size, journal, metrics)
+
+
+def group_by_namespace(table_plans):
+    """Return the table plans grouped by their namespaces, ordered by the first table of each namespace."""
+    namespaces = OrderedDict()
+    for table_plan in table_plans:
+        namespaces.setdefault(split_table_name(table_plan.name)[0], []).append(table_plan)
+    return namespaces
+
+
+def merge_groups_by_foreign_keys(groups, foreign_keys):
+    """
+    Merge the groups of table plans whose tables are connected by foreign keys, so that they are anonymized
+    serially, one merged group per connection. Merged groups are named by the names of their groups.
+    """
+    group_of_table = {
+        table_plan.name: group for group, table_plans in groups.items() for table_plan in table_plans
+    }
+    merged_into = {group: group for group in groups}
+
+    def find(group):
+        while merged_into[group] != group:
+            group = merged_into[group]
+        return group
+
+    for table, referenced in foreign_keys:
+        if table in group_of_table and referenced in group_of_table:
+            merged_into[find(group_of_table[referenced])] = find(group_of_table[table])
+    merged = OrderedDict()
+    for group, table_plans in groups.items():
+        merged.setdefault(find(group), []).append((group, table_plans))
+    return OrderedDict(
+        (
+            ", ".join(group for group, _ in members),
+            [table_plan for _, table_plans in members for table_plan in table_plans],
+        )
+        for members in merged.values()
+    )
+
+
+def report_namespace_progress(namespace, finished, total):
+    logging.info("Anonymized schema {} ({} of {})".format(namespace, finished, total))
+
+
+def anonymize_db_in_parallel(
+    conn,
+    cursor,
+    plan,
+    db_args,
+    disable_schema_changes,
+    jobs,
+    engine=UPDATE_ENGINE,
+    batch_size=None,
+    journal=None,
+    metrics=None,
+):
+    """
+    Anonymize tables concurrently using a pool of `jobs` connections, starting with the largest tables.
+    TRUNCATEs and ALTERs take exclusive locks that may cascade to related tables via foreign keys,
+    so they are all run serially on the main connection before the UPDATEs are dispatched to the pool.
+    Tables of several namespaces are dispatched a namespace at a time and the progress is reported
+    whenever a namespace is finished. With the rewrite engine, tables (or namespaces) connected
+    by foreign keys are dispatched together, as swapping a table locks the tables related to it.
+    """
+    table_plans = sorted(
+        (
+            table_plan
+            for table_plan in plan.tables
+            if not (journal and journal.is_table_finished(table_plan.name))
+        ),
+        key=lambda table_plan: table_plan.size,
+        reverse=True,
+    )
+    metrics = metrics or Metrics()
+    for table_plan in table_plans:
+        if table_plan.truncate is not None:
+            anonymize_table(
+                conn, cursor, table_plan, disable_schema_changes, journal=journal, metrics=metrics
+            )
+            if journal:
+                conn.commit()
+                journal.finish_table(table_plan.name)
+    updated_plans = [table_plan for table_plan in table_plans if table_plan.truncate is None]
+    if not disable_schema_changes:
+        with metrics.stage("widen"):
+            prepare_tables_for_anonymization(conn, cursor, updated_plans)
+    conn.commit()
+
+    namespaces = group_by_namespace(updated_plans)
+    if len(namespaces) > 1:
+        groups = namespaces
+    else:
+        groups = OrderedDict((table_plan.name, [table_plan]) for table_plan in updated_plans)
+    if engine == REWRITE_ENGINE:
+        # Swapping a table re-adds the foreign keys of the related tables, which deadlocks with their swaps
+        groups = merge_groups_by_foreign_keys(groups, get_foreign_keys(cursor))
+    pool = ThreadedConnectionPool(jobs, jobs, **db_args)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = OrderedDict(
+                (
+                    executor.submit(
+                        anonymize_tables_from_pool,
+                        pool,
+                        group_plans,
+                        engine,
+                        batch_size,
+                        journal,
+                        metrics,
+                    ),
+                    group if len(namespaces) > 1 else None,
+                )
+                for group, group_plans in groups.items()
+            )
+            try:
+                for finished, future in enumerate(as_completed(futures), 1):
+                    future.result()
+                    if futures[future] is not None:
+                        report_namespace_progress(futures[future], finished, len(futures))
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        pool.closeall()
+
+
+def anonymize_db(
+    schema,
+    db_args,
+    disable_schema_changes,
+    jobs=1,
+    engine=UPDATE_ENGINE,
+    batch_size=None,
+    journal=None,
+    metrics=None,
+):
+    metrics = metrics or Metrics()
+    with psycopg2.connect(**db_args) as conn:
+        with conn.cursor() as cursor:
+            with metrics.stage("check"):
+                plan = check_schema(cursor, schema, db_args)
+            if plan.domains:
+                # All values of a domain must be collected before any of its tables is anonymized
+                with metrics.stage("mapping"):
+                    create_mapping_tables(cursor, plan.domains)
+                    conn.commit()
+            if jobs > 1:
+                anonymize_db_in_parallel(
+                    conn,
+                    cursor,
+                    plan,
+                    db_args,
+                    disable_schema_changes,
+                    jobs,
+                    engine,
+                    batch_size,
+                    journal,
+                    metrics,
+                )
+            else:
+                if not disable_schema_changes:
+                    with metrics.stage("widen"):
+                        prepare_tables_for_anonymization(
+                            conn,
+                            cursor,
+                            [
+                                table_plan
+                                for table_plan in plan.tables
+                                if table_plan.truncate is None
+                                and not (journal and journal.is_table_finished(table_plan.name))
+                            ],
+                        )
+                namespaces = group_by_namespace(plan.tables)
+                for finished, (namespace, table_plans) in enumerate(namespaces.items(), 1):
+                    for table_plan in table_plans:
+                        if journal and journal.is_table_finished(table_plan.name):
+                            logging.debug(
+                                "Skipping {} anonymized by previous run".format(table_plan.name)
+                            )
+                            continue
+                        # The columns of all tables were already widened above
+                        anonymize_table(
+                            conn,
+                            cursor,
+                            table_plan,
+                            True,
+                            engine,
+                            batch_size,
+                            journal,
+                            metrics,
+                        )
+                        if journal:
+                            conn.commit()
+                            journal.finish_table(table_plan.name)
+                    if len(namespaces) > 1:
+                        report_namespace_progress(namespace, finished, len(namespaces))
+            if plan.domains:
+                with metrics.stage("drop"):
+                    drop_mapping_tables(cursor)
+            logging.debug("Anonymization complete!")
+
+
+def get_plan_emptied_tables(source_cursor, plan):
+    """
+    Return the names of the tables whose data is dropped by the plan: the truncated tables and all tables
+    referencing the tables truncated with cascade. Without FKs in the target, the latter must be found in the source.
+    """
+    return {table_plan.name for table_plan in plan.tables if table_plan.truncate} | set(
+        get_referencing_tables(
+            source_cursor,
+            [table_plan.name for table_plan in plan.tables if table_plan.truncate == "cascade"],
+        )
+    )
+
+
+def check_in_flight_plan(plan):
+    for table_plan in plan.tables:
+        if table_plan.python_columns:
+            raise InvalidAnonymizationSchemaError(
+                "Python rules of {} cannot be applied in flight".format(table_plan.name)
+            )
+    if plan.domains:
+        raise InvalidAnonymizationSchemaError("Domains cannot be pseudonymized in flight")
+
+
+def anonymize_db_in_flight(
+    schema,
+    source_db_args,
+    db_args,
+    disable_schema_changes,
+    journal=None,
+    metrics=None,
+    record_watermarks=False,
+):
+    """
+    Copy the data of all tables from the source DB into the restored definitions in the target DB,
+    applying the anonymization on the way, see `transfer_table`. All tables are read in one snapshot.
+    With `record_watermarks`, the watermarks of the copied data are stored for `anonymize_db_incrementally`.
+    """
+    metrics = metrics or Metrics()
+    with psycopg2.connect(**(source_db_args or get_source_db_args_from_env())) as source_conn:
+        source_conn.set_session(
+            isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True
+        )
+        with psycopg2.connect(**db_args) as conn:
+            with conn.cursor() as cursor:
+                with metrics.stage("check"):
+                    plan = check_schema(cursor, schema, db_args)
+                check_in_flight_plan(plan)
+                if record_watermarks:
+                    create_watermark_table(cursor)
+                with source_conn.cursor() as source_cursor:
+                    skipped_tables = get_plan_emptied_tables(source_cursor, plan)
+                table_plans = []
+                for table_plan in plan.tables:
+                    if table_plan.name in skipped_tables:
+                        logging.debug("Skipping data of truncated {}".format(table_plan.name))
+                    elif journal and journal.is_table_finished(table_plan.name):
+                        logging.debug(
+                            "Skipping {} anonymized by previous run".format(table_plan.name)
+                        )
+                    else:
+                        table_plans.append(table_plan)
+                if not disable_schema_changes:
+                    with metrics.stage("widen"):
+                        prepare_tables_for_anonymization(conn, cursor, table_plans)
+                for table_plan in table_plans:
+                    if table_plan.partitioned:
+                        # The rows are copied into the leaf partitions
+                        continue
+                    with metrics.table(cursor, table_plan.name) as stats, metrics.stage("copy"):
+                        stats["rows"] = transfer_table(
+                            source_conn,
+                            conn,
+                            table_plan.name,
+                            dict(table_plan.column_values),
+                            table_plan.where,
+                        )
+                    if record_watermarks:
+                        # The primary keys are restored in the target DB only after the data
+                        with source_conn.cursor() as source_cursor:
+                            watermark_column = get_watermark_column(
+                                source_cursor, table_plan.name, table_plan.watermark
+                            )
+                        if watermark_column:
+                            record_watermark(source_conn, conn, table_plan.name, watermark_column)
+                    conn.commit()
+                    if journal:
+                        journal.finish_table(table_plan.name)
+            logging.debug("Anonymization complete!")
+
+
+def sort_by_foreign_keys(table_plans, foreign_keys):
+    """Order the tables so that referenced tables precede the tables referencing them, as far as cycles allow."""
+    remaining = list(table_plans)
+    sorted_plans = []
+    while remaining:
+        pending = {table_plan.name for table_plan in remaining}
+        ready = [
+            table_plan
+            for table_plan in remaining
+            if not any(
+                table == table_plan.name and referenced in pending
+                for table, referenced in foreign_keys
             )
+        ]
+        # Break a cycle of foreign keys by taking the tables in their original order
+        ready = ready or remaining[:1]
+        sorted_plans.extend(ready)
+        remaining = [table_plan for table_plan in remaining if table_plan not in ready]
+    return sorted_plans
+
+
+def anonymize_db_incrementally(schema, source_db_args, db_args, metrics=None):
+    """
+    Bring the anonymized copy made by a previous run up to date with the source DB by copying only
+    the rows changed since the watermark of each table and deleting the rows removed from the source,
+    see `copy_changed_rows` and `delete_removed_rows`. All tables are read in one snapshot; referenced tables
+    are upserted first and cleaned up last, so that the foreign keys hold after each committed table.
+    """
+    metrics = metrics or Metrics()
+    with psycopg2.connect(**(source_db_args or get_source_db_args_from_env())) as source_conn:
+        source_conn.set_session(
+            isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True
         )
-        cursor.execute(update_statement)
+        with psycopg2.connect(**db_args) as conn:
+            with conn.cursor() as cursor:
+                with metrics.stage("check"):
+                    plan = check_schema(cursor, schema, db_args)
+                check_in_flight_plan(plan)
+                with source_conn.cursor() as source_cursor:
+                    skipped_tables = get_plan_emptied_tables(source_cursor, plan)
+                # Truncated tables stay empty and partitioned tables are synced through their partitions
+                table_plans = sort_by_foreign_keys(
+                    [
+                        table_plan
+                        for table_plan in plan.tables
+                        if table_plan.name not in skipped_tables and not table_plan.partitioned
+                    ],
+                    get_foreign_keys(cursor),
+                )
+                for table_plan in table_plans:
+                    with metrics.table(cursor, table_plan.name) as stats, metrics.stage("copy"):
+                        stats["rows"] = copy_changed_rows(
+                            source_conn,
+                            conn,
+                            table_plan.name,
+                            dict(table_plan.column_values),
+                            table_plan.where,
+                            table_plan.watermark,
+                        )
+                    conn.commit()
+                for table_plan in reversed(table_plans):
+                    with metrics.stage("delete"):
+                        logging.debug(
+                            "Deleted {} rows removed from {}".format(
+                                delete_removed_rows(source_conn, conn, table_plan.name),
+                                table_plan.name,
+                            )
+                        )
+                    conn.commit()
+            logging.debug("Incremental anonymization complete!")
+
+
+def format_size(size):
+    for unit in ("bytes", "kB", "MB", "GB"):
+        if abs(size) < 1024:
+            break
+        size /= 1024
     else:
-        logging.debug("Nothing to anonymize for {}".format(table))
+        unit = "TB"
+    return "{:.0f} {}".format(size, unit) if unit == "bytes" else "{:.1f} {}".format(size, unit)
+
+
+def load_benchmark_throughput(baseline_path):
+    """
+    Return the bytes anonymized per second and the bytes of WAL generated per anonymized byte
+    measured by the benchmark and stored in its baseline, see benchmarks/benchmark.py.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    return (
+        baseline["anonymize_bytes"] / baseline["anonymize"],
+        baseline["anonymize_wal_bytes"] / baseline["anonymize_bytes"],
+    )
 
 
-def anonymize_db(schema, db_args, disable_schema_changes):
+def get_table_statements(table_plan, disable_schema_changes=False):
+    """Return the SQL statements run by `anonymize_table` with the default update engine."""
+    if table_plan.truncate is not None:
+        return [get_truncate_statement(table_plan)]
+    statements = []
+    if table_plan.widened_columns and not disable_schema_changes:
+        statements.append(get_widen_statement(table_plan))
+    if get_update_statement(table_plan):
+        statements.append(get_update_statement(table_plan))
+    return statements + get_domain_update_statements(table_plan)
+
+
+def plan_db(schema, db_args, disable_schema_changes=False, baseline_path=None, source=False):
+    """
+    Print the statements that would anonymize the DB along with the estimated number of rows and the size
+    of each table and the cost of its UPDATE according to EXPLAIN. Given the baseline of the benchmark,
+    the wall time and the WAL volume of the UPDATEs are projected from the throughput it measured.
+    With `source`, the DB is the source DB, whose tables missing from the schema are left out
+    as they would not be dumped. The DB is accessed in a read-only session and nothing is modified.
+    """
+    throughput = load_benchmark_throughput(baseline_path) if baseline_path else None
     with psycopg2.connect(**db_args) as conn:
+        conn.set_session(readonly=True)
         with conn.cursor() as cursor:
-            check_schema(cursor, schema, db_args)
+            schema, catalog = load_schema_catalog(cursor, schema)
+            if source:
+                catalog = OrderedDict(
+                    (table, relation) for table, relation in catalog.items() if table in schema
+                )
+            plan = compile_plan(schema, catalog)
             cursor.execute(
-                "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' AND table_type <> 'VIEW' ORDER BY table_name;"
+                "SELECT t.name, c.reltuples::bigint, pg_total_relation_size(c.oid) "
+                "FROM unnest(%s::text[], %s::text[]) t(name, identifier) "
+                "JOIN pg_class c ON c.oid = t.identifier::regclass;",
+                (
+                    [table_plan.name for table_plan in plan.tables],
+                    [quote_table_name(table_plan.name) for table_plan in plan.tables],
+                ),
             )
-            for table_name in cursor.fetchall():
-                anonymize_table(conn, cursor, schema, table_name[0], disable_schema_changes)
-            logging.debug("Anonymization complete!")
+            table_stats = {table: (rows, size) for table, rows, size in cursor.fetchall()}
+            for domain, columns in plan.domains:
+                print(
+                    "-- Mapping table for domain {} of {}".format(
+                        domain, ", ".join("{}.{}".format(*column) for column in columns)
+                    )
+                )
+            total_seconds = total_wal_bytes = 0
+            for table_plan in plan.tables:
+                rows, size = table_stats[table_plan.name]
+                summary = [
+                    "{} rows".format(rows if rows >= 0 else "unknown number of"),
+                    format_size(size),
+                ]
+                update_statement = get_update_statement(table_plan)
+                if table_plan.truncate is None and update_statement:
+                    try:
+                        cursor.execute("EXPLAIN (FORMAT JSON) {}".format(update_statement))
+                        explained = cursor.fetchone()[0][0]["Plan"]
+                        updated_rows = explained["Plans"][0]["Plan Rows"]
+                        summary.append(
+                            "UPDATE cost {:.2f} for {} rows".format(
+                                explained["Total Cost"], updated_rows
+                            )
+                        )
+                    except psycopg2.Error as e:
+                        # e.g. a rule refers to a function created only by the anonymization
+                        conn.rollback()
+                        updated_rows = rows
+                        summary.append("UPDATE cannot be explained: {}".format(str(e).strip()))
+                    if throughput:
+                        bytes_per_second, wal_ratio = throughput
+                        updated_size = size * min(updated_rows / rows, 1) if rows > 0 else size
+                        seconds = updated_size / bytes_per_second
+                        wal_bytes = updated_size * wal_ratio
+                        total_seconds += seconds
+                        total_wal_bytes += wal_bytes
+                        summary.append(
+                            "projected {:.1f} s and {} of WAL".format(seconds, format_size(wal_bytes))
+                        )
+                if table_plan.python_columns:
+                    summary.append(
+                        "Python rules for {}".format(
+                            ", ".join(column for column, _ in table_plan.python_columns)
+                        )
+                    )
+                print("\n-- {}: {}".format(table_plan.name, ", ".join(summary)))
+                for statement in get_table_statements(table_plan, disable_schema_changes):
+                    print("{};".format(statement))
+            if throughput:
+                print(
+                    "\n-- Projected total: {:.1f} s and {} of WAL, "
+                    "tables anonymized in parallel with --jobs finish sooner".format(
+                        total_seconds, format_size(total_wal_bytes)
+                    )
+                )
+
+
+def is_incrementally_updatable(db_args):
+    with psycopg2.connect(**db_args) as conn:
+        with conn.cursor() as cursor:
+            return has_watermark_table(cursor)
 
 
 def load_anonymize_remove(
@@ -280,25 +1643,173 @@ def load_anonymize_remove(
     disable_schema_changes=False,
     leave_dump=False,
     db_args=None,
+    jobs=1,
+    engine=UPDATE_ENGINE,
+    defer_post_data=False,
+    batch_size=None,
+    journal_path=None,
+    resume=False,
+    restore_jobs=DEFAULT_RESTORE_JOBS,
+    stream=False,
+    source_db_args=None,
+    in_flight=False,
+    metrics_path=None,
+    prometheus_path=None,
+    incremental=False,
+    template=None,
+    ephemeral=False,
+    logged=False,
 ):
+    """
+    Restore the dump into the DB given by `db_args`, anonymize it and delete the dump.
+    With `stream`, the tables are piped directly from the DB given by `source_db_args`
+    (or the DB_DEFAULT_* environment variables) instead and no dump file is used.
+    With `in_flight`, only the table definitions are streamed and the data is copied table by table
+    with the anonymization already applied, so that the raw data never reaches the target DB.
+    With `incremental`, a DB previously copied in flight with `incremental` is updated by copying only
+    the changed rows, see `anonymize_db_incrementally`; otherwise the DB is copied in flight.
+    With `template`, a frozen copy of the anonymized DB is published as a template database, see `publish_template`.
+    With `ephemeral`, the DB is restored and anonymized without durability: the tables are UNLOGGED until
+    the post-data is restored (and stay so unless `logged`) and `EPHEMERAL_SETTINGS` are used.
+    Timings of the stages and statistics of the tables are written to `metrics_path` as JSON
+    and to `prometheus_path` as a Prometheus textfile, also when the run fails.
+    """
+    metrics = Metrics(enabled=bool(metrics_path or prometheus_path))
+    in_flight = in_flight or incremental
+    stream = stream or in_flight
+    # Foreign keys restored with the post-data would prevent switching the tables back to LOGGED
+    defer_post_data = defer_post_data or ephemeral
     schema = yaml.load(open(schema), Loader=yaml.FullLoader)
+    if stream and has_subset(schema):
+        raise PgantomizerError("Subsets can only be restored from a dump made by pgantomizer_dump")
     db_args = db_args or get_db_args_from_env()
-
-    if skip_restore:
-        logging.debug("Skipping restore process and using existing schema")
-        anonymize_db(schema, db_args, disable_schema_changes)
-    else:
-        try:
-            load_db_to_new_instance(dump_file, db_args)
-            anonymize_db(schema, db_args, disable_schema_changes)
-        except (
-            Exception
-        ):  # Any exception must result into dropping the schema to prevent sensitive data leakage
-            drop_schema(db_args)
-            raise
-        finally:
-            if not leave_dump:
-                subprocess.run(["rm", dump_file])
+    if ephemeral:
+        db_args = {**db_args, "options": get_session_options(EPHEMERAL_SETTINGS)}
+        report_session_settings(db_args, metrics)
+    journal = Journal(journal_path, resume) if journal_path else None
+    if journal:
+        if journal.get_dump_file() not in (None, dump_file):
+            raise PgantomizerError(
+                "Journal {} belongs to a run with dump file {}".format(
+                    journal_path, journal.get_dump_file()
+                )
+            )
+        journal.set_dump_file(dump_file)
+
+    try:
+        if incremental and is_incrementally_updatable(db_args):
+            # The raw data never reaches the target DB in flight, so the copy is kept on failure
+            logging.debug("Updating the anonymized DB incrementally")
+            anonymize_db_incrementally(schema, source_db_args, db_args, metrics)
+        elif skip_restore:
+            logging.debug("Skipping restore process and using existing schema")
+            anonymize_db(
+                schema,
+                db_args,
+                disable_schema_changes,
+                jobs,
+                engine,
+                batch_size,
+                journal,
+                metrics,
+            )
+        else:
+            finished = False
+            try:
+                if journal and journal.is_stage_finished(RESTORE_STAGE):
+                    logging.debug("Skipping restore finished by previous run")
+                else:
+                    # With deferred post-data, anonymize the bare tables so that no index has to be
+                    # maintained for the rewritten rows
+                    sections = PRE_DATA_SECTIONS if defer_post_data or in_flight else None
+                    if stream:
+                        # Only the sequences are restored from the data section when copying in flight
+                        stream_db_to_new_instance(
+                            schema,
+                            source_db_args,
+                            db_args,
+                            sections,
+                            not in_flight,
+                            metrics,
+                            ephemeral,
+                        )
+                    else:
+                        load_db_to_new_instance(
+                            dump_file,
+                            db_args,
+                            sections,
+                            get_dump_emptied_tables(dump_file, schema),
+                            restore_jobs,
+                            metrics,
+                            ephemeral,
+                        )
+                    if journal:
+                        journal.finish_stage(RESTORE_STAGE)
+                if not (journal and journal.is_stage_finished(ANONYMIZE_STAGE)):
+                    if in_flight:
+                        anonymize_db_in_flight(
+                            schema,
+                            source_db_args,
+                            db_args,
+                            disable_schema_changes,
+                            journal,
+                            metrics,
+                            record_watermarks=incremental,
+                        )
+                    else:
+                        anonymize_db(
+                            schema,
+                            db_args,
+                            disable_schema_changes,
+                            jobs,
+                            engine,
+                            batch_size,
+                            journal,
+                            metrics,
+                        )
+                    if journal:
+                        journal.finish_stage(ANONYMIZE_STAGE)
+                if ephemeral and logged:
+                    with metrics.stage("logged"):
+                        set_tables_persistence(db_args, logged=True)
+                if defer_post_data or in_flight:
+                    logging.debug("Restoring indexes, constraints and triggers")
+                    with metrics.stage("post-data"):
+                        if stream:
+                            stream_db(schema, source_db_args, db_args, POST_DATA_SECTIONS)
+                        else:
+                            # A constraint violated by the anonymized data must not go missing silently
+                            restore_db(
+                                dump_file, db_args, POST_DATA_SECTIONS, jobs=restore_jobs, check=True
+                            )
+                finished = True
+            except (
+                Exception
+            ):  # Any exception must result into dropping the schema to prevent sensitive data leakage
+                if journal:
+                    logging.warning(
+                        "Keeping partially anonymized data for a resumed run, see {}".format(
+                            journal_path
+                        )
+                    )
+                else:
+                    with metrics.stage("drop"):
+                        drop_schema(db_args, get_schema_namespaces(db_args, schema))
+                raise
+            finally:
+                # The dump is needed to resume the run
+                if not (leave_dump or stream) and (finished or journal is None):
+                    subprocess.run(["rm", "-r", dump_file])
+        if template:
+            with metrics.stage("publish"):
+                publish_template(db_args, template)
+    finally:
+        if metrics_path:
+            metrics.write_json(metrics_path)
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
+    if journal:
+        journal.remove()
 
 
 def main():
@@ -327,6 +1838,112 @@ def main():
         action="store_true",
         help="do not delete dump file after anonymization",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of tables to anonymize concurrently, each using its own DB connection",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=ENGINES,
+        default=UPDATE_ENGINE,
+        help="anonymize tables by an in-place UPDATE or by rewriting them into an anonymized copy",
+    )
+    parser.add_argument(
+        "-p",
+        "--defer-post-data",
+        action="store_true",
+        help="restore indexes, constraints and triggers only after the data is anonymized",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        help="update tables in separately committed batches of primary key ranges "
+        "with the given number of rows or size such as 64MB",
+    )
+    parser.add_argument(
+        "--journal",
+        help="file recording finished stages and tables so that a failed run can be resumed; "
+        "beware that the partially anonymized data is kept in the DB on failure",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the run recorded in the journal instead of starting over",
+    )
+    parser.add_argument(
+        "--restore-jobs",
+        type=int,
+        default=DEFAULT_RESTORE_JOBS,
+        help="number of parallel jobs used by pg_restore",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="pipe the tables directly from the source DB instead of restoring a dump file",
+    )
+    parser.add_argument(
+        "--in-flight",
+        action="store_true",
+        help="like --stream, but copy the data with the anonymization already applied by the source DB, "
+        "so that the raw data never reaches the anonymized DB",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="like --in-flight, but update a DB copied by a previous --incremental run "
+        "with only the rows changed since then",
+    )
+    parser.add_argument(
+        "--publish-template",
+        help="publish a vacuumed and frozen copy of the anonymized DB as a template database of this name "
+        "to be cloned by pgantomizer_clone",
+    )
+    parser.add_argument(
+        "--ephemeral",
+        action="store_true",
+        help="restore and anonymize into UNLOGGED tables with synchronous_commit off and larger work memory, "
+        "the anonymized tables are emptied if the DB server crashes; implies --defer-post-data",
+    )
+    parser.add_argument(
+        "--logged",
+        action="store_true",
+        help="with --ephemeral, switch the tables back to LOGGED once they are anonymized",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="only print the statements that would be run with size and cost estimates of the tables "
+        "in the source DB if given, otherwise in the anonymized DB, without modifying anything",
+    )
+    parser.add_argument(
+        "--benchmark-baseline",
+        help="baseline stored by the benchmark, used by --plan to project wall time and WAL volume",
+    )
+    parser.add_argument(
+        "--metrics-file", help="write timings of the stages and statistics of the tables to a JSON file"
+    )
+    parser.add_argument(
+        "--prometheus-file",
+        help="write the metrics to a file for the textfile collector of the Prometheus node exporter",
+    )
+    parser.add_argument(
+        "--source-dbname",
+        help="name of the source database to stream from, DB_DEFAULT_* variables are used if omitted",
+    )
+    parser.add_argument("--source-user", help="name of the Postgres user of the source database")
+    parser.add_argument(
+        "--source-password", help="password of the Postgres user of the source database", default=""
+    )
+    parser.add_argument(
+        "--source-host", help="host where the source DB is running", default="localhost"
+    )
+    parser.add_argument(
+        "--source-port", help="port where the source DB is running", default="5432"
+    )
     parser.add_argument(
         "--schema",
         help="YAML config file with anonymization rules for all tables",
@@ -336,7 +1953,7 @@ def main():
     parser.add_argument(
         "-f",
         "--dump-file",
-        help="path to the dump of DB to load and anonymize",
+        help="path to the dump of DB to load and anonymize, either a file or a directory",
         default="to_anonymize.sql",
     )
     parser.add_argument("--dbname", help="name of the database to dump")
@@ -358,8 +1975,15 @@ def main():
     else:
         logging.basicConfig(format="%(levelname)s: %(message)s")
 
-    print(args)
-    if not args.skip_restore and not os.path.isfile(args.dump_file):
+    logging.debug(args)
+    if args.resume and not args.journal:
+        sys.exit("Resuming requires the --journal of the previous run.")
+    if args.logged and not args.ephemeral:
+        sys.exit("Only tables of an --ephemeral run can be switched back to LOGGED.")
+
+    if not (
+        args.skip_restore or args.stream or args.in_flight or args.incremental or args.plan
+    ) and not os.path.exists(args.dump_file):
         sys.exit('File with dump "{}" does not exist.'.format(args.dump_file))
 
     if not os.path.isfile(args.schema):
@@ -376,6 +2000,33 @@ def main():
         if args.dbname and args.user
         else None
     )
+    source_db_args = (
+        {
+            name: value
+            for name, value in zip(
+                DB_ARG_NAMES,
+                (
+                    args.source_dbname,
+                    args.source_user,
+                    args.source_password,
+                    args.source_host,
+                    args.source_port,
+                ),
+            )
+        }
+        if args.source_dbname and args.source_user
+        else None
+    )
+
+    if args.plan:
+        plan_db(
+            yaml.load(open(args.schema), Loader=yaml.FullLoader),
+            source_db_args or db_args or get_db_args_from_env(),
+            args.disable_schema_changes,
+            args.benchmark_baseline,
+            source=source_db_args is not None,
+        )
+        return
 
     load_anonymize_remove(
         args.dump_file,
@@ -384,6 +2035,22 @@ def main():
         args.disable_schema_changes,
         args.leave_dump,
         db_args,
+        args.jobs,
+        args.engine,
+        args.defer_post_data,
+        args.batch_size,
+        args.journal,
+        args.resume,
+        args.restore_jobs,
+        args.stream,
+        source_db_args,
+        args.in_flight,
+        args.metrics_file,
+        args.prometheus_file,
+        args.incremental,
+        args.publish_template,
+        args.ephemeral,
+        args.logged,
     )
 
 
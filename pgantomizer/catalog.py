@@ -0,0 +1,190 @@
+from collections import OrderedDict, namedtuple
+from fnmatch import fnmatchcase
+
+from .utils import expand_schema, get_namespace_patterns, get_truncated_tables, quote_table_name
+
+
+Column = namedtuple("Column", ["name", "data_type", "max_length", "has_dependents", "comparable"])
+Relation = namedtuple("Relation", ["name", "kind", "columns", "pk_columns", "size", "parent"])
+
+
+def get_qualified_name_sql(namespace, relation):
+    """Return the SQL expression of the name of the relation as built by `qualify_table_name`."""
+    return "CASE WHEN {namespace}.nspname = 'public' THEN {relation}.relname ELSE {namespace}.nspname || '.' || {relation}.relname END".format(
+        namespace=namespace, relation=relation
+    )
+
+
+# Data types are reported the same way as `information_schema.columns.data_type` which the anonymization rules
+# are keyed by, but the catalog is queried directly as the information_schema views are slow on large catalogs.
+# Columns are comparable if their built-in type has the equality of a default btree operator class,
+# directly or through a binary coercion such as varchar to text. Other types lack `=` (json, polygon)
+# or define it loosely (box and circle compare their areas).
+CATALOG_QUERY = """
+WITH relations AS (
+    SELECT c.oid, {name} AS relname, c.relkind, pg_relation_size(c.oid) AS size, {parent} AS parent
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_inherits inh ON c.relispartition AND inh.inhrelid = c.oid
+    LEFT JOIN pg_class p ON p.oid = inh.inhparent
+    LEFT JOIN pg_namespace pn ON pn.oid = p.relnamespace
+    WHERE n.nspname = ANY(%s) AND c.relkind IN ('r', 'p', 'f')
+)
+SELECT
+    r.relname,
+    r.relkind,
+    r.size,
+    r.parent,
+    a.attname,
+    CASE WHEN t.typtype = 'd' THEN
+        CASE WHEN bt.typelem <> 0 AND bt.typlen = -1 THEN 'ARRAY'
+             WHEN bt.typnamespace = 'pg_catalog'::regnamespace THEN format_type(t.typbasetype, NULL)
+             ELSE 'USER-DEFINED' END
+    ELSE
+        CASE WHEN t.typelem <> 0 AND t.typlen = -1 THEN 'ARRAY'
+             WHEN t.typnamespace = 'pg_catalog'::regnamespace THEN format_type(a.atttypid, NULL)
+             ELSE 'USER-DEFINED' END
+    END,
+    CASE WHEN t.typtype = 'd' THEN
+        CASE WHEN t.typbasetype IN ('varchar'::regtype, 'bpchar'::regtype) AND t.typtypmod > 0
+             THEN t.typtypmod - 4 END
+    ELSE
+        CASE WHEN a.atttypid IN ('varchar'::regtype, 'bpchar'::regtype) AND a.atttypmod > 0
+             THEN a.atttypmod - 4 END
+    END,
+    coalesce(a.attnum = ANY(i.indkey), FALSE),
+    EXISTS (
+        SELECT 1 FROM pg_depend d
+        WHERE d.refclassid = 'pg_class'::regclass AND d.refobjid = r.oid AND d.refobjsubid = a.attnum
+        AND (d.classid IN ('pg_rewrite'::regclass, 'pg_policy'::regclass)
+             OR (d.classid = 'pg_class'::regclass AND d.objid = r.oid AND d.objsubid <> 0))
+    ),
+    coalesce(ct.typnamespace = 'pg_catalog'::regnamespace AND NOT (ct.typelem <> 0 AND ct.typlen = -1) AND EXISTS (
+        SELECT 1 FROM pg_opclass oc JOIN pg_am am ON am.oid = oc.opcmethod
+        WHERE am.amname = 'btree' AND oc.opcdefault AND (oc.opcintype = ct.oid OR EXISTS (
+            SELECT 1 FROM pg_cast WHERE castsource = ct.oid AND casttarget = oc.opcintype AND castmethod = 'b'
+        ))
+    ), FALSE)
+FROM relations r
+LEFT JOIN pg_attribute a ON a.attrelid = r.oid AND a.attnum > 0 AND NOT a.attisdropped
+LEFT JOIN pg_type t ON t.oid = a.atttypid
+LEFT JOIN pg_type bt ON bt.oid = t.typbasetype
+LEFT JOIN pg_type ct ON ct.oid = CASE WHEN t.typtype = 'd' THEN t.typbasetype ELSE t.oid END
+LEFT JOIN pg_index i ON i.indrelid = r.oid AND i.indisprimary
+ORDER BY r.relname, a.attnum;
+""".format(
+    name=get_qualified_name_sql("n", "c"), parent=get_qualified_name_sql("pn", "p")
+)
+
+
+def get_namespaces(cursor, patterns, excluded=()):
+    """Return the names of the namespaces matching any of the glob patterns, e.g. `tenant_*`."""
+    cursor.execute(
+        "SELECT nspname FROM pg_namespace WHERE nspname !~ '^pg_' AND nspname <> 'information_schema' "
+        "ORDER BY nspname;"
+    )
+    return [
+        namespace
+        for (namespace,) in cursor.fetchall()
+        if namespace not in excluded and any(fnmatchcase(namespace, pattern) for pattern in patterns)
+    ]
+
+
+def load_catalog(cursor, namespaces=("public",)):
+    """
+    Load all tables of the namespaces with their columns, primary keys, sizes and partitioned parents
+    in a single query. Tables outside public are named by their schema-qualified names.
+    Columns are flagged as having dependents if views, policies or generated columns refer to them,
+    which prevents changing their type. Return an ordered mapping of table names to `Relation`s.
+    """
+    cursor.execute(CATALOG_QUERY, (list(namespaces),))
+    rows = OrderedDict()
+    for row in cursor.fetchall():
+        table, kind, size, parent, column, data_type, max_length, is_pk, has_dependents, comparable = row
+        relation = rows.setdefault(table, (kind, size, parent, [], []))
+        if column is not None:
+            relation[3].append(Column(column, data_type, max_length, has_dependents, comparable))
+            if is_pk:
+                relation[4].append(column)
+    return OrderedDict(
+        (table, Relation(table, kind, tuple(columns), tuple(pk_columns), size, parent))
+        for table, (kind, size, parent, columns, pk_columns) in rows.items()
+    )
+
+
+def get_referencing_tables(cursor, tables):
+    """Return names of all tables that reference any of the given tables through a chain of foreign keys."""
+    cursor.execute(
+        "WITH RECURSIVE referencing(oid) AS ("
+        "SELECT unnest(%s::regclass[])::oid "
+        "UNION SELECT con.conrelid FROM pg_constraint con JOIN referencing r ON con.confrelid = r.oid "
+        "WHERE con.contype = 'f') "
+        "SELECT {} FROM referencing r JOIN pg_class c ON c.oid = r.oid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace;".format(get_qualified_name_sql("n", "c")),
+        ([quote_table_name(table) for table in tables],),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_emptied_tables(cursor, schema):
+    """
+    Return names of the tables of the DB whose data the truncate rules of the schema drop: the truncated tables
+    and all tables referencing the tables truncated with `cascade`, which TRUNCATE CASCADE empties as well.
+    """
+    rules = expand_schema(schema, get_namespaces(cursor, get_namespace_patterns(schema)))
+    cursor.execute(
+        "SELECT {} FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE {} = ANY(%s);".format(get_qualified_name_sql("n", "c"), get_qualified_name_sql("n", "c")),
+        (get_truncated_tables(rules),),
+    )
+    truncated = [row[0] for row in cursor.fetchall()]
+    cascaded = get_referencing_tables(
+        cursor, [table for table in truncated if rules[table]["truncate"] == "cascade"]
+    )
+    return sorted(set(truncated) | set(cascaded))
+
+
+def get_primary_key_columns(cursor, table):
+    """Return the quoted names of the columns of the table's primary key constraint in their order."""
+    cursor.execute(
+        "SELECT quote_ident(a.attname) FROM pg_index i "
+        "JOIN LATERAL unnest(i.indkey) WITH ORDINALITY k(attnum, position) ON TRUE "
+        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum "
+        "WHERE i.indrelid = %s::regclass AND i.indisprimary ORDER BY k.position;",
+        (quote_table_name(table),),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_foreign_keys(cursor):
+    """Return pairs of names of referencing and referenced tables of all foreign keys."""
+    cursor.execute(
+        "SELECT DISTINCT {}, {} FROM pg_constraint con "
+        "JOIN pg_class c ON c.oid = con.conrelid JOIN pg_class r ON r.oid = con.confrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace JOIN pg_namespace rn ON rn.oid = r.relnamespace "
+        "WHERE con.contype = 'f' AND con.conrelid <> con.confrelid;".format(
+            get_qualified_name_sql("n", "c"), get_qualified_name_sql("rn", "r")
+        )
+    )
+    return cursor.fetchall()
+
+
+def get_foreign_key_columns(cursor):
+    """
+    Return the names of the referencing and referenced tables of all foreign keys along with the quoted names
+    of their referencing and referenced columns. Foreign keys of partitioned tables are returned only once,
+    as defined on the partitioned tables.
+    """
+    cursor.execute(
+        "SELECT {}, {}, "
+        "array(SELECT quote_ident(a.attname) FROM unnest(con.conkey) WITH ORDINALITY k(attnum, position) "
+        "JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum ORDER BY k.position), "
+        "array(SELECT quote_ident(a.attname) FROM unnest(con.confkey) WITH ORDINALITY k(attnum, position) "
+        "JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum ORDER BY k.position) "
+        "FROM pg_constraint con "
+        "JOIN pg_class c ON c.oid = con.conrelid JOIN pg_class r ON r.oid = con.confrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace JOIN pg_namespace rn ON rn.oid = r.relnamespace "
+        "WHERE con.contype = 'f' AND con.conparentid = 0 ORDER BY con.oid;".format(
+            get_qualified_name_sql("n", "c"), get_qualified_name_sql("rn", "r")
+        )
+    )
+    return cursor.fetchall()
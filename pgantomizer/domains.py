@@ -0,0 +1,110 @@
+import hashlib
+import logging
+
+from .utils import execute_statements, get_secret_key, quote_table_name
+
+
+MAPPING_SCHEMA = "pgantomizer_mapping"
+HMAC_BLOCK_SIZE = 64
+TEXT_PSEUDONYM = "'{domain}_' || left(encode(mapping.digest, 'hex'), 16)"
+# The first 8 bytes of the digest reduced to the non-negative range of the integer type
+INTEGER_PSEUDONYM = (
+    "(('x' || encode(substring(mapping.digest FROM 1 FOR 8), 'hex'))::bit(64)::bigint & {mask})::{data_type}"
+)
+# Pseudonyms of the values of a domain by the data types of its columns
+PSEUDONYMS = {
+    "character varying": TEXT_PSEUDONYM,
+    "character": TEXT_PSEUDONYM,
+    "text": TEXT_PSEUDONYM,
+    "smallint": INTEGER_PSEUDONYM.format(mask=2 ** 15 - 1, data_type="smallint"),
+    "integer": INTEGER_PSEUDONYM.format(mask=2 ** 31 - 1, data_type="integer"),
+    "bigint": INTEGER_PSEUDONYM.format(mask=2 ** 63 - 1, data_type="bigint"),
+    "uuid": "encode(substring(mapping.digest FROM 1 FOR 16), 'hex')::uuid",
+}
+
+
+def get_mapping_table(domain):
+    return "{}.{}".format(MAPPING_SCHEMA, domain)
+
+
+def get_pseudonym_expression(domain, data_type):
+    """
+    Return the SQL expression of the pseudonym of a value looked up in the mapping table of the domain
+    (aliased as mapping), or None if values of the data type cannot be pseudonymized.
+    All pseudonyms are derived from the keyed hash of the value: text columns get pseudonyms such as
+    "email_3f9a0c1d2b4e5f60", integer columns (e.g. IDs) a non-negative number of their type and UUID columns UUIDs.
+    """
+    pseudonym = PSEUDONYMS.get(data_type)
+    return pseudonym.format(domain=domain) if pseudonym else None
+
+
+def get_domain_update_statement(table, column, domain, value, where=None):
+    """Return the UPDATE replacing the values of the column by their pseudonyms joined from the mapping table."""
+    return (
+        "UPDATE {table} SET {column} = {value} FROM {mapping} mapping "
+        "WHERE mapping.value = {table}.{column}::text{where}"
+    ).format(
+        table=quote_table_name(table),
+        column=column,
+        value=value,
+        mapping=get_mapping_table(domain),
+        where=" AND ({})".format(where) if where else "",
+    )
+
+
+def get_hmac_keys(key):
+    """Return the inner and outer padded keys of HMAC-SHA256, so that it can be computed with sha256 in SQL."""
+    key = key.encode("utf-8")
+    if len(key) > HMAC_BLOCK_SIZE:
+        key = hashlib.sha256(key).digest()
+    key = key.ljust(HMAC_BLOCK_SIZE, b"\0")
+    return bytes(byte ^ 0x36 for byte in key), bytes(byte ^ 0x5C for byte in key)
+
+
+def create_mapping_tables(cursor, domains):
+    """
+    Create a mapping table for each domain that holds the distinct values of all its columns with their
+    HMAC under the secret key of the run (see `get_secret_key`), so that equal values in different tables
+    get the same pseudonym that reveals neither the value nor its order. Mapping tables left
+    by a previous run are kept as the tables may already be partially pseudonymized with them.
+    `domains` is a sequence of pairs of the domain name and the (table, column) pairs that belong to it.
+    The missing mapping tables are all created in a single round-trip.
+    """
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS {}".format(MAPPING_SCHEMA))
+    cursor.execute(
+        "SELECT name FROM unnest(%s::text[]) name WHERE to_regclass(name) IS NOT NULL;",
+        ([get_mapping_table(domain) for domain, _ in domains],),
+    )
+    existing = {row[0] for row in cursor.fetchall()}
+    inner_key, outer_key = get_hmac_keys(get_secret_key())
+    statements = []
+    for domain, columns in domains:
+        mapping = get_mapping_table(domain)
+        if mapping in existing:
+            logging.debug("Reusing mapping table {}".format(mapping))
+            continue
+        logging.debug("Creating mapping table {} ...".format(mapping))
+        statements += [
+            cursor.mogrify(
+                "CREATE TABLE {mapping} AS "
+                "SELECT value, sha256(%(outer_key)s || sha256(%(inner_key)s || convert_to(value, 'UTF8'))) AS digest "
+                "FROM ({values}) source(value)".format(
+                    mapping=mapping,
+                    values=" UNION ".join(
+                        "SELECT DISTINCT {column}::text FROM {table} WHERE {column} IS NOT NULL".format(
+                            column=column, table=quote_table_name(table)
+                        )
+                        for table, column in columns
+                    ),
+                ),
+                {"inner_key": inner_key, "outer_key": outer_key},
+            ).decode(),
+            "ALTER TABLE {} ADD PRIMARY KEY (value)".format(mapping),
+            "ANALYZE {}".format(mapping),
+        ]
+    execute_statements(cursor, statements)
+
+
+def drop_mapping_tables(cursor):
+    # The mapping tables hold the raw values, so they must never outlive the anonymization
+    cursor.execute("DROP SCHEMA IF EXISTS {} CASCADE".format(MAPPING_SCHEMA))
@@ -1,18 +1,106 @@
 import argparse
 import logging
 import os
+import re
+import shlex
 import subprocess
 import sys
 
+import psycopg2
+
 import yaml
 
+from .catalog import get_emptied_tables
+from .metrics import Metrics
+from .subset import export_subset, has_subset, select_subset
+from .utils import get_truncated_tables, quote_identifier
 
-def dump_db(dump_path, schema_path, password="", *db_args):
-    schema = yaml.load(open(schema_path), Loader=yaml.FullLoader)
-    password = password or os.environ.get("DB_DEFAULT_PASS", "")
-    os.putenv("PGPASSWORD", password)
-    cmd = "PGPASSWORD={password} pg_dump -Fc -Z 9 {args} {tables} -f {filename}".format(
+
+DUMP_FORMATS = {"custom": "c", "directory": "d"}
+DB_ARG_NAMES = ("dbname", "user", "password", "host", "port")
+DB_ENV_NAMES = (
+    "DB_DEFAULT_NAME",
+    "DB_DEFAULT_USER",
+    "DB_DEFAULT_PASS",
+    "DB_DEFAULT_SERVICE",
+    "DB_DEFAULT_PORT",
+)
+
+
+ANONYMIZED_DB_ENV_NAMES = (
+    "ANONYMIZED_DB_NAME",
+    "ANONYMIZED_DB_USER",
+    "ANONYMIZED_DB_PASS",
+    "ANONYMIZED_DB_HOST",
+    "ANONYMIZED_DB_PORT",
+)
+
+
+def get_source_db_args_from_env():
+    return {name: os.environ.get(var) for name, var in zip(DB_ARG_NAMES, DB_ENV_NAMES)}
+
+
+def get_db_args_from_env():
+    """Return the connection arguments of the anonymized DB, which pgantomizer restores into."""
+    return {name: os.environ.get(var) for name, var in zip(DB_ARG_NAMES, ANONYMIZED_DB_ENV_NAMES)}
+
+
+def get_dump_db_args(password, db_args):
+    """Return the connection arguments of the source DB given as the positional arguments of `dump_db`."""
+    return {
+        **(
+            dict(zip(("dbname", "user", "host", "port"), db_args))
+            if db_args
+            else get_source_db_args_from_env()
+        ),
+        "password": password,
+    }
+
+
+def get_emptied_source_tables(source_db_args, schema):
+    """Return the tables of the source DB whose data is dropped by the truncate rules, see `get_emptied_tables`."""
+    with psycopg2.connect(**source_db_args) as conn:
+        with conn.cursor() as cursor:
+            return get_emptied_tables(cursor, schema)
+
+
+def get_table_pattern(table):
+    """
+    Return the table name as a pg_dump pattern quoted for the shell. Parts of the names other than plain
+    lowercase names are double-quoted, so that pg_dump neither folds their case nor reads them as wildcards,
+    while the glob characters of namespace patterns are left unquoted.
+    """
+    def quote_part(match):
+        return match.group() if re.match(r"^[a-z0-9_]+$", match.group()) else quote_identifier(match.group())
+
+    return shlex.quote(re.sub(r"[^.*?]+", quote_part, table))
+
+
+def get_dump_command(
+    schema,
+    password,
+    db_args,
+    dump_format="custom",
+    jobs=1,
+    compression="9",
+    filename=None,
+    sections=None,
+    include_table_data=True,
+    excluded_data_tables=(),
+    snapshot=None,
+):
+    """
+    Build the pg_dump command for the tables listed in the schema, writing to stdout if no filename is given.
+    Without `include_table_data`, the data section only sets the sequences. The data of truncated tables
+    and `excluded_data_tables` is not dumped. With `snapshot`, the DB is read in the exported snapshot.
+    """
+    return "PGPASSWORD={password} pg_dump -F {format} {jobs}-Z {compression} {snapshot}{sections}{args} {tables} {excluded_data}{filename}".format(
         password=password,
+        format=DUMP_FORMATS[dump_format],
+        jobs="-j {} ".format(jobs) if dump_format == "directory" else "",
+        compression=compression,
+        snapshot="--snapshot={} ".format(snapshot) if snapshot else "",
+        sections="".join("--section={} ".format(section) for section in sections or []),
         args="-d {} -U {} -h {} -p {} ".format(
             *(
                 db_args
@@ -27,18 +115,106 @@ def dump_db(dump_path, schema_path, password="", *db_args):
                 ]
             )
         ),
-        tables=" ".join("-t {}".format(table) for table in schema),
-        filename=dump_path,
+        # Namespaces of the tables may be glob patterns, which pg_dump matches itself
+        tables=" ".join("-t {}".format(get_table_pattern(table)) for table in schema),
+        excluded_data=" ".join(
+            "--exclude-table-data={}".format(get_table_pattern(table))
+            for table in get_truncated_tables(schema) + list(excluded_data_tables)
+        )
+        if include_table_data
+        else "--exclude-table-data='*.*'",
+        filename=" -f {}".format(filename) if filename else "",
     )
-    logging.debug("Dumping DB with following command: {}".format(cmd))
-    subprocess.run(cmd, shell=True)
+
+
+def dump_subset(dump_path, schema, password, db_args, jobs=1, compression="9", metrics=None):
+    """
+    Dump the tables listed in the schema in the directory format with only the rows of the subset selected
+    by `select_subset` in the tables it spans. pg_dump reads the DB in the snapshot the subset is selected in
+    and dumps the definitions and the data of the other tables, the rows of the subset are written next to them.
+    """
+    metrics = metrics or Metrics()
+    conn = psycopg2.connect(**get_dump_db_args(password, db_args))
+    try:
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_export_snapshot();")
+            snapshot = cursor.fetchone()[0]
+            with metrics.stage("subset"):
+                data_tables = select_subset(cursor, schema)
+            cmd = get_dump_command(
+                schema,
+                password,
+                db_args,
+                "directory",
+                jobs,
+                compression,
+                filename=dump_path,
+                excluded_data_tables=list(data_tables) + get_emptied_tables(cursor, schema),
+                snapshot=snapshot,
+            )
+            logging.debug("Dumping DB with following command: {}".format(cmd))
+            with metrics.stage("dump"):
+                subprocess.run(cmd, shell=True, check=True)
+            with metrics.stage("subset"):
+                export_subset(cursor, data_tables, dump_path, compression)
+    finally:
+        # The temporary tables of the subset are dropped along with the session
+        conn.close()
+
+
+def dump_db(
+    dump_path,
+    schema_path,
+    password="",
+    *db_args,
+    dump_format="custom",
+    jobs=1,
+    compression="9",
+    metrics_path=None,
+    prometheus_path=None,
+):
+    """
+    Dump the tables listed in the schema. Only the directory format can be dumped with parallel `jobs`.
+    If any table has a `subset` rule, only a subset of rows is dumped in the directory format, see `dump_subset`.
+    `compression` is passed to `pg_dump -Z`, so it is either a level or a method with an optional level
+    such as "lz4", "zstd:3" or "none" (methods other than gzip require pg_dump 16).
+    The duration of the dump is written to `metrics_path` as JSON and to `prometheus_path` as a Prometheus textfile.
+    """
+    metrics = Metrics(enabled=bool(metrics_path or prometheus_path))
+    schema = yaml.load(open(schema_path), Loader=yaml.FullLoader)
+    password = password or os.environ.get("DB_DEFAULT_PASS", "")
+    os.putenv("PGPASSWORD", password)
+    if has_subset(schema):
+        if dump_format != "directory":
+            logging.info("Dumping the subset in the directory format")
+        dump_subset(dump_path, schema, password, db_args, jobs, compression, metrics)
+    else:
+        # Rows of tables referencing the tables truncated with cascade would break their foreign keys
+        cmd = get_dump_command(
+            schema,
+            password,
+            db_args,
+            dump_format,
+            jobs,
+            compression,
+            filename=dump_path,
+            excluded_data_tables=get_emptied_source_tables(get_dump_db_args(password, db_args), schema),
+        )
+        logging.debug("Dumping DB with following command: {}".format(cmd))
+        with metrics.stage("dump"):
+            subprocess.run(cmd, shell=True)
+    if metrics_path:
+        metrics.write_json(metrics_path)
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Dump tables specified in YAML config file from production DB "
         "for later anonymization.",
-        epilog="Compressed Postgres format is used. See README.md for details.",
+        epilog="Compressed custom or directory Postgres format is used. See README.md for details.",
     )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="increase output verbosity"
@@ -51,9 +227,34 @@ def main():
     )
     parser.add_argument(
         "--dump-file",
-        help="path to the file where to dump the DB",
+        help="path to the file or directory where to dump the DB",
         default="to_anonymize.sql",
     )
+    parser.add_argument(
+        "-F",
+        "--format",
+        choices=DUMP_FORMATS,
+        default="custom",
+        help="archive format of the dump, only the directory format can be dumped in parallel",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of tables to dump in parallel when using the directory format",
+    )
+    parser.add_argument(
+        "-Z",
+        "--compress",
+        default="9",
+        help="compression level or method with an optional level, e.g. 9, lz4, zstd:3 or none",
+    )
+    parser.add_argument("--metrics-file", help="write the duration of the dump to a JSON file")
+    parser.add_argument(
+        "--prometheus-file",
+        help="write the duration of the dump to a file for the textfile collector of the Prometheus node exporter",
+    )
     parser.add_argument("--dbname", help="name of the database to dump")
     parser.add_argument(
         "--user", help="name of the Postgres user with access to the database"
@@ -85,6 +286,11 @@ def main():
             if args.dbname and args.user
             else []
         ),
+        dump_format=args.format,
+        jobs=args.jobs,
+        compression=args.compress,
+        metrics_path=args.metrics_file,
+        prometheus_path=args.prometheus_file,
     )
 
 
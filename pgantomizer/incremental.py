@@ -0,0 +1,151 @@
+import logging
+
+import psycopg2
+
+from .catalog import get_primary_key_columns
+from .rewrite import get_anonymized_values
+from .transfer import copy_between, transfer_table
+from .utils import get_temporary_table_name, quote_table_name
+
+
+STATE_SCHEMA = "pgantomizer_state"
+WATERMARK_TABLE = "{}.watermark".format(STATE_SCHEMA)
+
+
+def create_watermark_table(cursor):
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS {}".format(STATE_SCHEMA))
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS {} (table_name text PRIMARY KEY, value text NOT NULL)".format(
+            WATERMARK_TABLE
+        )
+    )
+
+
+def has_watermark_table(cursor):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (WATERMARK_TABLE,))
+    return cursor.fetchone()[0]
+
+
+def get_watermark_column(cursor, table, watermark_column=None):
+    """
+    Return the configured watermark column of the table, or its primary key used as a high-water mark
+    if it consists of a single column, or None if changes of the table cannot be tracked.
+    """
+    if watermark_column:
+        return watermark_column
+    pk_columns = get_primary_key_columns(cursor, table)
+    return pk_columns[0] if len(pk_columns) == 1 else None
+
+
+def record_watermark(source_conn, target_conn, table, watermark_column):
+    """
+    Store the highest value of the watermark column of the source table in the target DB,
+    to be committed along with the data copied in the same snapshot of the source.
+    """
+    with source_conn.cursor() as source_cursor:
+        source_cursor.execute("SELECT max({})::text FROM {}".format(watermark_column, quote_table_name(table)))
+        watermark = source_cursor.fetchone()[0]
+    if watermark is None:
+        return
+    with target_conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {} VALUES (%s, %s) ON CONFLICT (table_name) DO UPDATE SET value = EXCLUDED.value;".format(
+                WATERMARK_TABLE
+            ),
+            (table, watermark),
+        )
+
+
+def upsert_changed_rows(cursor, table, changed_table, pk_columns):
+    """Insert the rows of `changed_table` into the table, replacing the rows with the same primary key."""
+    columns, _ = get_anonymized_values(cursor, table, {})
+    updates = [
+        "{column} = EXCLUDED.{column}".format(column=column)
+        for column in columns
+        if column not in pk_columns
+    ]
+    cursor.execute(
+        "INSERT INTO {table} ({columns}) OVERRIDING SYSTEM VALUE SELECT {columns} FROM {changed_table} "
+        "ON CONFLICT ({pk_columns}) {action}".format(
+            table=quote_table_name(table),
+            columns=", ".join(columns),
+            changed_table=changed_table,
+            pk_columns=", ".join(pk_columns),
+            action="DO UPDATE SET {}".format(", ".join(updates)) if updates else "DO NOTHING",
+        )
+    )
+    return cursor.rowcount
+
+
+def copy_changed_rows(source_conn, target_conn, table, column_values, where_clause, watermark_column):
+    """
+    Upsert the rows of the source table beyond the stored watermark into the target table with the
+    anonymization applied and advance the watermark. Tables without a primary key are copied whole.
+    Return the number of rows written.
+    """
+    with target_conn.cursor() as cursor:
+        pk_columns = get_primary_key_columns(cursor, table)
+        if not pk_columns:
+            logging.debug("Copying {} without a primary key whole ...".format(table))
+            cursor.execute("DELETE FROM {}".format(quote_table_name(table)))
+            return transfer_table(source_conn, target_conn, table, column_values, where_clause)
+
+        watermark_column = get_watermark_column(cursor, table, watermark_column)
+        row_filter = None
+        if watermark_column:
+            cursor.execute("SELECT value FROM {} WHERE table_name = %s;".format(WATERMARK_TABLE), (table,))
+            row = cursor.fetchone()
+            if row:
+                row_filter = cursor.mogrify(
+                    "{} > %s".format(watermark_column), (row[0],)
+                ).decode(psycopg2.extensions.encodings[target_conn.encoding])
+        else:
+            logging.debug("Copying {} whole as its changes cannot be tracked ...".format(table))
+
+        changed_table = get_temporary_table_name(table, "__changed")
+        cursor.execute("CREATE TEMPORARY TABLE {} (LIKE {})".format(changed_table, quote_table_name(table)))
+        transfer_table(
+            source_conn, target_conn, table, column_values, where_clause, row_filter, changed_table
+        )
+        written_rows = upsert_changed_rows(cursor, table, changed_table, pk_columns)
+        cursor.execute("DROP TABLE {}".format(changed_table))
+    if watermark_column:
+        record_watermark(source_conn, target_conn, table, watermark_column)
+    return written_rows
+
+
+def delete_removed_rows(source_conn, target_conn, table):
+    """Delete the rows of the target table whose primary keys are no longer in the source table."""
+    with target_conn.cursor() as cursor:
+        pk_columns = get_primary_key_columns(cursor, table)
+        if not pk_columns:
+            return 0
+        keys_table = get_temporary_table_name(table, "__keys")
+        table = quote_table_name(table)
+        cursor.execute(
+            "CREATE TEMPORARY TABLE {keys_table} AS SELECT {pk_columns} FROM {table} WITH NO DATA".format(
+                keys_table=keys_table, pk_columns=", ".join(pk_columns), table=table
+            )
+        )
+        copy_between(
+            source_conn,
+            target_conn,
+            "COPY (SELECT {} FROM {}) TO STDOUT".format(", ".join(pk_columns), table),
+            "COPY {} FROM STDIN".format(keys_table),
+        )
+        cursor.execute("ANALYZE {}".format(keys_table))
+        cursor.execute(
+            "DELETE FROM {table} WHERE NOT EXISTS (SELECT 1 FROM {keys_table} WHERE {condition})".format(
+                table=table,
+                keys_table=keys_table,
+                condition=" AND ".join(
+                    "{keys_table}.{column} = {table}.{column}".format(
+                        keys_table=keys_table, table=table, column=column
+                    )
+                    for column in pk_columns
+                ),
+            )
+        )
+        deleted_rows = cursor.rowcount
+        cursor.execute("DROP TABLE {}".format(keys_table))
+    return deleted_rows
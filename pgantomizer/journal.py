@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+
+
+RESTORE_STAGE = "restore"
+ANONYMIZE_STAGE = "anonymize"
+
+
+class Journal:
+    """
+    Record of finished stages, tables and update batches kept in a local JSON file,
+    so that an interrupted run can continue where it stopped instead of starting over.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        if resume and os.path.isfile(path):
+            with open(path) as journal_file:
+                self.state = json.load(journal_file)
+        else:
+            self.state = {"dump_file": None, "stages": [], "tables": [], "batches": {}}
+
+    def save(self):
+        # Write to a temporary file first so that a crash never leaves a truncated journal behind
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as journal_file:
+            json.dump(self.state, journal_file)
+        os.replace(tmp_path, self.path)
+
+    def get_dump_file(self):
+        return self.state["dump_file"]
+
+    def set_dump_file(self, dump_file):
+        with self.lock:
+            self.state["dump_file"] = dump_file
+            self.save()
+
+    def is_stage_finished(self, stage):
+        return stage in self.state["stages"]
+
+    def finish_stage(self, stage):
+        with self.lock:
+            self.state["stages"].append(stage)
+            self.save()
+
+    def is_table_finished(self, table):
+        return table in self.state["tables"]
+
+    def finish_table(self, table):
+        with self.lock:
+            self.state["tables"].append(table)
+            self.state["batches"].pop(table, None)
+            self.save()
+
+    def get_batch_progress(self, table):
+        """Return the upper primary key bound of the last committed batch of the table."""
+        return self.state["batches"].get(table)
+
+    def finish_batch(self, table, upper_bound):
+        with self.lock:
+            self.state["batches"][table] = (
+                upper_bound if isinstance(upper_bound, (int, str)) else str(upper_bound)
+            )
+            self.save()
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .utils import quote_table_name
+
+
+TABLE_METRICS = OrderedDict(
+    [
+        ("seconds", "Wall time spent anonymizing the table."),
+        ("rows", "Number of rows written by the anonymization of the table."),
+        ("bytes_before", "Total size of the table with its indexes before the anonymization."),
+        ("bytes_after", "Total size of the table with its indexes after the anonymization."),
+        ("wal_bytes", "WAL generated while anonymizing the table, overlaps with other tables in parallel runs."),
+    ]
+)
+
+
+class Metrics:
+    """
+    Wall times of the stages of a run and statistics of each table collected for a JSON report
+    and a Prometheus textfile, along with the session settings the run used. Stages run by several threads at once report the sum of their times.
+    Unless `enabled`, the sizes and the WAL of the tables, which cost extra round-trips, are not queried.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.tables = OrderedDict()
+        self.settings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + time.monotonic() - start
+
+    @contextmanager
+    def table(self, cursor, table):
+        """
+        Measure the anonymization of the table run in the body on the given cursor.
+        The body is expected to set "rows" in the yielded dict. The table is recorded also if the body fails,
+        but then without its size after and its WAL, as the transaction of the cursor may be aborted.
+        """
+        sizes = OrderedDict([("bytes_before", None), ("bytes_after", None), ("wal_bytes", None)])
+        if self.enabled:
+            cursor.execute(
+                "SELECT pg_total_relation_size(%s::regclass), pg_current_wal_insert_lsn();",
+                (quote_table_name(table),),
+            )
+            sizes["bytes_before"], wal_lsn = cursor.fetchone()
+        start = time.monotonic()
+        stats = {"rows": None}
+        try:
+            yield stats
+            if self.enabled:
+                cursor.execute(
+                    "SELECT pg_total_relation_size(%s::regclass), "
+                    "pg_wal_lsn_diff(pg_current_wal_insert_lsn(), %s)::bigint;",
+                    (quote_table_name(table), wal_lsn),
+                )
+                sizes["bytes_after"], sizes["wal_bytes"] = cursor.fetchone()
+        finally:
+            seconds = time.monotonic() - start
+            with self.lock:
+                self.tables[table] = OrderedDict(
+                    [("seconds", seconds), ("rows", stats["rows"])] + list(sizes.items())
+                )
+
+    def write_json(self, path):
+        write_atomically(
+            path, json.dumps(
+                {"stages": self.stages, "tables": self.tables, "settings": self.settings}, indent=2
+            ) + "\n"
+        )
+
+    def write_prometheus(self, path):
+        """Write the metrics in the text format read by the textfile collector of the node exporter."""
+        lines = [
+            "# HELP pgantomizer_stage_seconds Wall time spent in the stage of the run.",
+            "# TYPE pgantomizer_stage_seconds gauge",
+        ]
+        lines.extend(
+            'pgantomizer_stage_seconds{{stage="{}"}} {}'.format(escape_label_value(stage), seconds)
+            for stage, seconds in self.stages.items()
+        )
+        for metric, description in TABLE_METRICS.items():
+            lines.append("# HELP pgantomizer_table_{} {}".format(metric, description))
+            lines.append("# TYPE pgantomizer_table_{} gauge".format(metric))
+            lines.extend(
+                'pgantomizer_table_{}{{table="{}"}} {}'.format(
+                    metric, escape_label_value(table), stats[metric]
+                )
+                for table, stats in self.tables.items()
+                if stats[metric] is not None
+            )
+        write_atomically(path, "\n".join(lines) + "\n")
+
+
+def escape_label_value(value):
+    """Escape the backslashes, double quotes and line feeds of a label value of the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_atomically(path, content):
+    # The textfile collector may read the file at any time, so it must never see it half-written
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as metrics_file:
+        metrics_file.write(content)
+    os.replace(tmp_path, path)
@@ -0,0 +1,178 @@
+import hashlib
+import hmac
+import importlib
+import logging
+import multiprocessing
+import os
+import random
+import re
+import string
+import tempfile
+
+import psycopg2
+
+from .utils import SECRET_KEY_ENV, get_secret_key, get_temporary_table_name, quote_table_name
+
+
+PYTHON_RULE_BATCH_ROWS = 10000
+
+COPY_UNESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+COPY_ESCAPE_PATTERN = re.compile(r"\\(.)")
+
+
+def scramble(column, values, pks):
+    """
+    Replace letters with random letters of the same case and digits with random digits, keeping everything else,
+    so that e.g. phone numbers and postal codes keep their format. Equal values are scrambled the same way
+    by a generator seeded with their HMAC under the secret key of the run, see `get_secret_key`.
+    """
+    key = get_secret_key().encode("utf-8")
+    scrambled = []
+    for value in values:
+        if value is None:
+            scrambled.append(None)
+            continue
+        rng = random.Random(hmac.new(key, value.encode("utf-8"), hashlib.sha256).digest())
+        scrambled.append(
+            "".join(
+                rng.choice(string.ascii_lowercase)
+                if char in string.ascii_lowercase
+                else rng.choice(string.ascii_uppercase)
+                if char in string.ascii_uppercase
+                else rng.choice(string.digits)
+                if char in string.digits
+                else char
+                for char in value
+            )
+        )
+    return scrambled
+
+
+PYTHON_ANONYMIZATION_RULES = {
+    "scramble": scramble,
+}
+
+
+def resolve_python_rule(rule):
+    """Return the callable for a rule given by its name or by a "package.module:function" import path."""
+    if rule in PYTHON_ANONYMIZATION_RULES:
+        return PYTHON_ANONYMIZATION_RULES[rule]
+    module_name, _, function_name = rule.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def init_worker(secret_key):
+    # Workers started by spawning would generate keys of their own
+    os.environ[SECRET_KEY_ENV] = secret_key
+
+
+def decode_copy_field(field):
+    if field == "\\N":
+        return None
+    return COPY_ESCAPE_PATTERN.sub(lambda match: COPY_UNESCAPES.get(match.group(1), match.group(1)), field)
+
+
+def encode_copy_field(value):
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\t", "\\t")
+    )
+
+
+def transform_batch(task):
+    """
+    Apply the rules to a batch of rows in COPY text format and return the transformed rows in the same format.
+    The batch is transposed to columns, so that each rule is called once per batch with all its values.
+    """
+    rules, lines = task
+    rows = [[decode_copy_field(field) for field in line.split("\t")] for line in lines]
+    pks = [row[0] for row in rows]
+    columns = [pks]
+    for index, (column, rule) in enumerate(rules, 1):
+        columns.append(resolve_python_rule(rule)(column, [row[index] for row in rows], pks))
+    return "".join(
+        "\t".join(encode_copy_field(value) for value in row) + "\n" for row in zip(*columns)
+    )
+
+
+def read_batches(lines_file, batch_rows):
+    batch = []
+    for line in lines_file:
+        batch.append(line.rstrip("\n"))
+        if len(batch) == batch_rows:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_python_rule_values(cursor, table, pk_name, python_columns, where, processes=None):
+    """
+    Stream the primary key and the columns with Python rules out of the table with COPY, transform them
+    in batches across a pool of processes and return the path to a file with the results in COPY format.
+    The raw values and the results are spooled to temporary files to keep the memory bounded.
+    """
+    encoding = psycopg2.extensions.encodings[cursor.connection.encoding]
+    with tempfile.TemporaryFile() as raw_file:
+        cursor.copy_expert(
+            "COPY (SELECT {pk}, {columns} FROM {table} WHERE {where}) TO STDOUT".format(
+                pk=pk_name,
+                columns=", ".join(column for column, _ in python_columns),
+                table=quote_table_name(table),
+                where=where or "TRUE",
+            ),
+            raw_file,
+        )
+        raw_file.seek(0)
+        lines = (line.decode(encoding) for line in raw_file)
+        tasks = ((python_columns, batch) for batch in read_batches(lines, PYTHON_RULE_BATCH_ROWS))
+        processes = processes or os.cpu_count()
+        with tempfile.NamedTemporaryFile("wb", suffix=".copy", delete=False) as results_file:
+            with multiprocessing.Pool(processes, init_worker, (get_secret_key(),)) as pool:
+                window = []
+                for task in tasks:
+                    window.append(pool.apply_async(transform_batch, (task,)))
+                    # Bound the number of batches in flight, results are written in order
+                    if len(window) >= 2 * processes:
+                        results_file.write(window.pop(0).get().encode(encoding))
+                for result in window:
+                    results_file.write(result.get().encode(encoding))
+    return results_file.name
+
+
+def import_python_rule_values(cursor, table, pk_name, python_columns, results_path):
+    """
+    Load the results of `export_python_rule_values` into a temporary table and join them on the primary key.
+    Return the number of rows updated.
+    """
+    values_table = get_temporary_table_name(table, "__python_rules")
+    columns = [column for column, _ in python_columns]
+    logging.debug("Running UPDATE on {} for Python rule columns {} ...".format(table, ", ".join(columns)))
+    cursor.execute(
+        "CREATE TEMPORARY TABLE {values_table} AS SELECT {pk}, {columns} FROM {table} WITH NO DATA".format(
+            values_table=values_table, pk=pk_name, columns=", ".join(columns), table=quote_table_name(table)
+        )
+    )
+    with open(results_path, "rb") as results_file:
+        cursor.copy_expert("COPY {} FROM STDIN".format(values_table), results_file)
+    cursor.execute("ANALYZE {}".format(values_table))
+    cursor.execute(
+        "UPDATE {table} SET {column_updates_sql} FROM {values_table} "
+        "WHERE {table}.{pk} = {values_table}.{pk}".format(
+            table=quote_table_name(table),
+            column_updates_sql=", ".join(
+                "{column} = {values_table}.{column}".format(column=column, values_table=values_table)
+                for column in columns
+            ),
+            values_table=values_table,
+            pk=pk_name,
+        )
+    )
+    updated_rows = cursor.rowcount
+    cursor.execute("DROP TABLE {}".format(values_table))
+    return updated_rows
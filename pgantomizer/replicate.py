@@ -0,0 +1,562 @@
+import argparse
+import json
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from collections import OrderedDict, namedtuple
+
+import psycopg2
+import psycopg2.extras
+
+import yaml
+
+from .anonymize import (
+    DB_ARG_NAMES,
+    PgantomizerError,
+    check_in_flight_plan,
+    compile_plan,
+    get_db_args_from_env,
+    get_plan_emptied_tables,
+    load_schema_catalog,
+)
+from .catalog import get_primary_key_columns
+from .dump import get_source_db_args_from_env
+from .incremental import upsert_changed_rows
+from .rewrite import get_anonymized_values
+from .transfer import copy_between
+from .utils import (
+    get_temporary_table_name,
+    qualify_table_name,
+    quote_identifier,
+    quote_table_name,
+    split_table_name,
+)
+
+
+DEFAULT_SLOT_NAME = "pgantomizer"
+DEFAULT_PUBLICATION_NAME = "pgantomizer"
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# Marks a TOASTed value left out of an update by pgoutput as it did not change
+UNCHANGED_TOAST = object()
+
+DecodedRelation = namedtuple("DecodedRelation", ["schema", "name", "columns", "key_columns"])
+
+
+class ReplicationError(PgantomizerError):
+    pass
+
+
+def parse_lsn(lsn):
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def read_string(data, offset):
+    end = data.index(b"\0", offset)
+    return data[offset:end].decode(), end + 1
+
+
+def read_tuple(data, offset):
+    """Decode the TupleData of a pgoutput message into a list of text values, None for NULLs."""
+    (count,) = struct.unpack_from("!h", data, offset)
+    offset += 2
+    values = []
+    for _ in range(count):
+        kind = data[offset : offset + 1]
+        offset += 1
+        if kind == b"n":
+            values.append(None)
+        elif kind == b"u":
+            values.append(UNCHANGED_TOAST)
+        elif kind == b"t":
+            (length,) = struct.unpack_from("!i", data, offset)
+            offset += 4
+            values.append(data[offset : offset + length].decode())
+            offset += length
+        else:
+            raise ReplicationError("Unsupported kind of tuple data {!r}".format(kind))
+    return values, offset
+
+
+def read_relation(data):
+    (relation_id,) = struct.unpack_from("!i", data, 1)
+    schema, offset = read_string(data, 5)
+    name, offset = read_string(data, offset)
+    # Skip the replica identity setting
+    (count,) = struct.unpack_from("!h", data, offset + 1)
+    offset += 3
+    columns = []
+    key_columns = []
+    for _ in range(count):
+        flags = data[offset]
+        column, offset = read_string(data, offset + 1)
+        # Skip the type OID and modifier, the values are cast by the target table's row type
+        offset += 8
+        columns.append(column)
+        if flags & 1:
+            key_columns.append(column)
+    return relation_id, DecodedRelation(
+        schema, qualify_table_name(schema, name), tuple(columns), tuple(key_columns)
+    )
+
+
+class ChangeBatch:
+    """
+    Net effect of the changes decoded since the last applied commit. Only the last change of each row is kept,
+    keyed by its replica identity: an upserted row, a key of a row to refresh from the source or to delete.
+    """
+
+    def __init__(self):
+        self.tables = OrderedDict()
+        self.truncated = []
+        self.changes = 0
+        self.lsn = None
+        self.started = None
+
+    def add(self, relation, action, values):
+        row = dict(zip(relation.columns, values))
+        key = tuple(row[column] for column in relation.key_columns)
+        changes = self.tables.setdefault(relation.name, OrderedDict())
+        if action == "upsert" and UNCHANGED_TOAST in values:
+            previous_action, previous_row = changes.get(key, (None, None))
+            if previous_action == "upsert":
+                # The row was written in the same batch, so its unchanged values are known
+                row = {
+                    column: previous_row[column] if value is UNCHANGED_TOAST else value
+                    for column, value in row.items()
+                }
+            else:
+                action = "refresh"
+                row = {column: row[column] for column in relation.key_columns}
+        # Reinsert to order the changes of the table as they happened
+        changes.pop(key, None)
+        changes[key] = (action, row)
+        self.changes += 1
+        self.started = self.started or time.monotonic()
+
+    def truncate(self, table):
+        self.tables.pop(table, None)
+        if table not in self.truncated:
+            self.truncated.append(table)
+        self.changes += 1
+        self.started = self.started or time.monotonic()
+
+    def is_due(self, batch_size, flush_interval):
+        return self.lsn is not None and (
+            self.changes >= batch_size
+            or self.started is None
+            or time.monotonic() - self.started >= flush_interval
+        )
+
+
+def decode_message(data, relations, batch, dropped_tables, tables):
+    """
+    Add the change carried by a pgoutput message to the batch and return the end LSN if it is a commit.
+    The publication covers all tables of the source DB, so changes of tables other than `tables`,
+    which are not in the anonymized DB, are ignored; those of `dropped_tables` are dropped.
+    """
+    kind = data[:1]
+    if kind == b"R":
+        relation_id, relation = read_relation(data)
+        relations[relation_id] = relation
+    elif kind in (b"I", b"U", b"D"):
+        (relation_id,) = struct.unpack_from("!i", data, 1)
+        relation = relations[relation_id]
+        if relation.name not in tables or relation.name in dropped_tables:
+            return None
+        if not relation.key_columns:
+            raise ReplicationError("Changes of {} cannot be matched without a replica identity".format(relation.name))
+        offset = 5
+        if data[offset : offset + 1] in (b"K", b"O"):
+            old_values, offset = read_tuple(data, offset + 1)
+            # Deleted rows and updated rows whose key changed are removed under their old key
+            batch.add(relation, "delete", old_values)
+        if kind != b"D":
+            new_values, offset = read_tuple(data, offset + 1)
+            batch.add(relation, "upsert", new_values)
+    elif kind == b"T":
+        (count,) = struct.unpack_from("!i", data, 1)
+        for relation_id in struct.unpack_from("!{}i".format(count), data, 6):
+            relation = relations[relation_id]
+            if relation.name in tables:
+                batch.truncate(relation.name)
+    elif kind == b"C":
+        (end_lsn,) = struct.unpack_from("!q", data, 10)
+        return end_lsn
+    return None
+
+
+def copy_anonymized_rows(source_conn, target_conn, cursor, table_plan, from_clause, columns, target_table):
+    """
+    Copy the given columns of the rows selected by `from_clause`, under the name of the table,
+    into `target_table` with the anonymization evaluated by the source DB.
+    """
+    all_columns, values = get_anonymized_values(
+        cursor, table_plan.name, dict(table_plan.column_values), table_plan.where
+    )
+    values = dict(zip(all_columns, values))
+    copy_between(
+        source_conn,
+        target_conn,
+        "COPY (SELECT {} FROM {}) TO STDOUT".format(
+            ", ".join(values[column] for column in columns), from_clause
+        ),
+        "COPY {} ({}) FROM STDIN".format(target_table, ", ".join(columns)),
+    )
+
+
+def get_decoded_rows(cursor, table, rows):
+    """
+    Return an SQL subquery of the decoded rows, given as dicts of text values, with the columns of the table.
+    The values are cast from text, so that they are read by the input functions of the column types
+    as pgoutput writes them by the output functions, e.g. a jsonb document is not taken for a JSON string.
+    """
+    cursor.execute(
+        "SELECT quote_ident(attname), format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum;",
+        (quote_table_name(table),),
+    )
+    columns = cursor.fetchall()
+    return "(SELECT {values} FROM json_to_recordset({rows}) decoded({columns}))".format(
+        values=", ".join(
+            "decoded.{column}::{data_type} AS {column}".format(column=column, data_type=data_type)
+            for column, data_type in columns
+        ),
+        rows=cursor.mogrify("%s", (json.dumps(rows),)).decode(
+            psycopg2.extensions.encodings[cursor.connection.encoding]
+        ),
+        columns=", ".join("{} text".format(column) for column, _ in columns),
+    )
+
+
+def apply_table_changes(source_conn, target_conn, cursor, table_plan, pk_columns, changes):
+    """Delete, refresh and upsert the changed rows of the table. Return the number of rows written."""
+    table = table_plan.name
+    rows = {"delete": [], "refresh": [], "upsert": []}
+    for action, row in changes.values():
+        rows[action].append(row)
+    if rows["delete"]:
+        deleted_table = get_temporary_table_name(table, "__deleted")
+        cursor.execute(
+            "CREATE TEMPORARY TABLE {deleted_table} ON COMMIT DROP AS SELECT {pk_columns} FROM {table} "
+            "WITH NO DATA".format(
+                deleted_table=deleted_table, pk_columns=", ".join(pk_columns), table=quote_table_name(table)
+            )
+        )
+        copy_anonymized_rows(
+            source_conn,
+            target_conn,
+            cursor,
+            table_plan,
+            "{} {}".format(
+                get_decoded_rows(cursor, table, rows["delete"]), quote_identifier(split_table_name(table)[1])
+            ),
+            pk_columns,
+            deleted_table,
+        )
+        cursor.execute(
+            "DELETE FROM {table} WHERE EXISTS (SELECT 1 FROM {deleted_table} WHERE {condition})".format(
+                table=quote_table_name(table),
+                deleted_table=deleted_table,
+                condition=" AND ".join(
+                    "{deleted_table}.{column} = {table}.{column}".format(
+                        deleted_table=deleted_table, table=quote_table_name(table), column=column
+                    )
+                    for column in pk_columns
+                ),
+            )
+        )
+    if not (rows["refresh"] or rows["upsert"]):
+        return 0
+    changed_table = get_temporary_table_name(table, "__changed")
+    cursor.execute(
+        "CREATE TEMPORARY TABLE {} (LIKE {}) ON COMMIT DROP".format(changed_table, quote_table_name(table))
+    )
+    columns, _ = get_anonymized_values(cursor, table, {})
+    if rows["upsert"]:
+        copy_anonymized_rows(
+            source_conn,
+            target_conn,
+            cursor,
+            table_plan,
+            "{} {}".format(
+                get_decoded_rows(cursor, table, rows["upsert"]), quote_identifier(split_table_name(table)[1])
+            ),
+            columns,
+            changed_table,
+        )
+    if rows["refresh"]:
+        # Values of unchanged TOASTed columns are not decoded, so the current rows are read from the source
+        copy_anonymized_rows(
+            source_conn,
+            target_conn,
+            cursor,
+            table_plan,
+            "{table} WHERE ({pk_columns}) IN (SELECT {pk_columns} FROM {keys} keys)".format(
+                table=quote_table_name(table),
+                pk_columns=", ".join(pk_columns),
+                keys=get_decoded_rows(cursor, table, rows["refresh"]),
+            ),
+            columns,
+            changed_table,
+        )
+    return upsert_changed_rows(cursor, table, changed_table, pk_columns)
+
+
+def apply_batch(source_conn, target_conn, batch, table_plans, pk_columns):
+    """Apply the batch to the target DB in one transaction."""
+    with target_conn.cursor() as cursor:
+        if batch.truncated:
+            cursor.execute("TRUNCATE {}".format(", ".join(map(quote_table_name, batch.truncated))))
+        written_rows = 0
+        for table, changes in batch.tables.items():
+            written_rows += apply_table_changes(
+                source_conn, target_conn, cursor, table_plans[table], pk_columns[table], changes
+            )
+    target_conn.commit()
+    logging.debug(
+        "Applied {} changes up to LSN {:X}/{:X}, {} rows written".format(
+            batch.changes, batch.lsn >> 32, batch.lsn & 0xFFFFFFFF, written_rows
+        )
+    )
+
+
+def create_replication_slot(source_db_args, slot_name=DEFAULT_SLOT_NAME, publication=DEFAULT_PUBLICATION_NAME):
+    """
+    Create the publication of all tables and the logical replication slot that keeps the changes
+    for `replicate`. The slot must be created before the initial anonymized copy is made.
+    """
+    with psycopg2.connect(**source_db_args) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_publication WHERE pubname = %s;", (publication,))
+            if not cursor.fetchone():
+                cursor.execute("CREATE PUBLICATION {} FOR ALL TABLES".format(publication))
+            cursor.execute("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s;", (slot_name,))
+            slot_exists = cursor.fetchone()
+    if slot_exists:
+        logging.debug("Reusing replication slot {}".format(slot_name))
+        return
+    conn = psycopg2.connect(connection_factory=psycopg2.extras.LogicalReplicationConnection, **source_db_args)
+    try:
+        conn.cursor().create_replication_slot(slot_name, output_plugin="pgoutput")
+    finally:
+        conn.close()
+
+
+def drop_replication_slot(source_db_args, slot_name=DEFAULT_SLOT_NAME, publication=DEFAULT_PUBLICATION_NAME):
+    # An abandoned slot makes the source DB keep its WAL forever
+    with psycopg2.connect(**source_db_args) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_drop_replication_slot(slot_name) FROM pg_replication_slots WHERE slot_name = %s;",
+                (slot_name,),
+            )
+            cursor.execute("DROP PUBLICATION IF EXISTS {}".format(publication))
+
+
+def replicate(
+    schema,
+    source_db_args,
+    db_args,
+    slot_name=DEFAULT_SLOT_NAME,
+    publication=DEFAULT_PUBLICATION_NAME,
+    batch_size=DEFAULT_BATCH_SIZE,
+    flush_interval=DEFAULT_FLUSH_INTERVAL,
+    until_lsn=None,
+):
+    """
+    Keep the anonymized DB in sync with the source DB by applying the changes decoded from the replication slot
+    with the anonymization evaluated by the source DB, see `apply_batch`. Whole transactions are batched
+    until `batch_size` changes are collected or `flush_interval` seconds pass. Changes of truncated tables
+    and of the tables referencing the tables truncated with cascade are dropped. With `until_lsn`, stop after the first transaction committed at or after the LSN.
+    """
+    source_db_args = source_db_args or get_source_db_args_from_env()
+    target_conn = psycopg2.connect(**db_args)
+    source_conn = psycopg2.connect(**source_db_args)
+    source_conn.autocommit = True
+    replication_conn = psycopg2.connect(
+        connection_factory=psycopg2.extras.LogicalReplicationConnection, **source_db_args
+    )
+    try:
+        with target_conn.cursor() as cursor:
+            schema, catalog = load_schema_catalog(cursor, schema)
+            plan = compile_plan(schema, catalog)
+            check_in_flight_plan(plan)
+            with source_conn.cursor() as source_cursor:
+                skipped_tables = get_plan_emptied_tables(source_cursor, plan)
+            table_plans = {
+                table_plan.name: table_plan
+                for table_plan in plan.tables
+                if table_plan.name not in skipped_tables and not table_plan.partitioned
+            }
+            dropped_tables = set(catalog) - set(table_plans)
+            pk_columns = {table: get_primary_key_columns(cursor, table) for table in table_plans}
+            # Like the apply workers of Postgres, leave the foreign keys to be enforced by the source DB
+            cursor.execute("SET session_replication_role = replica")
+        target_conn.commit()
+        missing_pks = [table for table, columns in pk_columns.items() if not columns]
+        if missing_pks:
+            raise ReplicationError(
+                "Tables without a primary key cannot be replicated: {}".format(", ".join(missing_pks))
+            )
+
+        cursor = replication_conn.cursor()
+        cursor.start_replication(
+            slot_name=slot_name,
+            decode=False,
+            options={"proto_version": "1", "publication_names": publication},
+        )
+        relations = {}
+        batch = ChangeBatch()
+        while True:
+            message = cursor.read_message()
+            if message is None:
+                if batch.is_due(batch_size, flush_interval):
+                    apply_batch(source_conn, target_conn, batch, table_plans, pk_columns)
+                    cursor.send_feedback(flush_lsn=batch.lsn)
+                    batch = ChangeBatch()
+                select.select([cursor], [], [], flush_interval)
+                continue
+            end_lsn = decode_message(message.payload, relations, batch, dropped_tables, catalog)
+            if end_lsn is None:
+                continue
+            batch.lsn = end_lsn
+            if until_lsn is not None and end_lsn >= until_lsn:
+                apply_batch(source_conn, target_conn, batch, table_plans, pk_columns)
+                cursor.send_feedback(flush_lsn=batch.lsn, force=True)
+                return
+            if batch.is_due(batch_size, flush_interval):
+                apply_batch(source_conn, target_conn, batch, table_plans, pk_columns)
+                cursor.send_feedback(flush_lsn=batch.lsn)
+                batch = ChangeBatch()
+    finally:
+        replication_conn.close()
+        source_conn.close()
+        target_conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Continuously apply the changes of the source DB to a DB anonymized by pgantomizer "
+        "through logical replication.",
+        epilog="Run with --create-slot before making the initial anonymized copy. See README.rst for details.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="increase output verbosity"
+    )
+    parser.add_argument(
+        "--schema",
+        help="YAML config file with anonymization rules for all tables",
+        required=True,
+        default="./schema.yaml",
+    )
+    parser.add_argument(
+        "--slot", help="name of the logical replication slot", default=DEFAULT_SLOT_NAME
+    )
+    parser.add_argument(
+        "--publication", help="name of the publication of all tables", default=DEFAULT_PUBLICATION_NAME
+    )
+    parser.add_argument(
+        "--create-slot",
+        action="store_true",
+        help="create the publication and the replication slot in the source DB and exit",
+    )
+    parser.add_argument(
+        "--drop-slot",
+        action="store_true",
+        help="drop the publication and the replication slot from the source DB and exit",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="number of changes to collect before applying them",
+    )
+    parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=DEFAULT_FLUSH_INTERVAL,
+        help="seconds after which the collected changes are applied even if the batch is not full",
+    )
+    parser.add_argument(
+        "--until-lsn", help="exit after applying the first transaction committed at or after this LSN"
+    )
+    parser.add_argument(
+        "--source-dbname",
+        help="name of the source database, DB_DEFAULT_* variables are used if omitted",
+    )
+    parser.add_argument("--source-user", help="name of the Postgres user of the source database")
+    parser.add_argument(
+        "--source-password", help="password of the Postgres user of the source database", default=""
+    )
+    parser.add_argument(
+        "--source-host", help="host where the source DB is running", default="localhost"
+    )
+    parser.add_argument(
+        "--source-port", help="port where the source DB is running", default="5432"
+    )
+    parser.add_argument("--dbname", help="name of the anonymized database")
+    parser.add_argument(
+        "--user",
+        help="name of the Postgres user with access to the anonymized database",
+    )
+    parser.add_argument(
+        "--password",
+        help="password of the Postgres user with access to the anonymized database",
+        default="",
+    )
+    parser.add_argument("--host", help="host where the DB is running", default="localhost")
+    parser.add_argument("--port", help="port where the DB is running", default="5432")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG)
+    else:
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    if not os.path.isfile(args.schema):
+        sys.exit('File with schema "{}" does not exist.'.format(args.schema))
+
+    source_db_args = (
+        dict(
+            zip(
+                DB_ARG_NAMES,
+                (
+                    args.source_dbname,
+                    args.source_user,
+                    args.source_password,
+                    args.source_host,
+                    args.source_port,
+                ),
+            )
+        )
+        if args.source_dbname and args.source_user
+        else get_source_db_args_from_env()
+    )
+    if args.create_slot:
+        create_replication_slot(source_db_args, args.slot, args.publication)
+        return
+    if args.drop_slot:
+        drop_replication_slot(source_db_args, args.slot, args.publication)
+        return
+
+    replicate(
+        yaml.load(open(args.schema), Loader=yaml.FullLoader),
+        source_db_args,
+        dict(zip(DB_ARG_NAMES, (args.dbname, args.user, args.password, args.host, args.port)))
+        if args.dbname and args.user
+        else get_db_args_from_env(),
+        args.slot,
+        args.publication,
+        args.batch_size,
+        args.flush_interval,
+        parse_lsn(args.until_lsn) if args.until_lsn else None,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import logging
+
+from .utils import quote_identifier, quote_table_name, split_table_name
+
+
+REWRITTEN_TABLE_SUFFIX = "__anonymized"
+
+
+def get_rewrite_blocker(cursor, table):
+    """
+    Return the reason why the table cannot be swapped for a rewritten copy, or None if it can.
+    Objects that depend on the table itself (views, partitions, inheritance children, policies, publications)
+    would have to be dropped along with it, so such tables are left to the UPDATE engine.
+    """
+    cursor.execute(
+        "SELECT c.relkind, c.relispartition OR c.relhassubclass "
+        "OR EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = c.oid), "
+        "EXISTS (SELECT 1 FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid "
+        "WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = c.oid AND r.ev_class <> c.oid), "
+        "c.relrowsecurity OR EXISTS (SELECT 1 FROM pg_policy WHERE polrelid = c.oid), "
+        "EXISTS (SELECT 1 FROM pg_publication_rel WHERE prrelid = c.oid) "
+        "FROM pg_class c WHERE c.oid = %s::regclass;",
+        (quote_table_name(table),),
+    )
+    relkind, inherited, has_views, has_policies, published = cursor.fetchone()
+    if relkind != "r":
+        return "it is not a plain table"
+    if inherited:
+        return "it takes part in inheritance or partitioning"
+    if has_views:
+        return "views depend on it"
+    if has_policies:
+        return "it has row level security"
+    if published:
+        return "it is part of a publication"
+    return None
+
+
+def get_table_rebuild_statements(cursor, table):
+    """
+    Collect DDL that recreates everything `CREATE TABLE ... (LIKE ... INCLUDING ALL EXCLUDING INDEXES)`
+    does not carry over: indexes, PK/unique/exclusion/FK constraints, triggers, storage options,
+    the table comment, ownership and grants. The statements refer to the table by its original name
+    and must be run after the rewritten copy has been renamed.
+    """
+    table = quote_table_name(table)
+    statements = []
+    cursor.execute(
+        "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i WHERE i.indrelid = %s::regclass "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint con WHERE con.conindid = i.indexrelid "
+        "AND con.conrelid = i.indrelid AND con.contype IN ('p', 'u', 'x'));",
+        (table,),
+    )
+    statements.extend(row[0] for row in cursor.fetchall())
+    # FKs go last as self-referencing ones need the PK to exist
+    cursor.execute(
+        "SELECT quote_ident(conname), pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'x', 'f') "
+        "ORDER BY contype = 'f', conname;",
+        (table,),
+    )
+    statements.extend(
+        "ALTER TABLE {} ADD CONSTRAINT {} {}".format(table, name, definition)
+        for name, definition in cursor.fetchall()
+    )
+    cursor.execute(
+        "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal;",
+        (table,),
+    )
+    statements.extend(row[0] for row in cursor.fetchall())
+    cursor.execute(
+        "SELECT array_to_string(reloptions, ', '), "
+        "quote_literal(obj_description(oid, 'pg_class')), "
+        "CASE WHEN relowner <> (SELECT oid FROM pg_roles WHERE rolname = current_user) "
+        "THEN quote_ident(pg_get_userbyid(relowner)) END "
+        "FROM pg_class WHERE oid = %s::regclass;",
+        (table,),
+    )
+    options, comment, owner = cursor.fetchone()
+    if options:
+        statements.append("ALTER TABLE {} SET ({})".format(table, options))
+    if comment:
+        statements.append("COMMENT ON TABLE {} IS {}".format(table, comment))
+    if owner:
+        statements.append("ALTER TABLE {} OWNER TO {}".format(table, owner))
+    cursor.execute(
+        "SELECT a.privilege_type, NULL, "
+        "CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END, "
+        "a.is_grantable FROM pg_class c, aclexplode(c.relacl) a WHERE c.oid = %s::regclass "
+        "UNION ALL "
+        "SELECT a.privilege_type, quote_ident(att.attname), "
+        "CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END, "
+        "a.is_grantable FROM pg_attribute att, aclexplode(att.attacl) a "
+        "WHERE att.attrelid = %s::regclass AND att.attnum > 0 AND NOT att.attisdropped;",
+        (table, table),
+    )
+    statements.extend(
+        "GRANT {privilege}{column} ON {table} TO {grantee}{grant_option}".format(
+            privilege=privilege,
+            column=" ({})".format(column) if column else "",
+            table=table,
+            grantee=grantee,
+            grant_option=" WITH GRANT OPTION" if is_grantable else "",
+        )
+        for privilege, column, grantee, is_grantable in cursor.fetchall()
+    )
+    return statements
+
+
+def get_anonymized_values(cursor, table, column_values, where_clause=None):
+    """
+    Return the quoted names of all columns of the table that can be written to along with the SQL expressions
+    of their anonymized values. Columns without an expression in `column_values` keep their value,
+    as do all columns of rows not matching `where_clause`.
+    """
+    cursor.execute(
+        "SELECT attname, quote_ident(attname) FROM pg_attribute WHERE attrelid = %s::regclass "
+        "AND attnum > 0 AND NOT attisdropped AND attgenerated = '' ORDER BY attnum;",
+        (quote_table_name(table),),
+    )
+    columns = []
+    values = []
+    for name, column in cursor.fetchall():
+        columns.append(column)
+        if name not in column_values:
+            values.append(column)
+        elif where_clause:
+            values.append(
+                "CASE WHEN {where} THEN {value} ELSE {column} END".format(
+                    where=where_clause, value=column_values[name], column=column
+                )
+            )
+        else:
+            values.append(column_values[name])
+    return columns, values
+
+
+def rewrite_table(cursor, table, column_values, where_clause=None):
+    """
+    Anonymize the table by copying it into a new table with the anonymization expressions applied
+    and swapping the copy in place of the original. Unlike an in-place UPDATE, this leaves no dead tuples
+    behind, the table is written only once, indexes are built in bulk afterwards and the original
+    is readable until the final swap.
+
+    `column_values` maps column names to SQL expressions; other columns are copied as they are.
+    Rows not matching `where_clause` keep their original values. Return the number of rows copied.
+    The copy of an UNLOGGED table is UNLOGGED as well.
+    """
+    new_table = quote_table_name("{}{}".format(table, REWRITTEN_TABLE_SUFFIX))
+    rebuild_statements = get_table_rebuild_statements(cursor, table)
+    columns, values = get_anonymized_values(cursor, table, column_values, where_clause)
+    relation_name = split_table_name(table)[1]
+    table = quote_table_name(table)
+    cursor.execute("SELECT relpersistence FROM pg_class WHERE oid = %s::regclass;", (table,))
+    unlogged = cursor.fetchone()[0] == "u"
+
+    logging.debug("Copying {} into {} ...".format(table, new_table))
+    cursor.execute(
+        "CREATE {persistence}TABLE {new_table} (LIKE {table} INCLUDING ALL EXCLUDING INDEXES)".format(
+            persistence="UNLOGGED " if unlogged else "", new_table=new_table, table=table
+        )
+    )
+    cursor.execute(
+        "INSERT INTO {new_table} ({columns}) OVERRIDING SYSTEM VALUE SELECT {values} FROM {table}".format(
+            new_table=new_table,
+            columns=", ".join(columns),
+            values=", ".join(values),
+            table=table,
+        )
+    )
+    copied_rows = cursor.rowcount
+
+    # Identity columns got fresh sequences, serial columns keep theirs but must not be dropped with the table
+    cursor.execute(
+        "SELECT a.attname, quote_ident(a.attname), s.oid::regclass, d.deptype FROM pg_depend d "
+        "JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S' "
+        "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+        "WHERE d.classid = 'pg_class'::regclass AND d.refobjid = %s::regclass AND d.deptype IN ('a', 'i');",
+        (table,),
+    )
+    for column_name, column, sequence, deptype in cursor.fetchall():
+        if deptype == "i":
+            # Unlike the table name, the column name is not parsed as an identifier
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, %s), last_value, is_called) FROM {}".format(
+                    sequence
+                ),
+                (new_table, column_name),
+            )
+        else:
+            cursor.execute(
+                "ALTER SEQUENCE {} OWNED BY {}.{}".format(sequence, new_table, column)
+            )
+
+    cursor.execute(
+        "SELECT conrelid::regclass, quote_ident(conname), pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE confrelid = %s::regclass AND conrelid <> confrelid AND contype = 'f';",
+        (table,),
+    )
+    referencing_constraints = cursor.fetchall()
+    for referencing_table, name, _ in referencing_constraints:
+        cursor.execute("ALTER TABLE {} DROP CONSTRAINT {}".format(referencing_table, name))
+
+    logging.debug("Swapping {} for its anonymized copy ...".format(table))
+    cursor.execute("DROP TABLE {}".format(table))
+    cursor.execute("ALTER TABLE {} RENAME TO {}".format(new_table, quote_identifier(relation_name)))
+    for statement in rebuild_statements:
+        cursor.execute(statement)
+    for referencing_table, name, definition in referencing_constraints:
+        cursor.execute(
+            "ALTER TABLE {} ADD CONSTRAINT {} {}".format(referencing_table, name, definition)
+        )
+    return copied_rows
@@ -0,0 +1,218 @@
+import gzip
+import logging
+import os
+import re
+from collections import OrderedDict
+
+import psycopg2
+
+from .catalog import get_emptied_tables, get_foreign_key_columns, get_namespaces, load_catalog
+from .rewrite import get_anonymized_values
+from .utils import (
+    expand_schema,
+    get_namespace_patterns,
+    get_temporary_table_name,
+    quote_table_name,
+    table_matches,
+)
+
+
+SUBSET_DATA_DIR = "subset"
+SUBSET_TABLE_SUFFIX = "__subset"
+PERCENTAGE_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*%$")
+DATA_FILE_RE = re.compile(r"^(.+)\.dat(\.gz)?$")
+
+
+def has_subset(schema):
+    return any(rules and "subset" in rules for rules in schema.values())
+
+
+def get_selection(subset):
+    """
+    Return the clause selecting the rows of a root table by its `subset` rule, which is either a percentage
+    of rows sampled at random such as "1%" or an SQL condition such as "created > '2024-01-01'".
+    """
+    match = PERCENTAGE_RE.match(str(subset).strip())
+    if not match:
+        return "WHERE ({})".format(subset)
+    if not 0 < float(match.group(1)) <= 100:
+        raise ValueError('Subset "{}" is not a percentage between 0 and 100'.format(subset))
+    return "TABLESAMPLE BERNOULLI ({})".format(match.group(1))
+
+
+def get_subset_scope(foreign_keys, roots):
+    """Return the names of the tables connected to the root tables by chains of foreign keys."""
+    scope = set(roots)
+    changed = True
+    while changed:
+        changed = False
+        for table, referenced, _, _ in foreign_keys:
+            if (table in scope) != (referenced in scope):
+                scope.update((table, referenced))
+                changed = True
+    return scope
+
+
+def get_closure_statements(table, referenced, columns, referenced_columns, subset_tables):
+    """
+    Return the INSERTs following the foreign key of the table from the rows selected in the last round:
+    up to the referenced rows, which the restored foreign key needs, and down to the referencing rows,
+    but only from rows selected by the roots or on the way down from them.
+    Otherwise every row referencing a row added on the way up would pull in yet more rows.
+    """
+    join_condition = " AND ".join(
+        "c.{} = p.{}".format(column, referenced_column)
+        for column, referenced_column in zip(columns, referenced_columns)
+    )
+    up = (
+        "INSERT INTO {referenced_subset} SELECT DISTINCT p.tableoid, p.ctid, FALSE, %(next_round)s "
+        "FROM {subset} s JOIN {table} c ON c.tableoid = s.relation AND c.ctid = s.tid "
+        "JOIN {referenced} p ON {join_condition} WHERE s.round = %(round)s "
+        "ON CONFLICT (relation, tid) DO NOTHING"
+    )
+    down = (
+        "INSERT INTO {subset} SELECT DISTINCT c.tableoid, c.ctid, TRUE, %(next_round)s "
+        "FROM {referenced_subset} s JOIN {referenced} p ON p.tableoid = s.relation AND p.ctid = s.tid "
+        "JOIN {table} c ON {join_condition} WHERE s.round = %(round)s AND s.downward "
+        "ON CONFLICT (relation, tid) DO UPDATE SET downward = TRUE, round = EXCLUDED.round "
+        "WHERE NOT {subset}.downward"
+    )
+    return [
+        statement.format(
+            table=quote_table_name(table),
+            referenced=quote_table_name(referenced),
+            subset=subset_tables[table],
+            referenced_subset=subset_tables[referenced],
+            join_condition=join_condition,
+        )
+        for statement in (up, down)
+    ]
+
+
+def select_subset(cursor, schema):
+    """
+    Select the rows of the subset given by the `subset` rules of the root tables together with all rows
+    they reference and all rows referencing them (transitively), so that the foreign keys hold in the subset.
+    Tables not connected to any root by foreign keys are not subset. Tables emptied by the truncate rules
+    (see `get_emptied_tables`) and their partitions are left out, so that none of their rows is exported. The rows are identified by their
+    table OIDs and ctids kept in temporary tables, one per subset table, filled by set-based INSERTs
+    in rounds that only follow the rows added by the previous round.
+    Return a mapping of the dumped tables holding rows of the subset to the temporary tables of their rows;
+    partitions are mapped to the temporary table of their partitioned table.
+    """
+    emptied_tables = set(get_emptied_tables(cursor, schema))
+    namespaces = get_namespaces(cursor, get_namespace_patterns(schema))
+    schema = expand_schema(schema, namespaces)
+    catalog = load_catalog(cursor, namespaces)
+    tables = []
+    for table in catalog:
+        relation = catalog[table]
+        while relation.name not in emptied_tables and relation.parent in catalog:
+            relation = catalog[relation.parent]
+        if table in schema and relation.name not in emptied_tables:
+            tables.append(table)
+    foreign_keys = [
+        foreign_key
+        for foreign_key in get_foreign_key_columns(cursor)
+        if foreign_key[0] in tables and foreign_key[1] in tables
+    ]
+    roots = [table for table in tables if (schema[table] or {}).get("subset") is not None]
+    scope = get_subset_scope(foreign_keys, roots)
+    subset_tables = OrderedDict(
+        (table, get_temporary_table_name(table, SUBSET_TABLE_SUFFIX)) for table in tables if table in scope
+    )
+    for subset_table in subset_tables.values():
+        cursor.execute(
+            "CREATE TEMPORARY TABLE {} (relation oid, tid tid, downward boolean NOT NULL, "
+            "round integer NOT NULL, PRIMARY KEY (relation, tid))".format(subset_table)
+        )
+    for table in roots:
+        logging.debug("Selecting the subset of {} ...".format(table))
+        cursor.execute(
+            "INSERT INTO {} SELECT tableoid, ctid, TRUE, 0 FROM {} {}".format(
+                subset_tables[table], quote_table_name(table), get_selection(schema[table]["subset"])
+            )
+        )
+
+    statements = [
+        statement
+        for table, referenced, columns, referenced_columns in foreign_keys
+        if table in scope
+        for statement in get_closure_statements(
+            table, referenced, columns, referenced_columns, subset_tables
+        )
+    ]
+    round_number = 0
+    while True:
+        for subset_table in subset_tables.values():
+            cursor.execute("ANALYZE {}".format(subset_table))
+        selected_rows = 0
+        for statement in statements:
+            cursor.execute(statement, {"round": round_number, "next_round": round_number + 1})
+            selected_rows += cursor.rowcount
+        if selected_rows == 0:
+            break
+        round_number += 1
+    logging.debug("Closed the subset under foreign keys in {} rounds".format(round_number + 1))
+
+    data_tables = OrderedDict()
+    for table in tables:
+        relation = catalog[table]
+        owner = relation
+        while owner.name not in subset_tables and owner.parent in catalog:
+            owner = catalog[owner.parent]
+        if relation.kind == "r" and owner.name in subset_tables:
+            data_tables[table] = subset_tables[owner.name]
+    return data_tables
+
+
+def get_gzip_level(compression):
+    # Other compression methods of pg_dump are not available in Python, their subset is left uncompressed
+    return int(compression) if str(compression).isdigit() else 0
+
+
+def export_subset(cursor, data_tables, dump_path, compression="9"):
+    """
+    Write the rows of the subset selected by `select_subset` into the dump directory, a COPY data file
+    per table compressed by gzip if `compression` is a level of pg_dump's default method.
+    """
+    os.mkdir(os.path.join(dump_path, SUBSET_DATA_DIR))
+    level = get_gzip_level(compression)
+    for table, subset_table in data_tables.items():
+        columns, _ = get_anonymized_values(cursor, table, {})
+        path = os.path.join(
+            dump_path, SUBSET_DATA_DIR, "{}.dat{}".format(table, ".gz" if level else "")
+        )
+        with gzip.open(path, "wb", compresslevel=level) if level else open(path, "wb") as data_file:
+            cursor.copy_expert(
+                "COPY (SELECT {columns} FROM {table} t JOIN {subset_table} s "
+                "ON s.relation = t.tableoid AND s.tid = t.ctid) TO STDOUT".format(
+                    columns=", ".join("t.{}".format(column) for column in columns),
+                    table=quote_table_name(table),
+                    subset_table=subset_table,
+                ),
+                data_file,
+            )
+        logging.debug("Dumped {} rows of the subset of {}".format(cursor.rowcount, table))
+
+
+def has_subset_data(filename):
+    return os.path.isdir(os.path.join(filename, SUBSET_DATA_DIR))
+
+
+def load_subset(filename, db_args, excluded_data_tables=()):
+    """Load the rows of the subset written by `export_subset` into the restored tables."""
+    directory = os.path.join(filename, SUBSET_DATA_DIR)
+    with psycopg2.connect(**db_args) as conn:
+        with conn.cursor() as cursor:
+            for file_name in sorted(os.listdir(directory)):
+                table, compressed = DATA_FILE_RE.match(file_name).groups()
+                if any(table_matches(excluded, table) for excluded in excluded_data_tables):
+                    logging.debug("Skipping restore of data for table {}".format(table))
+                    continue
+                columns, _ = get_anonymized_values(cursor, table, {})
+                path = os.path.join(directory, file_name)
+                with gzip.open(path, "rb") if compressed else open(path, "rb") as data_file:
+                    cursor.copy_expert(
+                        "COPY {} ({}) FROM STDIN".format(quote_table_name(table), ", ".join(columns)), data_file
+                    )
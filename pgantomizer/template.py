@@ -0,0 +1,188 @@
+import argparse
+import logging
+import sys
+
+import psycopg2
+
+from .dump import DB_ARG_NAMES, get_db_args_from_env
+
+
+MAINTENANCE_DBNAME = "postgres"
+NEXT_SUFFIX = "__next"
+RETIRED_SUFFIX = "__retired"
+
+
+def connect_to_maintenance_db(db_args):
+    # CREATE DATABASE and DROP DATABASE cannot run inside a transaction block
+    conn = psycopg2.connect(**{**db_args, "dbname": MAINTENANCE_DBNAME})
+    conn.autocommit = True
+    return conn
+
+
+def get_create_database_statement(cursor, name, template):
+    """
+    Copy the files of the template instead of writing its whole content into the WAL, which is the default
+    since Postgres 15 and makes copies of large databases slow.
+    """
+    cursor.execute("SHOW server_version_num;")
+    return "CREATE DATABASE {} TEMPLATE {}{}".format(
+        name, template, " STRATEGY FILE_COPY" if int(cursor.fetchone()[0]) >= 150000 else ""
+    )
+
+
+def disconnect_databases(cursor, names):
+    for name in names:
+        cursor.execute("ALTER DATABASE {} WITH ALLOW_CONNECTIONS false".format(name))
+    cursor.execute(
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = ANY(%s);", (list(names),)
+    )
+
+
+def drop_databases(cursor, names):
+    disconnect_databases(cursor, names)
+    for name in names:
+        cursor.execute("ALTER DATABASE {} WITH IS_TEMPLATE false".format(name))
+        cursor.execute("DROP DATABASE {}".format(name))
+
+
+def get_existing_databases(cursor, names):
+    cursor.execute("SELECT datname FROM pg_database WHERE datname = ANY(%s);", (list(names),))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def swap_databases(cursor, names):
+    """
+    Replace each database by the one with the same name suffixed with `NEXT_SUFFIX` in a single transaction,
+    so that clients see either all old or all new databases, and drop the replaced ones.
+    Connections to the replaced databases are terminated as a database in use cannot be renamed.
+    """
+    existing = get_existing_databases(cursor, names)
+    disconnect_databases(cursor, existing)
+    cursor.execute("BEGIN")
+    for name in names:
+        if name in existing:
+            cursor.execute("ALTER DATABASE {} RENAME TO {}{}".format(name, name, RETIRED_SUFFIX))
+        cursor.execute("ALTER DATABASE {}{} RENAME TO {}".format(name, NEXT_SUFFIX, name))
+    cursor.execute("COMMIT")
+    drop_databases(cursor, ["{}{}".format(name, RETIRED_SUFFIX) for name in existing])
+
+
+def drop_leftovers(cursor, names):
+    """Drop the databases left behind by an interrupted publication or cloning."""
+    drop_databases(
+        cursor,
+        get_existing_databases(
+            cursor,
+            [name + suffix for name in names for suffix in (NEXT_SUFFIX, RETIRED_SUFFIX)],
+        ),
+    )
+
+
+def publish_template(db_args, template):
+    """
+    Vacuum and freeze the anonymized DB and publish its copy as the template database `template`,
+    replacing the previous one. Clones of the template thus start with all rows frozen and the statistics
+    up to date. The anonymized DB is kept for the next run.
+    """
+    conn = psycopg2.connect(**db_args)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            logging.debug("Vacuuming and freezing {}".format(db_args["dbname"]))
+            cursor.execute("VACUUM (FREEZE, ANALYZE)")
+    finally:
+        # The template cannot be copied while anyone is connected to it
+        conn.close()
+
+    conn = connect_to_maintenance_db(db_args)
+    try:
+        with conn.cursor() as cursor:
+            drop_leftovers(cursor, [template])
+            logging.debug("Publishing {} as template {}".format(db_args["dbname"], template))
+            cursor.execute(
+                get_create_database_statement(cursor, template + NEXT_SUFFIX, db_args["dbname"])
+            )
+            cursor.execute(
+                "ALTER DATABASE {}{} WITH IS_TEMPLATE true ALLOW_CONNECTIONS false".format(
+                    template, NEXT_SUFFIX
+                )
+            )
+            swap_databases(cursor, [template])
+    finally:
+        conn.close()
+
+
+def get_clone_names(template, count):
+    return ["{}_{}".format(template, number) for number in range(1, count + 1)]
+
+
+def clone_template(db_args, template, count):
+    """
+    Create `count` databases named after the template with numeric suffixes as its copies, replacing
+    the clones of the previous template all at once. Clones beyond `count` left by earlier calls are dropped.
+    """
+    conn = connect_to_maintenance_db(db_args)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT datname FROM pg_database WHERE datname ~ %s;", ("^{}_[0-9]+$".format(template),)
+            )
+            names = get_clone_names(template, count)
+            stale = {row[0] for row in cursor.fetchall()} - set(names)
+            drop_leftovers(cursor, names)
+            try:
+                for name in names:
+                    logging.debug("Cloning {} into {}".format(template, name))
+                    cursor.execute(get_create_database_statement(cursor, name + NEXT_SUFFIX, template))
+            except Exception:
+                drop_leftovers(cursor, names)
+                raise
+            swap_databases(cursor, names)
+            drop_databases(cursor, stale)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create fresh copies of an anonymized database published as a template "
+        "by pgantomizer --publish-template.",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="increase output verbosity"
+    )
+    parser.add_argument("--template", help="name of the template database", required=True)
+    parser.add_argument(
+        "-n",
+        "--count",
+        type=int,
+        default=1,
+        help="number of clones named <template>_1 to <template>_<count> replacing the previous ones",
+    )
+    parser.add_argument(
+        "--user",
+        help="name of the Postgres user allowed to create databases, ANONYMIZED_DB_* variables are used if omitted",
+    )
+    parser.add_argument("--password", help="password of the Postgres user", default="")
+    parser.add_argument("--host", help="host where the DB is running", default="localhost")
+    parser.add_argument("--port", help="port where the DB is running", default="5432")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG)
+    else:
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    if args.count < 1:
+        sys.exit("At least one clone must be created.")
+
+    clone_template(
+        dict(zip(DB_ARG_NAMES, (None, args.user, args.password, args.host, args.port)))
+        if args.user
+        else get_db_args_from_env(),
+        args.template,
+        args.count,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+
+from .rewrite import get_anonymized_values
+from .utils import quote_table_name
+
+
+def copy_between(source_conn, target_conn, copy_out_sql, copy_in_sql):
+    """
+    Pipe COPY TO STDOUT on the source into COPY FROM STDIN on the target; the pipe keeps memory
+    bounded by blocking the source whenever the target falls behind. Return the number of rows copied.
+    """
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "rb")
+    writer = os.fdopen(write_fd, "wb")
+    errors = []
+
+    def copy_out():
+        try:
+            with source_conn.cursor() as cursor:
+                cursor.copy_expert(copy_out_sql, writer)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # Closing the pipe ends the COPY on the target
+            writer.close()
+
+    thread = threading.Thread(target=copy_out)
+    thread.start()
+    try:
+        with target_conn.cursor() as cursor:
+            cursor.copy_expert(copy_in_sql, reader)
+            copied_rows = cursor.rowcount
+    finally:
+        # Unblocks the source if the target failed
+        reader.close()
+        thread.join()
+    if errors:
+        raise errors[0]
+    return copied_rows
+
+
+def transfer_table(
+    source_conn,
+    target_conn,
+    table,
+    column_values,
+    where_clause=None,
+    row_filter=None,
+    target_table=None,
+):
+    """
+    Copy the table from the source DB to the target DB with the anonymization expressions evaluated
+    by the source, so that the raw values never reach the target and every row is written exactly once.
+    Only rows matching `row_filter` are copied, into `target_table` if it is given.
+    Return the number of rows copied.
+    """
+    with target_conn.cursor() as cursor:
+        columns, values = get_anonymized_values(cursor, table, column_values, where_clause)
+    copy_out_sql = "COPY (SELECT {values} FROM {table} WHERE {row_filter}) TO STDOUT".format(
+        values=", ".join(values), table=quote_table_name(table), row_filter=row_filter or "TRUE"
+    )
+    copy_in_sql = "COPY {table} ({columns}) FROM STDIN".format(
+        table=target_table or quote_table_name(table), columns=", ".join(columns)
+    )
+    logging.debug("Copying anonymized {} from the source DB ...".format(table))
+    return copy_between(source_conn, target_conn, copy_out_sql, copy_in_sql)
@@ -1,4 +1,12 @@
-from functools import reduce
+import glob
+import os
+import secrets
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from functools import lru_cache, reduce
+
+
+SECRET_KEY_ENV = "PGANTOMIZER_SECRET_KEY"
 
 
 def get_in(nested_dict, keys, default=None):
@@ -6,3 +14,95 @@ def get_in(nested_dict, keys, default=None):
         return mapping.get(key) if mapping else default
 
     return reduce(get_or_none, keys, nested_dict) if keys else default
+
+
+@lru_cache(maxsize=None)
+def get_secret_key():
+    """
+    Return the secret key of the run that keys the hashes of values, so that pseudonyms cannot be recomputed
+    from guessed raw values. It is read from PGANTOMIZER_SECRET_KEY, or generated randomly for the run.
+    Pseudonyms are stable across runs only with the same key.
+    """
+    return os.environ.get(SECRET_KEY_ENV) or secrets.token_hex(32)
+
+
+def get_truncated_tables(schema):
+    """Return names of the tables whose data is dropped by the anonymization anyway."""
+    return [
+        table
+        for table, rules in schema.items()
+        if rules and rules.get("truncate") in (True, "cascade")
+    ]
+
+
+def split_table_name(table):
+    """Return the namespace (public if none is given) and the name of a possibly schema-qualified table."""
+    namespace, _, name = table.rpartition(".")
+    return namespace or "public", name
+
+
+def qualify_table_name(namespace, name):
+    """Return the name tables are referred to by: bare in public, qualified by their namespace elsewhere."""
+    return name if namespace == "public" else "{}.{}".format(namespace, name)
+
+
+def quote_identifier(name):
+    """Return the name double-quoted as an SQL identifier, the way `psycopg2.sql.Identifier` renders it."""
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def quote_table_name(table):
+    """Return the table name as an SQL identifier qualified by its namespace, both quoted."""
+    return "{}.{}".format(*(quote_identifier(part) for part in split_table_name(table)))
+
+
+def unquote_identifier(identifier):
+    """Return the name given by the identifier, which is double-quoted if it is not a plain lowercase name."""
+    if identifier.startswith('"'):
+        return identifier[1:-1].replace('""', '"')
+    return identifier
+
+
+def table_matches(pattern, table):
+    """Tell whether the table is matched by the name in the schema, whose namespace may be a glob pattern."""
+    pattern_namespace, pattern_name = split_table_name(pattern)
+    namespace, name = split_table_name(table)
+    return name == pattern_name and fnmatchcase(namespace, pattern_namespace)
+
+
+def get_temporary_table_name(table, suffix):
+    # Temporary tables live in their own namespace, so the name must not be qualified
+    return quote_identifier("{}{}".format(table.replace(".", "__"), suffix))
+
+
+def get_namespace_patterns(schema):
+    return sorted({split_table_name(table)[0] for table in schema})
+
+
+def expand_schema(schema, namespaces):
+    """
+    Return the schema with the rules of every table keyed by its name as loaded by `load_catalog`.
+    Tables are listed by their names in public or qualified by their namespace, which may be a glob pattern
+    applying the rules to the table in every matching namespace, e.g. `tenant_*.customer`.
+    Rules of a table in a namespace given by its exact name take precedence over rules matched by a pattern.
+    """
+    expanded = OrderedDict(
+        (qualify_table_name(*split_table_name(table)), rules)
+        for table, rules in schema.items()
+        if not glob.has_magic(table)
+    )
+    for table, rules in schema.items():
+        name = split_table_name(table)[1]
+        for namespace in namespaces:
+            if table_matches(table, qualify_table_name(namespace, name)):
+                expanded.setdefault(qualify_table_name(namespace, name), rules)
+    return expanded
+
+
+def execute_statements(cursor, statements):
+    """
+    Run the statements in a single round-trip to the server as one query. They are executed in order
+    in the current transaction and the first statement failing raises its error, as if run one by one.
+    """
+    if statements:
+        cursor.execute(";\n".join(statements))
@@ -47,6 +47,8 @@ setup(
         "console_scripts": [
             "pgantomizer_dump=pgantomizer.dump:main",
             "pgantomizer=pgantomizer.anonymize:main",
+            "pgantomizer_replicate=pgantomizer.replicate:main",
+            "pgantomizer_clone=pgantomizer.template:main",
         ]
     },
 )
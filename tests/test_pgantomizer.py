@@ -1,16 +1,39 @@
+import hashlib
+import hmac
+import json
 import os
+import shutil
+import subprocess
 from types import SimpleNamespace
 
+import psycopg2
 import pytest
+import yaml
 from pytest_postgresql import factories
 
+from benchmarks.benchmark import compare_with_baseline
 from pgantomizer.anonymize import (
     InvalidAnonymizationSchemaError,
     MissingAnonymizationRuleError,
+    PgantomizerError,
+    drop_schema,
+    get_dump_emptied_tables,
     load_anonymize_remove,
     load_db_to_new_instance,
+    plan_db,
 )
-from pgantomizer.dump import dump_db
+from pgantomizer.dump import ANONYMIZED_DB_ENV_NAMES, DB_ARG_NAMES, DB_ENV_NAMES, dump_db
+from pgantomizer.metrics import Metrics
+from pgantomizer.replicate import (
+    create_replication_slot,
+    drop_replication_slot,
+    parse_lsn,
+    replicate,
+)
+from pgantomizer.template import clone_template, drop_databases
+from pgantomizer.template import main as clone_main
+from pgantomizer.python_rules import scramble
+from pgantomizer.utils import SECRET_KEY_ENV, execute_statements, get_secret_key
 from pgantomizer.dump import main as dump_main
 from pgantomizer.anonymize import main as anonymize_main
 
@@ -21,6 +44,7 @@ anonymized_proc = factories.postgresql_proc(port="8765")
 anonymized = factories.postgresql("anonymized_proc")
 
 DUMP_PATH = "test_dump.sql"
+DUMP_DIR_PATH = "test_dump_dir"
 SCHEMA_PATH = "example_schema.yaml"
 ORIGINAL_DB_ARGS = {
     "password": "",
@@ -78,12 +102,803 @@ def test_dump_and_load(original_db, anonymized):
     os.remove(DUMP_PATH)
 
 
+def test_truncated_table_data_is_not_dumped_or_restored(original_db, anonymized):
+    dump_db(DUMP_PATH, "tests/truncated_table.yaml", "", *DUMP_DB_ARGS)
+    toc = subprocess.run(
+        ["pg_restore", "-l", DUMP_PATH], stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    assert "TABLE DATA public customer " in toc
+    assert "TABLE DATA public delivery " not in toc
+
+    # Data of truncated tables is skipped on restore even if the dump contains it
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS, excluded_data_tables=["customer"])
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT count(*) FROM customer;")
+    assert cursor.fetchone()[0] == 0
+    cursor.execute("SELECT count(*) FROM customer_address;")
+    assert cursor.fetchone()[0] == 2
+
+    os.remove(DUMP_PATH)
+
+
+@pytest.mark.parametrize("defer_post_data", [False, True])
+def test_tables_referencing_table_truncated_with_cascade_are_emptied(original_db, anonymized, defer_post_data):
+    dump_db(DUMP_PATH, "tests/truncated_cascade.yaml", "", *DUMP_DB_ARGS)
+    toc = subprocess.run(
+        ["pg_restore", "-l", DUMP_PATH], stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    assert "TABLE DATA public customer_address " not in toc
+
+    load_anonymize_remove(
+        DUMP_PATH,
+        "tests/truncated_cascade.yaml",
+        leave_dump=False,
+        db_args=ANONYMIZED_DB_ARGS,
+        defer_post_data=defer_post_data,
+    )
+    cursor = anonymized.cursor()
+    for table in ("customer", "customer_address", "delivery"):
+        cursor.execute("SELECT count(*) FROM {};".format(table))
+        assert cursor.fetchone()[0] == 0
+    cursor.execute("SELECT count(*) FROM pg_constraint WHERE contype = 'f';")
+    assert cursor.fetchone()[0] == 2
+
+
+def test_data_of_tables_referencing_table_truncated_with_cascade_is_not_restored(original_db, anonymized):
+    # The dump contains the data of all tables, the references are found in its foreign keys
+    dump_db(DUMP_PATH, "tests/truncated_table.yaml", "", *DUMP_DB_ARGS)
+    with open("tests/truncated_cascade.yaml") as schema_file:
+        schema = yaml.safe_load(schema_file)
+    emptied_tables = get_dump_emptied_tables(DUMP_PATH, schema)
+    assert sorted(emptied_tables) == ["customer", "customer_address", "delivery"]
+
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS, excluded_data_tables=emptied_tables)
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT count(*) FROM customer_address;")
+    assert cursor.fetchone()[0] == 0
+    cursor.execute("SELECT count(*) FROM pg_constraint WHERE contype = 'f';")
+    assert cursor.fetchone()[0] == 2
+
+    os.remove(DUMP_PATH)
+
+
+def test_directory_dump_in_parallel(original_db, anonymized):
+    dump_db(
+        DUMP_DIR_PATH,
+        SCHEMA_PATH,
+        "",
+        *DUMP_DB_ARGS,
+        dump_format="directory",
+        jobs=2,
+        compression="none",
+    )
+    assert os.path.isfile(os.path.join(DUMP_DIR_PATH, "toc.dat"))
+    try:
+        load_anonymize_remove(
+            DUMP_DIR_PATH,
+            SCHEMA_PATH,
+            leave_dump=False,
+            db_args=ANONYMIZED_DB_ARGS,
+            restore_jobs=2,
+        )
+        assert_db_anonymized(anonymized)
+        assert not os.path.exists(DUMP_DIR_PATH)
+    finally:
+        shutil.rmtree(DUMP_DIR_PATH, ignore_errors=True)
+
+
+@pytest.mark.parametrize("defer_post_data", [False, True])
+def test_stream_anonymize(original_db, anonymized, defer_post_data):
+    load_anonymize_remove(
+        DUMP_PATH,
+        SCHEMA_PATH,
+        db_args=ANONYMIZED_DB_ARGS,
+        defer_post_data=defer_post_data,
+        stream=True,
+        source_db_args=ORIGINAL_DB_ARGS,
+    )
+    assert_db_anonymized(anonymized)
+    assert not os.path.exists(DUMP_PATH)
+
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT count(*) FROM pg_indexes WHERE schemaname = 'public';")
+    assert cursor.fetchone()[0] == 2
+
+
+def test_anonymize_in_flight(original_db, anonymized):
+    load_anonymize_remove(
+        DUMP_PATH,
+        "tests/truncated_table.yaml",
+        db_args=ANONYMIZED_DB_ARGS,
+        in_flight=True,
+        source_db_args=ORIGINAL_DB_ARGS,
+    )
+    assert_db_anonymized(anonymized)
+
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT count(*) FROM delivery;")
+    assert cursor.fetchone()[0] == 0
+    cursor.execute("SELECT count(*) FROM pg_constraint WHERE contype = 'f';")
+    assert cursor.fetchone()[0] == 2
+    # The raw values were never written, so no dead tuples are left behind
+    cursor.execute("SELECT sum(n_tup_upd) FROM pg_stat_user_tables;")
+    assert cursor.fetchone()[0] == 0
+
+
+def test_anonymize_incrementally(original_db, anonymized):
+    cursor = original_db.cursor()
+    cursor.execute("ALTER TABLE customer ADD COLUMN updated_at timestamptz NOT NULL DEFAULT now();")
+    original_db.commit()
+    load_anonymize_remove(
+        DUMP_PATH,
+        "tests/incremental.yaml",
+        db_args=ANONYMIZED_DB_ARGS,
+        source_db_args=ORIGINAL_DB_ARGS,
+        incremental=True,
+    )
+
+    cursor.execute(
+        "UPDATE customer SET currency = 'EUR', updated_at = now() + interval '1 second' WHERE customer_id = 1;"
+    )
+    cursor.execute(
+        "INSERT INTO customer VALUES (3, 'Kathryn Janeway', 'en', 'USD', '192.133.133.133', now() + interval '1 second');"
+    )
+    cursor.execute("INSERT INTO customer_address VALUES (3, 3, 'Indiana', 'USA');")
+    cursor.execute("DELETE FROM customer_address WHERE id = 2;")
+    cursor.execute("DELETE FROM customer WHERE customer_id = 2;")
+    original_db.commit()
+    load_anonymize_remove(
+        DUMP_PATH,
+        "tests/incremental.yaml",
+        db_args=ANONYMIZED_DB_ARGS,
+        source_db_args=ORIGINAL_DB_ARGS,
+        incremental=True,
+    )
+
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT customer_id, name, currency FROM customer ORDER BY customer_id;")
+    assert cursor.fetchall() == [(1, "name_1", "EUR"), (3, "name_3", "USD")]
+    cursor.execute("SELECT id, customer_id, address_line FROM customer_address ORDER BY id;")
+    assert cursor.fetchall() == [(1, 1, "15"), (3, 3, "7")]
+    # Only the changed rows were written by the second run
+    cursor.execute("SELECT sum(n_tup_upd) FROM pg_stat_user_tables WHERE schemaname = 'public';")
+    assert cursor.fetchone()[0] == 1
+
+
+def test_anonymize_incrementally_keeps_tables_referencing_truncated_table_empty(original_db, anonymized):
+    for address_id in (3, 4):
+        cursor = original_db.cursor()
+        cursor.execute(
+            "INSERT INTO customer_address VALUES (%s, 1, 'Paris', 'France');", (address_id,)
+        )
+        original_db.commit()
+        load_anonymize_remove(
+            DUMP_PATH,
+            "tests/incremental_cascade.yaml",
+            db_args=ANONYMIZED_DB_ARGS,
+            source_db_args=ORIGINAL_DB_ARGS,
+            incremental=True,
+        )
+
+    cursor = anonymized.cursor()
+    for table in ("customer", "customer_address", "delivery"):
+        cursor.execute("SELECT count(*) FROM {};".format(table))
+        assert cursor.fetchone()[0] == 0
+
+
+def test_replicate(original_db, anonymized):
+    cursor = original_db.cursor()
+    # A table without rules is published too, but it is not copied to the anonymized DB
+    cursor.execute("CREATE TABLE audit (id serial PRIMARY KEY, event varchar NOT NULL);")
+    cursor.execute("ALTER TABLE customer_address ADD COLUMN details jsonb;")
+    original_db.commit()
+    create_replication_slot(ORIGINAL_DB_ARGS)
+    try:
+        load_anonymize_remove(
+            DUMP_PATH,
+            "tests/replicated.yaml",
+            db_args=ANONYMIZED_DB_ARGS,
+            in_flight=True,
+            source_db_args=ORIGINAL_DB_ARGS,
+        )
+        cursor = original_db.cursor()
+        cursor.execute("UPDATE customer SET currency = 'EUR' WHERE customer_id = 1;")
+        cursor.execute(
+            "INSERT INTO customer VALUES (3, 'Kathryn Janeway', 'en', 'USD', '192.133.133.133');"
+        )
+        cursor.execute(
+            "INSERT INTO customer_address VALUES (3, 3, 'Indiana', 'USA', '{\"deck\": 5}');"
+        )
+        cursor.execute("INSERT INTO delivery VALUES (2, 3, 'Tricorder', '10.0.0.0');")
+        cursor.execute("INSERT INTO audit (event) VALUES ('customer 3 created');")
+        original_db.commit()
+        cursor.execute("TRUNCATE audit;")
+        cursor.execute("DELETE FROM customer_address WHERE id = 2;")
+        cursor.execute("DELETE FROM customer WHERE customer_id = 2;")
+        cursor.execute("SELECT pg_current_wal_insert_lsn()::text;")
+        until_lsn = cursor.fetchone()[0]
+        original_db.commit()
+        replicate(
+            yaml.load(open("tests/replicated.yaml"), Loader=yaml.FullLoader),
+            ORIGINAL_DB_ARGS,
+            ANONYMIZED_DB_ARGS,
+            until_lsn=parse_lsn(until_lsn),
+        )
+    finally:
+        drop_replication_slot(ORIGINAL_DB_ARGS)
+
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT customer_id, name, currency FROM customer ORDER BY customer_id;")
+    assert cursor.fetchall() == [(1, "name_1", "EUR"), (3, "name_3", "USD")]
+    cursor.execute(
+        "SELECT id, customer_id, address_line, details FROM customer_address ORDER BY id;"
+    )
+    assert cursor.fetchall() == [(1, 1, "15", None), (3, 3, "7", {"deck": 5})]
+    cursor.execute("SELECT count(*) FROM delivery;")
+    assert cursor.fetchone()[0] == 0
+
+
+def test_publish_template_and_clone(dumped_db, anonymized_proc, monkeypatch):
+    maintenance_conn = psycopg2.connect(**{**ANONYMIZED_DB_ARGS, "dbname": "postgres"})
+    maintenance_conn.autocommit = True
+    cursor = maintenance_conn.cursor()
+    cursor.execute("CREATE DATABASE template_build;")
+    try:
+        load_anonymize_remove(
+            DUMP_PATH,
+            SCHEMA_PATH,
+            db_args={**ANONYMIZED_DB_ARGS, "dbname": "template_build"},
+            template="anonymized",
+        )
+        clone_template(ANONYMIZED_DB_ARGS, "anonymized", 2)
+        # The clones are made on the anonymized instance, never on the source one
+        for name, var in zip(DB_ARG_NAMES, ANONYMIZED_DB_ENV_NAMES):
+            monkeypatch.setenv(var, ANONYMIZED_DB_ARGS[name])
+        for name, var in zip(DB_ARG_NAMES, DB_ENV_NAMES):
+            monkeypatch.setenv(var, ORIGINAL_DB_ARGS[name])
+        monkeypatch.setattr("sys.argv", ["pgantomizer_clone", "--template", "anonymized", "-n", "1"])
+        clone_main()
+
+        cursor.execute("SELECT datname, datistemplate FROM pg_database WHERE datname LIKE 'anonymized%' ORDER BY 1;")
+        assert cursor.fetchall() == [("anonymized", True), ("anonymized_1", False)]
+        clone = psycopg2.connect(**{**ANONYMIZED_DB_ARGS, "dbname": "anonymized_1"})
+        assert_db_anonymized(clone)
+        clone.close()
+    finally:
+        drop_databases(cursor, ["template_build", "anonymized", "anonymized_1"])
+        maintenance_conn.close()
+
+
+def test_anonymize_skips_unchanged_rows(dumped_db, anonymized):
+    load_anonymize_remove(DUMP_PATH, SCHEMA_PATH, leave_dump=True, db_args=ANONYMIZED_DB_ARGS)
+    cursor = anonymized.cursor()
+    cursor.execute("UPDATE customer SET name = 'Data' WHERE customer_id = 2;")
+    cursor.execute("SELECT customer_id, xmin::text FROM customer ORDER BY customer_id;")
+    written = cursor.fetchall()
+    anonymized.commit()
+
+    load_anonymize_remove(DUMP_PATH, SCHEMA_PATH, skip_restore=True, db_args=ANONYMIZED_DB_ARGS)
+    cursor.execute("SELECT customer_id, xmin::text, name FROM customer ORDER BY customer_id;")
+    customers = cursor.fetchall()
+    assert customers[0] == written[0] + ("name_1",)
+    assert customers[1][1] != written[1][1]
+    assert customers[1][2] == "name_2"
+
+
+def test_values_without_proper_equality_are_compared_as_text(anonymized):
+    cursor = anonymized.cursor()
+    cursor.execute(
+        "CREATE TABLE shape (id int PRIMARY KEY, bounds box, outline polygon, selector jsonpath);"
+        "INSERT INTO shape VALUES (1, '(3,3),(1,1)', '((0,0),(2,2),(2,0))', '$.name');"
+    )
+    anonymized.commit()
+    load_anonymize_remove(
+        None, "tests/geometric_types.yaml", skip_restore=True, db_args=ANONYMIZED_DB_ARGS
+    )
+    # The raw box has the same area as the anonymized one, which `=` of boxes takes for equal
+    cursor.execute("SELECT bounds::text, outline::text, selector::text FROM shape;")
+    assert cursor.fetchall() == [("(2,2),(0,0)", "((0,0),(1,1),(1,0))", '$."id"')]
+
+
+def test_load_anonymize_remove_multiple_schemas(original_db, anonymized, caplog):
+    cursor = original_db.cursor()
+    for tenant in ("tenant_1", "tenant_2"):
+        cursor.execute(
+            "CREATE SCHEMA {tenant}; CREATE TABLE {tenant}.customer (customer_id integer PRIMARY KEY, "
+            "name varchar NOT NULL, language varchar NOT NULL, currency varchar NOT NULL, ip inet NOT NULL); "
+            "INSERT INTO {tenant}.customer SELECT * FROM customer;".format(tenant=tenant)
+        )
+    original_db.commit()
+    dump_db(DUMP_PATH, "tests/multi_schema.yaml", "", *DUMP_DB_ARGS)
+
+    caplog.set_level("INFO")
+    load_anonymize_remove(
+        DUMP_PATH, "tests/multi_schema.yaml", db_args=ANONYMIZED_DB_ARGS, jobs=2
+    )
+    assert_db_anonymized(anonymized)
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT name, host(ip) FROM tenant_1.customer ORDER BY customer_id;")
+    assert cursor.fetchall() == [("name_1", "111.111.111.111"), ("name_2", "111.111.111.111")]
+    # Rules of a schema given by its name take precedence over the pattern
+    cursor.execute("SELECT name, host(ip) FROM tenant_2.customer ORDER BY customer_id;")
+    assert cursor.fetchall() == [("name_1", "192.222.222.222"), ("name_2", "192.111.111.111")]
+    assert len([record for record in caplog.records if record.msg.startswith("Anonymized schema")]) == 3
+
+
+def test_drop_schema_quotes_namespaces(anonymized):
+    cursor = anonymized.cursor()
+    cursor.execute('CREATE SCHEMA "Tenant 3"; CREATE TABLE "Tenant 3".customer (id int);')
+    anonymized.commit()
+
+    drop_schema(ANONYMIZED_DB_ARGS, ["Tenant 3"])
+    cursor.execute("SELECT to_regnamespace('\"Tenant 3\"') IS NOT NULL, to_regclass('\"Tenant 3\".customer');")
+    assert cursor.fetchone() == (True, None)
+
+
+@pytest.mark.parametrize("engine", ["update", "rewrite"])
+def test_load_anonymize_remove_quotes_table_names(original_db, anonymized, engine):
+    cursor = original_db.cursor()
+    cursor.execute(
+        'CREATE SCHEMA "Tenant 3"; '
+        'CREATE TABLE "Tenant 3"."Customer" (customer_id integer PRIMARY KEY, name varchar NOT NULL, '
+        "language varchar NOT NULL); "
+        'CREATE TABLE "Tenant 3"."Delivery" (delivery_id integer PRIMARY KEY, '
+        'customer_id integer REFERENCES "Tenant 3"."Customer", address varchar); '
+        'INSERT INTO "Tenant 3"."Customer" SELECT customer_id, name, language FROM customer; '
+        'INSERT INTO "Tenant 3"."Delivery" VALUES (1, 1, \'Deep Space Nine\');'
+    )
+    original_db.commit()
+    dump_db(DUMP_PATH, "tests/quoted_names.yaml", "", *DUMP_DB_ARGS)
+
+    load_anonymize_remove(
+        DUMP_PATH, "tests/quoted_names.yaml", db_args=ANONYMIZED_DB_ARGS, engine=engine, jobs=2
+    )
+    assert_db_anonymized(anonymized)
+    cursor = anonymized.cursor()
+    cursor.execute('SELECT name, language FROM "Tenant 3"."Customer" ORDER BY customer_id;')
+    assert cursor.fetchall() == [("name_1", "fr"), ("name_2", "tlh")]
+    cursor.execute('SELECT count(*) FROM "Tenant 3"."Delivery";')
+    assert cursor.fetchone()[0] == 0
+    cursor.execute(
+        "SELECT conrelid::regclass::text, contype FROM pg_constraint "
+        "WHERE connamespace = '\"Tenant 3\"'::regnamespace ORDER BY 1, 2;"
+    )
+    assert cursor.fetchall() == [
+        ('"Tenant 3"."Customer"', "p"),
+        ('"Tenant 3"."Delivery"', "f"),
+        ('"Tenant 3"."Delivery"', "p"),
+    ]
+
+
+def test_load_anonymize_remove_subset(original_db, anonymized):
+    cursor = original_db.cursor()
+    cursor.execute(
+        "INSERT INTO customer VALUES (3, 'Benjamin Sisko', 'en', 'LAT', '192.133.133.133'); "
+        "INSERT INTO customer_address VALUES (3, 3, 'New Orleans', 'Earth'); "
+        "INSERT INTO delivery VALUES (2, 3, 'Baseball', '123.123.123.124');"
+    )
+    original_db.commit()
+    dump_db(DUMP_DIR_PATH, "tests/subset.yaml", "", *DUMP_DB_ARGS)
+    assert os.path.isdir(os.path.join(DUMP_DIR_PATH, "subset"))
+
+    load_anonymize_remove(DUMP_DIR_PATH, "tests/subset.yaml", db_args=ANONYMIZED_DB_ARGS)
+    assert not os.path.exists(DUMP_DIR_PATH)
+    cursor = anonymized.cursor()
+    # Customer 3 is only referenced by the selected address, so its delivery is not followed
+    cursor.execute("SELECT customer_id, name FROM customer ORDER BY customer_id;")
+    assert cursor.fetchall() == [(1, "name_1"), (3, "name_3")]
+    cursor.execute("SELECT id, customer_id FROM customer_address ORDER BY id;")
+    assert cursor.fetchall() == [(1, 1), (3, 3)]
+    cursor.execute("SELECT id, customer_id FROM delivery ORDER BY id;")
+    assert cursor.fetchall() == [(1, 1)]
+    cursor.execute("SELECT count(*) FROM pg_constraint WHERE contype = 'f';")
+    assert cursor.fetchone()[0] == 2
+
+
+def test_subset_does_not_export_truncated_tables(original_db, anonymized):
+    dump_db(DUMP_DIR_PATH, "tests/subset_truncated.yaml", "", *DUMP_DB_ARGS)
+    assert sorted(os.listdir(os.path.join(DUMP_DIR_PATH, "subset"))) == [
+        "customer.dat.gz",
+        "customer_address.dat.gz",
+    ]
+
+    load_anonymize_remove(DUMP_DIR_PATH, "tests/subset_truncated.yaml", db_args=ANONYMIZED_DB_ARGS)
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT customer_id FROM customer_address;")
+    assert cursor.fetchall() == [(1,)]
+    cursor.execute("SELECT count(*) FROM delivery;")
+    assert cursor.fetchone()[0] == 0
+
+
+def test_load_anonymize_remove_ephemeral(dumped_db, anonymized, tmpdir):
+    metrics_path = str(tmpdir.join("metrics.json"))
+    load_anonymize_remove(
+        DUMP_PATH,
+        SCHEMA_PATH,
+        leave_dump=True,
+        db_args=ANONYMIZED_DB_ARGS,
+        metrics_path=metrics_path,
+        ephemeral=True,
+    )
+    assert_db_anonymized(anonymized)
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT relpersistence FROM pg_class WHERE relname IN ('customer', 'customer_pkey');")
+    assert cursor.fetchall() == [("u",), ("u",)]
+    assert json.load(open(metrics_path))["settings"]["synchronous_commit"] == "off"
+    anonymized.commit()
+
+    load_anonymize_remove(
+        DUMP_PATH, SCHEMA_PATH, db_args=ANONYMIZED_DB_ARGS, ephemeral=True, logged=True
+    )
+    assert_db_anonymized(anonymized)
+    cursor.execute("SELECT DISTINCT relpersistence FROM pg_class WHERE relname IN ('customer', 'customer_pkey');")
+    assert cursor.fetchall() == [("p",)]
+
+
+def test_load_anonymize_remove_ephemeral_with_rewrite_engine(dumped_db, anonymized):
+    load_anonymize_remove(
+        DUMP_PATH, SCHEMA_PATH, db_args=ANONYMIZED_DB_ARGS, engine="rewrite", ephemeral=True
+    )
+    assert_db_anonymized(anonymized)
+    cursor = anonymized.cursor()
+    cursor.execute(
+        "SELECT DISTINCT relpersistence FROM pg_class WHERE relname IN ('customer', 'customer_address');"
+    )
+    assert cursor.fetchall() == [("u",)]
+    # A foreign key between tables of different persistence could not be restored
+    cursor.execute("SELECT count(*) FROM pg_constraint WHERE contype = 'f';")
+    assert cursor.fetchone()[0] == 1
+
+
 def test_load_anonymize_remove(dumped_db, anonymized):
     assert_db_empty(anonymized)
     load_anonymize_remove(DUMP_PATH, SCHEMA_PATH, leave_dump=False, db_args=ANONYMIZED_DB_ARGS)
     assert_db_anonymized(anonymized)
 
 
+def test_load_anonymize_remove_in_parallel(dumped_db, anonymized):
+    assert_db_empty(anonymized)
+    load_anonymize_remove(
+        DUMP_PATH, SCHEMA_PATH, leave_dump=False, db_args=ANONYMIZED_DB_ARGS, jobs=2
+    )
+    assert_db_anonymized(anonymized)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_load_anonymize_remove_with_rewrite_engine(dumped_db, anonymized, jobs):
+    assert_db_empty(anonymized)
+    # Tables connected by foreign keys are rewritten serially, their swaps would deadlock
+    load_anonymize_remove(
+        DUMP_PATH,
+        SCHEMA_PATH,
+        leave_dump=False,
+        db_args=ANONYMIZED_DB_ARGS,
+        engine="rewrite",
+        jobs=jobs,
+    )
+    assert_db_anonymized(anonymized)
+
+    # Constraints and defaults of the swapped tables are recreated
+    cursor = anonymized.cursor()
+    cursor.execute(
+        "SELECT conrelid::regclass::text, contype FROM pg_constraint "
+        "WHERE connamespace = 'public'::regnamespace ORDER BY 1, 2;"
+    )
+    assert cursor.fetchall() == [
+        ("customer", "p"),
+        ("customer_address", "f"),
+        ("customer_address", "p"),
+    ]
+    cursor.execute(
+        "SELECT column_default FROM information_schema.columns "
+        "WHERE table_name = 'customer_address' AND column_name = 'id';"
+    )
+    assert cursor.fetchone()[0] == "nextval('customer_address_id_seq'::regclass)"
+
+
+def test_load_anonymize_remove_with_deferred_post_data(dumped_db, anonymized):
+    assert_db_empty(anonymized)
+    load_anonymize_remove(
+        DUMP_PATH, SCHEMA_PATH, leave_dump=False, db_args=ANONYMIZED_DB_ARGS, defer_post_data=True
+    )
+    assert_db_anonymized(anonymized)
+
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = 'public' ORDER BY 1;")
+    assert cursor.fetchall() == [("customer_address_pkey",), ("customer_pkey",)]
+
+
+def test_deferred_constraint_violated_by_anonymized_data_raises_exception(original_db, anonymized):
+    cursor = original_db.cursor()
+    cursor.execute("ALTER TABLE customer ADD CONSTRAINT ip_unique UNIQUE (ip);")
+    original_db.commit()
+    dump_db(DUMP_PATH, SCHEMA_PATH, "", *DUMP_DB_ARGS)
+    # All IPs are anonymized to the same address
+    with pytest.raises(PgantomizerError):
+        load_anonymize_remove(
+            DUMP_PATH, SCHEMA_PATH, db_args=ANONYMIZED_DB_ARGS, defer_post_data=True
+        )
+    assert_db_empty(anonymized)
+
+
+@pytest.mark.parametrize("batch_size", [1, "1kB"])
+def test_load_anonymize_remove_in_batches(dumped_db, anonymized, batch_size):
+    assert_db_empty(anonymized)
+    load_anonymize_remove(
+        DUMP_PATH,
+        SCHEMA_PATH,
+        leave_dump=False,
+        db_args=ANONYMIZED_DB_ARGS,
+        batch_size=batch_size,
+    )
+    assert_db_anonymized(anonymized)
+
+
+def test_only_anonymized_varchars_are_widened(dumped_db, anonymized):
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS)
+    cursor = anonymized.cursor()
+    cursor.execute(
+        "ALTER TABLE customer ALTER COLUMN name TYPE varchar(20), "
+        "ALTER COLUMN currency TYPE varchar(3);"
+        "ALTER TABLE customer_address ALTER COLUMN address_line TYPE varchar(20);"
+        "CREATE VIEW address_line AS SELECT address_line FROM customer_address;"
+    )
+    anonymized.commit()
+
+    load_anonymize_remove(DUMP_PATH, SCHEMA_PATH, skip_restore=True, db_args=ANONYMIZED_DB_ARGS)
+    assert_db_anonymized(anonymized)
+    cursor.execute(
+        "SELECT table_name, column_name, character_maximum_length FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND column_name IN ('name', 'currency', 'address_line') "
+        "ORDER BY 1, 2;"
+    )
+    assert cursor.fetchall() == [
+        ("address_line", "address_line", 20),
+        ("customer", "currency", 3),
+        ("customer", "name", 250),
+        ("customer_address", "address_line", 20),
+    ]
+
+
+def test_load_anonymize_remove_with_python_rules(dumped_db, anonymized):
+    load_anonymize_remove(DUMP_PATH, "tests/python_rules.yaml", db_args=ANONYMIZED_DB_ARGS)
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT name, currency FROM customer ORDER BY customer_id;")
+    (first_name, first_currency), (second_name, second_currency) = cursor.fetchall()
+    assert (first_name, second_name) == ("name_1", "name_2")
+    assert first_currency.isupper() and len(first_currency) == 3 and first_currency != "LAT"
+    assert second_currency.isupper() and len(second_currency) == 2 and second_currency != "KR"
+    cursor.execute("SELECT address_line, country FROM customer_address ORDER BY id;")
+    (first_line, first_country), (second_line, second_country) = cursor.fetchall()
+    assert (first_line, second_line) == ("15", "6")
+    assert first_country != "France" and first_country[0].isupper() and len(first_country) == 6
+    assert second_country != "Klingon Empire" and second_country[7] == " " and len(second_country) == 14
+
+
+def test_scrambled_values_depend_on_secret_key(monkeypatch):
+    scrambled = {}
+    for key in ("first", "second"):
+        monkeypatch.setenv(SECRET_KEY_ENV, key)
+        get_secret_key.cache_clear()
+        scrambled[key] = scramble("phone", ["+420 123 456", "+420 123 456", None], [1, 2, 3])
+    get_secret_key.cache_clear()
+    assert scrambled["first"][0] == scrambled["first"][1] and scrambled["first"][2] is None
+    assert scrambled["first"][0][0] == "+" and scrambled["first"][0][4::4] == "  "
+    assert scrambled["first"] != scrambled["second"]
+
+
+def test_domain_values_get_the_same_pseudonym_in_all_tables(dumped_db, anonymized, monkeypatch):
+    monkeypatch.setenv(SECRET_KEY_ENV, "secret")
+    get_secret_key.cache_clear()
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS)
+    cursor = anonymized.cursor()
+    cursor.execute(
+        "UPDATE customer SET name = 'Kronos' WHERE customer_id = 2;"
+        "ALTER TABLE customer ADD COLUMN token uuid DEFAULT gen_random_uuid();"
+        "ALTER TABLE customer_address ADD COLUMN token uuid;"
+        "UPDATE customer_address SET token = customer.token FROM customer "
+        "WHERE customer.customer_id = customer_address.customer_id;"
+        "ALTER TABLE customer ADD COLUMN code smallint DEFAULT 32000;"
+    )
+    cursor.execute("SELECT token FROM customer ORDER BY customer_id;")
+    tokens = [row[0] for row in cursor.fetchall()]
+    anonymized.commit()
+
+    try:
+        load_anonymize_remove(
+            DUMP_PATH, "tests/domain.yaml", skip_restore=True, db_args=ANONYMIZED_DB_ARGS
+        )
+    finally:
+        get_secret_key.cache_clear()
+    cursor.execute("SELECT name, token FROM customer ORDER BY customer_id;")
+    names, pseudonymized_tokens = zip(*cursor.fetchall())
+    cursor.execute("SELECT address_line, token FROM customer_address ORDER BY id;")
+    address_lines, address_tokens = zip(*cursor.fetchall())
+    assert names[1] == address_lines[1]
+    assert len(set(names + address_lines)) == 3
+    assert all(value.startswith("place_") for value in names + address_lines)
+    # The pseudonym is the keyed hash of the value, which reveals neither the value nor its order
+    assert names[1] == "place_" + hmac.new(b"secret", b"Kronos", hashlib.sha256).hexdigest()[:16]
+    assert pseudonymized_tokens == address_tokens
+    assert not set(pseudonymized_tokens) & set(tokens)
+    # Integers are reduced into the range of their type, independently of the other values
+    digest = hmac.new(b"secret", b"32000", hashlib.sha256).digest()
+    cursor.execute("SELECT DISTINCT code FROM customer;")
+    assert cursor.fetchall() == [(int.from_bytes(digest[:8], "big") & 32767,)]
+    cursor.execute("SELECT to_regnamespace('pgantomizer_mapping');")
+    assert cursor.fetchone()[0] is None
+
+
+def test_domain_columns_are_pseudonymized_in_rows_matched_before_other_rules(dumped_db, anonymized):
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS)
+    # The `where` rule reads a column that the other rules change before the pseudonyms are written
+    load_anonymize_remove(
+        DUMP_PATH, "tests/domain_where.yaml", skip_restore=True, db_args=ANONYMIZED_DB_ARGS
+    )
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT name, currency FROM customer ORDER BY customer_id;")
+    customers = cursor.fetchall()
+    assert customers[0] == ("Jean-Luc Picard", "LAT")
+    assert customers[1][0].startswith("place_") and customers[1][1] == "XXX"
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_partitions_inherit_rules_and_are_anonymized_once(dumped_db, anonymized, jobs):
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS)
+    cursor = anonymized.cursor()
+    cursor.execute(
+        "CREATE TABLE event (id int, note varchar(20), created date, PRIMARY KEY (id, created)) "
+        "PARTITION BY RANGE (created);"
+        "CREATE TABLE event_2020 PARTITION OF event FOR VALUES FROM ('2020-01-01') TO ('2021-01-01');"
+        "CREATE TABLE event_2021 PARTITION OF event FOR VALUES FROM ('2021-01-01') TO ('2022-01-01') "
+        "PARTITION BY RANGE (created);"
+        "CREATE TABLE event_2021_h1 PARTITION OF event_2021 "
+        "FOR VALUES FROM ('2021-01-01') TO ('2021-07-01');"
+        "CREATE TABLE event_2021_h2 PARTITION OF event_2021 "
+        "FOR VALUES FROM ('2021-07-01') TO ('2022-01-01');"
+        "INSERT INTO event VALUES (1, 'Borg cube sighted', '2020-05-01'), "
+        "(2, 'Red alert', '2021-03-01'), (3, 'Shields up', '2021-09-01');"
+    )
+    anonymized.commit()
+
+    load_anonymize_remove(
+        DUMP_PATH,
+        "tests/partitioned_table.yaml",
+        skip_restore=True,
+        db_args=ANONYMIZED_DB_ARGS,
+        jobs=jobs,
+    )
+    assert_db_anonymized(anonymized)
+    # Lengths of the original notes, a second pass would have turned them into their own lengths
+    cursor.execute("SELECT note FROM event ORDER BY id;")
+    assert cursor.fetchall() == [("17",), ("9",), ("10",)]
+    cursor.execute(
+        "SELECT DISTINCT character_maximum_length FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name LIKE 'event%' AND column_name = 'note';"
+    )
+    assert cursor.fetchall() == [(250,)]
+
+
+def test_columns_anonymized_by_rules_of_partitions_are_widened(dumped_db, anonymized):
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS)
+    cursor = anonymized.cursor()
+    cursor.execute(
+        "CREATE TABLE event (id int, note varchar(20), created date, PRIMARY KEY (id, created)) "
+        "PARTITION BY RANGE (created);"
+        "CREATE TABLE event_2020 PARTITION OF event FOR VALUES FROM ('2020-01-01') TO ('2021-01-01');"
+        "CREATE TABLE event_2021 PARTITION OF event FOR VALUES FROM ('2021-01-01') TO ('2022-01-01');"
+        "INSERT INTO event VALUES (1, 'Borg cube sighted', '2020-05-01'), (2, 'Red alert', '2021-03-01');"
+    )
+    anonymized.commit()
+
+    load_anonymize_remove(
+        DUMP_PATH, "tests/partition_rules.yaml", skip_restore=True, db_args=ANONYMIZED_DB_ARGS
+    )
+    cursor.execute("SELECT note FROM event ORDER BY id;")
+    assert cursor.fetchall() == [("Borg cube sighted",), ("Note removed by the anonymization",)]
+    cursor.execute(
+        "SELECT DISTINCT character_maximum_length FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name LIKE 'event%' AND column_name = 'note';"
+    )
+    assert cursor.fetchall() == [(250,)]
+
+
+def test_metrics_are_exported(dumped_db, anonymized, tmpdir):
+    metrics_path = str(tmpdir.join("metrics.json"))
+    prometheus_path = str(tmpdir.join("pgantomizer.prom"))
+    load_anonymize_remove(
+        DUMP_PATH,
+        SCHEMA_PATH,
+        db_args=ANONYMIZED_DB_ARGS,
+        metrics_path=metrics_path,
+        prometheus_path=prometheus_path,
+    )
+    assert_db_anonymized(anonymized)
+    with open(metrics_path) as metrics_file:
+        metrics = json.load(metrics_file)
+    assert {"drop", "restore", "check", "update"} <= set(metrics["stages"])
+    assert set(metrics["tables"]) == {"customer", "customer_address"}
+    customer = metrics["tables"]["customer"]
+    assert customer["rows"] == 2
+    assert customer["bytes_before"] > 0 and customer["bytes_after"] > 0
+    assert customer["wal_bytes"] > 0
+    with open(prometheus_path) as prometheus_file:
+        prometheus = prometheus_file.read()
+    assert 'pgantomizer_table_rows{table="customer"} 2\n' in prometheus
+    assert 'pgantomizer_stage_seconds{stage="restore"} ' in prometheus
+
+
+def test_metrics_record_failed_table_without_querying_aborted_transaction(original_db, tmpdir):
+    metrics = Metrics(enabled=True)
+    cursor = original_db.cursor()
+    with pytest.raises(psycopg2.errors.UndefinedColumn):
+        with metrics.table(cursor, "customer") as stats:
+            stats["rows"] = 1
+            cursor.execute("UPDATE customer SET missing = 1;")
+    assert metrics.tables["customer"]["rows"] == 1
+    assert metrics.tables["customer"]["bytes_before"] > 0
+    assert metrics.tables["customer"]["wal_bytes"] is None
+    original_db.rollback()
+
+    # Without metrics, no sizes are queried at all
+    with Metrics().table(None, "customer") as stats:
+        stats["rows"] = 2
+
+    metrics.tables['odd "table"\\\nname'] = metrics.tables.pop("customer")
+    prometheus_path = str(tmpdir.join("metrics.prom"))
+    metrics.write_prometheus(prometheus_path)
+    with open(prometheus_path) as prometheus_file:
+        assert 'pgantomizer_table_rows{table="odd \\"table\\"\\\\\\nname"} 1\n' in prometheus_file.read()
+
+
+def test_benchmark_reports_stages_slower_than_baseline_by_more_than_threshold():
+    baseline = {"dump": 10.0, "load": 10.0, "anonymize_bytes": 1000, "rows": 100}
+    results = {"dump": 12.5, "load": 11.5, "anonymize": 100.0, "anonymize_bytes": 5000, "rows": 100}
+    # Stages missing in the baseline and other results are not compared
+    assert compare_with_baseline(results, baseline, 0.2) == ["dump"]
+    assert compare_with_baseline(results, baseline, 0.1) == ["dump", "load"]
+    assert compare_with_baseline({"dump": 5.0, "load": 5.0}, baseline, 0.0) == []
+
+
+def test_plan_prints_statements_without_modifying_db(original_db, capsys, tmpdir):
+    baseline_path = str(tmpdir.join("baseline.json"))
+    with open(baseline_path, "w") as baseline_file:
+        json.dump({"anonymize": 2, "anonymize_bytes": 2000000, "anonymize_wal_bytes": 3000000}, baseline_file)
+
+    with open("tests/truncated_table.yaml") as schema_file:
+        schema = yaml.load(schema_file, Loader=yaml.FullLoader)
+    plan_db(schema, ORIGINAL_DB_ARGS, baseline_path=baseline_path)
+    output = capsys.readouterr().out
+    assert 'TRUNCATE "public"."delivery";' in output
+    assert (
+        "UPDATE \"public\".\"customer\" SET name = 'name_' || customer_id, ip = '111.111.111.111' "
+        "WHERE (name IS DISTINCT FROM ('name_' || customer_id)::character varying "
+        "OR ip IS DISTINCT FROM ('111.111.111.111')::inet);" in output
+    )
+    assert (
+        "UPDATE \"public\".\"customer_address\" SET address_line = length(address_line) "
+        "WHERE (address_line IS DISTINCT FROM (length(address_line))::character varying);" in output
+    )
+    assert "-- customer: " in output and "UPDATE cost" in output
+    assert "-- Projected total: " in output
+
+    cursor = original_db.cursor()
+    cursor.execute("SELECT count(*) FROM delivery;")
+    assert cursor.fetchone()[0] == 1
+    cursor.execute("SELECT name FROM customer ORDER BY customer_id;")
+    assert cursor.fetchall() == [("Jean-Luc Picard",), ("Worf, son of Mogh",)]
+
+
+def test_plan_against_source_db_covers_only_tables_of_schema(original_db, capsys):
+    with open(SCHEMA_PATH) as schema_file:
+        schema = yaml.load(schema_file, Loader=yaml.FullLoader)
+    # The schema leaves out delivery, which is not dumped either
+    plan_db(schema, ORIGINAL_DB_ARGS, source=True)
+    output = capsys.readouterr().out
+    assert "-- customer: " in output and "-- customer_address: " in output
+    assert "delivery" not in output
+
+
 def test_invalid_custom_rule_raises_exception(dumped_db, anonymized):
     with pytest.raises(MissingAnonymizationRuleError):
         load_anonymize_remove(
@@ -95,6 +910,48 @@ def test_invalid_custom_rule_raises_exception(dumped_db, anonymized):
     assert_db_empty(anonymized)
 
 
+def test_statements_run_in_one_query_fail_at_the_first_error(anonymized):
+    cursor = anonymized.cursor()
+    with pytest.raises(psycopg2.errors.UndefinedTable):
+        execute_statements(
+            cursor,
+            [
+                "CREATE TABLE first (id int)",
+                "INSERT INTO missing VALUES (1)",
+                "CREATE TABLE second (id int)",
+            ],
+        )
+    anonymized.rollback()
+    cursor.execute("SELECT to_regclass('first'), to_regclass('second');")
+    assert cursor.fetchone() == (None, None)
+
+
+def test_failed_run_is_resumed_from_journal(dumped_db, anonymized, tmpdir):
+    journal_path = str(tmpdir.join("journal.json"))
+    with pytest.raises(MissingAnonymizationRuleError):
+        load_anonymize_remove(
+            DUMP_PATH,
+            "tests/invalid_custom_rule.yaml",
+            leave_dump=False,
+            db_args=ANONYMIZED_DB_ARGS,
+            journal_path=journal_path,
+        )
+    # The restored data and the dump are kept for the resumed run
+    assert os.path.exists(DUMP_PATH)
+    assert os.path.exists(journal_path)
+
+    load_anonymize_remove(
+        DUMP_PATH,
+        SCHEMA_PATH,
+        leave_dump=False,
+        db_args=ANONYMIZED_DB_ARGS,
+        journal_path=journal_path,
+        resume=True,
+    )
+    assert_db_anonymized(anonymized)
+    assert not os.path.exists(journal_path)
+
+
 def test_missing_anonymization_rule_raises_exception(original_db, anonymized):
     dump_db(DUMP_PATH, "tests/missing_anonymization_rule.yaml", "", *DUMP_DB_ARGS)
     with pytest.raises(MissingAnonymizationRuleError):
@@ -118,6 +975,41 @@ def test_schema_column_missing_in_db_raises_exception(dumped_db, anonymized):
     assert_db_empty(anonymized)
 
 
+def test_domain_of_unsupported_type_raises_exception(dumped_db, anonymized, tmpdir):
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS)
+    with open("tests/domain.yaml") as schema_file:
+        schema = yaml.safe_load(schema_file)
+    schema["customer"]["raw"].remove("language")
+    schema["customer"]["custom_rules"]["language"] = {"domain": "language"}
+    cursor = anonymized.cursor()
+    cursor.execute("ALTER TABLE customer ALTER COLUMN language TYPE date USING '2020-01-01';")
+    anonymized.commit()
+    schema_path = str(tmpdir.join("schema.yaml"))
+    with open(schema_path, "w") as schema_file:
+        yaml.safe_dump(schema, schema_file)
+
+    with pytest.raises(InvalidAnonymizationSchemaError):
+        load_anonymize_remove(
+            DUMP_PATH, schema_path, skip_restore=True, db_args=ANONYMIZED_DB_ARGS
+        )
+
+
+def test_table_missing_in_schema_raises_exception(dumped_db, anonymized):
+    load_db_to_new_instance(DUMP_PATH, ANONYMIZED_DB_ARGS)
+    with pytest.raises(MissingAnonymizationRuleError):
+        load_anonymize_remove(
+            DUMP_PATH,
+            "tests/missing_table.yaml",
+            skip_restore=True,
+            db_args=ANONYMIZED_DB_ARGS,
+        )
+
+    # Nothing is anonymized when the schema is incomplete
+    cursor = anonymized.cursor()
+    cursor.execute("SELECT name FROM customer ORDER BY customer_id;")
+    assert cursor.fetchall() == [("Jean-Luc Picard",), ("Worf, son of Mogh",)]
+
+
 def test_missing_schema_raises_exception(dumped_db, anonymized):
     with pytest.raises(IOError):
         load_anonymize_remove(
@@ -132,6 +1024,11 @@ def test_command_line_invokation(original_db, anonymized, monkeypatch):
             verbose=False,
             schema=SCHEMA_PATH,
             dump_file=DUMP_PATH,
+            format="custom",
+            jobs=1,
+            compress="9",
+            metrics_file=None,
+            prometheus_file=None,
             disable_schema_changes=False,
             skip_restore=False,
             **{
@@ -149,6 +1046,27 @@ def test_command_line_invokation(original_db, anonymized, monkeypatch):
         lambda self: SimpleNamespace(
             verbose=False,
             leave_dump=False,
+            jobs=1,
+            engine="update",
+            defer_post_data=False,
+            batch_size=None,
+            journal=None,
+            resume=False,
+            restore_jobs=8,
+            stream=False,
+            in_flight=False,
+            incremental=False,
+            publish_template=None,
+            ephemeral=False,
+            logged=False,
+            plan=False,
+            benchmark_baseline=None,
+            metrics_file=None,
+            prometheus_file=None,
+            **{
+                "source_" + arg: None
+                for arg in ("dbname", "user", "host", "port", "password")
+            },
             schema=SCHEMA_PATH,
             dump_file=DUMP_PATH,
             disable_schema_changes=False,